@@ -0,0 +1,44 @@
+"""Simulated p50/p99 latency of the BackendPool strategies with 3 backends, one of them 8x slower.
+
+Backends are simulated in-process: latency grows with the requests a backend has in flight.
+
+    python benchmarks/balancing_strategies.py
+"""
+import asyncio
+import random
+
+import harness  # noqa: F401
+from utils.backend_pool import Backend, BackendPool
+
+SPEEDS = (1.0, 1.0, 8.0)
+REQUESTS = 3000
+
+
+async def simulate(strategy: str) -> (float, float):
+    random.seed(1)
+    pool = BackendPool([Backend('sim', port, None) for port in range(len(SPEEDS))], strategy)
+    latencies = []
+
+    async def request():
+        backend = pool.pick()
+        start = backend.start()
+        await asyncio.sleep(0.002 * SPEEDS[backend.port] * (1 + 0.3 * backend.in_flight) * random.uniform(0.5, 1.5))
+        # Backend.finish: the strategy alone, the circuit breakers of the pool would eject the slow backend.
+        latencies.append(backend.finish(start))
+
+    requests = []
+    for __ in range(REQUESTS):
+        requests.append(asyncio.ensure_future(request()))
+        await asyncio.sleep(0.0005)
+    await asyncio.gather(*requests)
+    return harness.percentile(latencies, 50), harness.percentile(latencies, 99)
+
+
+def main():
+    for strategy in BackendPool.STRATEGIES:
+        p50, p99 = asyncio.run(simulate(strategy))
+        print('{:<22} p50 {:8.1f} ms  p99 {:8.1f} ms'.format(strategy, p50, p99))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""Time of one 10 000-number batch lookup through the Balancer, MNP and DataBase (all in this process).
+
+    python benchmarks/batch_lookups.py
+"""
+import asyncio
+import json
+import time
+
+import aiohttp
+
+import harness
+
+NUMBERS = [str(79000000000 + i) for i in range(10000)]
+
+
+async def run():
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as session:
+        await session.post('http://127.0.0.1:8000/api/v1/login', json={'login': 'bench', 'password': 'bench'})
+        for name in ('get_operators', 'get_latest_mnps', 'get_mnp_histories'):
+            start = time.monotonic()
+            async with session.post('http://127.0.0.1:8000/api/v1/mnp/' + name,
+                                    json={'phone_numbers': NUMBERS}) as resp:
+                lines = (await resp.read()).splitlines()
+            elapsed_s = time.monotonic() - start
+            print('{:<18} status {}  {} numbers  {:.3f} s  {:.1f} us per number'.format(
+                name, resp.status, json.loads(lines[-1])['count'], elapsed_s, elapsed_s / len(NUMBERS) * 1e6))
+
+
+def main():
+    harness.start_all()
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
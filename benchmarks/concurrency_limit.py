@@ -0,0 +1,83 @@
+"""Latency and goodput of add_mnp through the Balancer with and without adaptive concurrency limits.
+
+One fake MNP server serves 10 requests at a time, 10 ms each; 300 closed-loop clients send requests for
+4 s and back off for 200 ms after a 503. The MNP server, the Balancer and the clients run in processes of
+their own.
+
+    python benchmarks/concurrency_limit.py [--limit]
+"""
+import asyncio
+import multiprocessing
+import sys
+import time
+
+import aiohttp
+
+import fake_mnp
+import harness
+
+PORT = 10000
+CLIENTS = 300
+DURATION_S = 4.0
+
+
+def serve_mnp():
+    semaphore = None
+
+    async def ten_at_a_time():
+        nonlocal semaphore
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(10)
+        async with semaphore:
+            await asyncio.sleep(0.01)
+
+    fake_mnp.serve(PORT, ten_at_a_time, in_thread=False)
+
+
+def serve_balancer(limit: bool):
+    import balancer
+    balancing = {'strategy': 'p2c_ewma', 'request_timeout_ms': 60000}
+    if limit:
+        balancing['concurrency_limit'] = {'global': {'initial_limit': 20, 'max_queue': 50, 'max_wait_ms': 100},
+                                          'per_backend': {'initial_limit': 20}}
+    harness.start(balancer.Balancer, harness.load('balancer', balancing=balancing,
+                                                  mnps=[{'host': '127.0.0.1', 'port': PORT}]), 'balancer')
+    time.sleep(DURATION_S + 60.0)
+
+
+async def run():
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True), connector=connector) as session:
+        await session.post('http://127.0.0.1:8000/api/v1/login', json={'login': 'bench', 'password': 'bench'})
+        latencies, statuses = [], {}
+        start = time.monotonic()
+
+        async def client():
+            while time.monotonic() - start < DURATION_S:
+                sent = time.monotonic()
+                async with session.post('http://127.0.0.1:8000/api/v1/mnp/add_mnp',
+                                        json={'phone_number': '79000000000', 'operator_name': 'bench'}) as resp:
+                    await resp.read()
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+                if resp.status == 200:
+                    latencies.append((time.monotonic() - sent) * 1000.0)
+                elif resp.status == 503:
+                    await asyncio.sleep(0.2)
+
+        await asyncio.gather(*(client() for __ in range(CLIENTS)))
+        return latencies, statuses
+
+
+def main():
+    limit = '--limit' in sys.argv[1:]
+    multiprocessing.Process(target=serve_mnp, daemon=True).start()
+    multiprocessing.Process(target=serve_balancer, args=(limit,), daemon=True).start()
+    time.sleep(1.5)
+    latencies, statuses = asyncio.run(run())
+    print('{}: {}  goodput {:.0f}/s  p50 {:.0f} ms  p99 {:.0f} ms'.format(
+        'limited' if limit else 'plain', statuses, statuses.get(200, 0) / DURATION_S,
+        harness.percentile(latencies, 50), harness.percentile(latencies, 99)))
+
+
+if __name__ == '__main__':
+    main()
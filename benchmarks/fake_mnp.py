@@ -0,0 +1,27 @@
+"""A stand-in MNP server for balancer benchmarks: answers every MNP route after a delay of its own."""
+import asyncio
+import threading
+from typing import Awaitable, Callable
+
+from aiohttp import web
+
+
+def serve(port: int, delay: Callable[[], Awaitable[None]], in_thread: bool = True) -> None:
+    """Serves on `port`, awaiting `delay()` before every answer; in a thread, or in this one for good."""
+    async def handle(req: web.Request) -> web.Response:
+        await delay()
+        return web.json_response({'data': port, 'code': 0})
+
+    async def health(req: web.Request) -> web.Response:
+        return web.json_response({'code': 0})
+
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.add_routes([web.post('/api/v1/mnp/{name}', handle), web.get('/api/v1/health', health)])
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+    if in_thread:
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+    else:
+        loop.run_forever()
@@ -0,0 +1,53 @@
+"""Runs the services of the repo in threads of one process, with their own configs and quiet logs."""
+import os
+import sys
+import threading
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+for service in ('balancer', 'mnp', 'database'):
+    sys.path.insert(0, os.path.join(ROOT, 'distributed_system', service))
+
+from utils.lazy_logger import LazyLogger  # noqa: E402
+from utils.utils import get_logger  # noqa: E402
+
+
+def load(service: str, **overrides) -> dict:
+    with open(os.path.join(ROOT, 'distributed_system', service, 'config.yml')) as f:
+        cfg = yaml.safe_load(f)
+    cfg['logs'] = {'con': False, 'level': 'WARNING', 'file': ''}
+    cfg['server']['min_timeout_ms'] = 1
+    cfg['server']['max_timeout_ms'] = 5
+    cfg.update(overrides)
+    return cfg
+
+
+def start(cls, cfg: dict, name: str):
+    """Starts a service in a thread of its own; returns it once it listens."""
+    started = threading.Event()
+    box = {}
+
+    def run():
+        box['service'] = cls(cfg, LazyLogger(get_logger(cfg, name)))
+        started.set()
+        box['service'].run()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return box['service']
+
+
+def start_all(balancer_cfg: dict = None, mnp_cfg: dict = None, database_cfg: dict = None):
+    import balancer
+    import database
+    import mnp
+    return (start(database.DataBase, load('database', **(database_cfg or {})), 'database'),
+            start(mnp.MNP, load('mnp', **(mnp_cfg or {})), 'mnp'),
+            start(balancer.Balancer, load('balancer', **(balancer_cfg or {})), 'balancer'))
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
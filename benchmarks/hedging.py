@@ -0,0 +1,62 @@
+"""Latency of get_operator through the Balancer with and without hedging.
+
+Two fake MNP servers answer 10% of requests after 1 s and the others after 5 ms; 20 rounds of 20
+concurrent requests are sent.
+
+    python benchmarks/hedging.py [--hedge]
+"""
+import asyncio
+import random
+import sys
+import time
+
+import aiohttp
+
+import fake_mnp
+import harness
+
+PORTS = (10000, 10001)
+
+
+async def slow_sometimes():
+    await asyncio.sleep(1.0 if random.random() < 0.1 else 0.005)
+
+
+async def run():
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as session:
+        await session.post('http://127.0.0.1:8000/api/v1/login', json={'login': 'bench', 'password': 'bench'})
+        latencies = []
+
+        async def request():
+            start = time.monotonic()
+            async with session.post('http://127.0.0.1:8000/api/v1/mnp/get_operator',
+                                    json={'phone_number': '79000000000'}) as resp:
+                await resp.read()
+                assert resp.status == 200, resp.status
+            latencies.append((time.monotonic() - start) * 1000.0)
+
+        for __ in range(20):
+            await asyncio.gather(*(request() for __ in range(20)))
+        return latencies
+
+
+def main():
+    hedge = '--hedge' in sys.argv[1:]
+    for port in PORTS:
+        fake_mnp.serve(port, slow_sometimes)
+    import balancer
+    balancing = {'strategy': 'p2c_ewma'}
+    if hedge:
+        balancing['hedging'] = {'percentile': 90, 'budget': 0.15, 'min_samples': 50, 'window': 200,
+                                'initial_delay_ms': 50}
+    harness.start(balancer.Balancer, harness.load('balancer', balancing=balancing,
+                                                  mnps=[{'host': '127.0.0.1', 'port': port} for port in PORTS]),
+                  'balancer')
+    latencies = asyncio.run(run())
+    print('{}: p50 {:.0f} ms  p95 {:.0f} ms  p99 {:.0f} ms'.format(
+        'hedged' if hedge else 'plain', harness.percentile(latencies, 50), harness.percentile(latencies, 95),
+        harness.percentile(latencies, 99)))
+
+
+if __name__ == '__main__':
+    main()
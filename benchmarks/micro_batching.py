@@ -0,0 +1,56 @@
+"""DataBase requests for concurrent single lookups with and without MNP micro-batching.
+
+1000 concurrent get_operator calls over 300 numbers go through the Balancer with the MNP cache off; the
+answers are checked against get_mnp_history of the same numbers.
+
+    python benchmarks/micro_batching.py [--batch]
+"""
+import asyncio
+import sys
+import time
+
+import aiohttp
+
+import harness
+
+CALLS = 1000
+NUMBERS = 300
+
+
+async def run():
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True), connector=connector) as session:
+        await session.post('http://127.0.0.1:8000/api/v1/login', json={'login': 'bench', 'password': 'bench'})
+
+        async def lookup(name: str, phone_number: str):
+            async with session.post('http://127.0.0.1:8000/api/v1/mnp/' + name,
+                                    json={'phone_number': phone_number}) as resp:
+                return (await resp.json())['data']
+
+        async def db_requests() -> int:
+            async with session.get('http://127.0.0.1:10000/api/v1/stats') as resp:
+                stats = await resp.json()
+            return sum(db['requests'] for db in stats['data']['replica_routing']['databases'])
+
+        start = time.monotonic()
+        operators = await asyncio.gather(*(lookup('get_operator', str(i % NUMBERS)) for i in range(CALLS)))
+        elapsed_s = time.monotonic() - start
+        requests = await db_requests()
+        histories = await asyncio.gather(*(lookup('get_mnp_history', str(i)) for i in range(NUMBERS)))
+        consistent = all(operators[i] == histories[i % NUMBERS][-1] for i in range(CALLS))
+        return requests, consistent, elapsed_s
+
+
+def main():
+    batch = '--batch' in sys.argv[1:]
+    mnp_cfg = {'cache': None, 'batching': {'max_delay_ms': 2, 'max_items': 100} if batch else None}
+    harness.start_all(balancer_cfg={'balancing': {'strategy': 'p2c_ewma'}}, mnp_cfg=mnp_cfg,
+                      database_cfg={'server': {'host': '0.0.0.0', 'port': 5432, 'min_timeout_ms': 20,
+                                               'max_timeout_ms': 30}})
+    requests, consistent, elapsed_s = asyncio.run(run())
+    print('{}: {} database requests for {} lookups, consistent {}, {:.2f} s'.format(
+        'batched' if batch else 'plain', requests, CALLS, consistent, elapsed_s))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,41 @@
 #!/usr/bin/python3
 import asyncio
-import base64
-import logging
+import multiprocessing
+import secrets
+import time
 from random import randint
-from typing import Mapping, Any, List
+from typing import Mapping, Any, Optional
 
 import aiohttp
 import aiohttp_session as web_session
 import yaml
 from aiohttp import web
-from aiohttp_session.cookie_storage import EncryptedCookieStorage
-from cryptography import fernet
+from multidict import CIMultiDict
 
-from utils.utils import get_logger, create_arguments_parser, parse_args_as_dict
+from utils.backend_pool import Backend, BackendPool
+from utils.concurrency_limiter import ConcurrencyLimiter
+from utils.deadline import Deadline
+from utils.hedging import HedgingPolicy
+from utils.id_generator import SnowflakeGenerator
+from utils.lazy_logger import LazyLogger
+from utils.session_storage import SignedCookieStorage
+from utils.utils import DEADLINE_EXCEEDED_HEADER, DEADLINE_HEADER, SESSION_KEY_HEADER, WRITE_POSITION_HEADER, \
+    get_logger, create_arguments_parser, parse_args_as_dict, make_app_runner
 
 
 class Balancer:
     def __make_app(self) -> web.Application:
         app = web.Application()
-        fernet_key = fernet.Fernet.generate_key()
-        secret_key = base64.urlsafe_b64decode(fernet_key)
-        web_session.setup(app, EncryptedCookieStorage(secret_key))
+        web_session.setup(app, self.__session_storage)
         app.add_routes([
             web.post(self.LOGIN_PATH, self.__login),
             web.post(self.LOGOUT_PATH, self.__logout),
+            web.get(self.STATS_PATH, self.__get_stats),
             web.route('*', self.TRANSFER_PATH + '/{tail:.*}', self.__transfer),
         ])
         return app
 
-    def __init__(self, cfg: dict, logger: logging.Logger):
+    def __init__(self, cfg: dict, logger: LazyLogger, worker_id: Optional[int] = None):
         self.__loop = asyncio.new_event_loop()
 
         self.__cfg = cfg.copy()
@@ -38,23 +45,53 @@ class Balancer:
 
         self.__min_timeout_ms = self.__cfg['server']['min_timeout_ms']
         self.__max_timeout_ms = self.__cfg['server']['max_timeout_ms']
+        # a client may ask for a shorter one in the deadline header.
+        self.__deadline_ms = self.__cfg['server'].get('deadline_ms')
 
-        runner = web.AppRunner(self.__make_app())
+        session_cfg = self.__cfg.get('session', {})
+        if session_cfg.get('secret', '') == '':
+            self.__logger.warning("no session secret configured, sessions will not survive a restart",
+                                  extra={'session_key': "???"})
+        if worker_id is not None and session_cfg.get('server_side', False):
+            self.__logger.warning("server side sessions are local to a worker, clients will lose them",
+                                  extra={'session_key': "???"})
+        self.__session_storage = SignedCookieStorage.from_config(session_cfg)
+
+        runner = make_app_runner(self.__make_app())
         self.__loop.run_until_complete(runner.setup())
-        site = web.TCPSite(runner, self.__host, self.__port)
+        # workers share the listening port, the kernel spreads connections between them.
+        site = web.TCPSite(runner, self.__host, self.__port, reuse_port=worker_id is not None)
         self.__loop.run_until_complete(site.start())
 
-        self.__mnps: List[Mapping[str, Any]] = self.__cfg['mnps']
+        balancing_cfg = self.__cfg.get('balancing', {})
+        self.__mnps = BackendPool.from_config(balancing_cfg, self.__cfg['mnps'], self.__loop)
+        limiter_cfg = balancing_cfg.get('concurrency_limit', {}).get('global')
+        self.__limiter = ConcurrencyLimiter.from_config(limiter_cfg) if limiter_cfg is not None else None
+        hedging_cfg = balancing_cfg.get('hedging')
+        self.__hedging = HedgingPolicy.from_config(hedging_cfg) if hedging_cfg is not None else None
+        self.__health_check_cfg = balancing_cfg.get('health_check')
+        if self.__health_check_cfg is not None:
+            self.__loop.create_task(self.__check_health())
 
-        self.__mnp_clients = [aiohttp.ClientSession('http://{}:{}'.format(mnp['host'], mnp['port']), loop=self.__loop)
-                              for mnp in self.__mnps]
-        self.__cur_mnp_ind = 0
-
-        self.__cur_session_key = 1
+        # session keys are unique across the workers of this balancer and across balancers with distinct node ids.
+        self.__session_keys = SnowflakeGenerator(node_id=self.__cfg['server'].get('node_id', 0),
+                                                 worker_id=worker_id if worker_id is not None else 0)
 
     def run(self):
         self.__loop.run_forever()
 
+    async def __check_health(self):
+        while True:
+            await asyncio.sleep(self.__health_check_cfg.get('interval_ms', 1000) / 1000.0)
+            states = [mnp.breaker.state for mnp in self.__mnps.backends]
+            await self.__mnps.check_health(self.__health_check_cfg.get('path', '/api/v1/health'),
+                                           self.__health_check_cfg.get('timeout_ms', 500))
+            for mnp, state in zip(self.__mnps.backends, states):
+                if mnp.breaker.state != state:
+                    self.__logger.warning("MNP server {} is {} after health check", mnp, mnp.breaker.state,
+                                          extra={'session_key': "???",
+                                                 'upstream_host': mnp.host, 'upstream_port': mnp.port})
+
     BASE_PATH = '/api/v1'
 
     LOGIN_PATH = BASE_PATH + '/login'
@@ -64,7 +101,7 @@ class Balancer:
                            extra={'session_key': "???"})
         session = await web_session.get_session(req)
         if 'logged_in' in session:
-            self.__logger.warning("user '{}' is already logged in!".format(session['login']),
+            self.__logger.warning("user '{}' is already logged in!", session['login'],
                                   extra={'session_key': session['session_key']})
             return web.json_response({'code': -1, 'description': 'already logged in!'}, status=401)
         try:
@@ -76,7 +113,7 @@ class Balancer:
                                   extra={'session_key': "???"})
             return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
 
-        self.__logger.debug("login request params: {}".format(params),
+        self.__logger.debug("login request params: {}", params,
                             extra={'session_key': "???"})
 
         await asyncio.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0)
@@ -86,48 +123,307 @@ class Balancer:
                                   extra={'session_key': "???"})
             return web.json_response({'code': -1, 'description': 'invalid login or password!'}, status=401)
 
+        # the session is readable by the client, the password is not kept in it.
         session['login'] = login
-        session['password'] = password
         session['logged_in'] = True
-        session['session_key'] = self.__cur_session_key
-        self.__cur_session_key += 1
+        session['session_key'] = self.__session_keys.next_id()
 
-        self.__logger.info("user '{}' successfully logged in".format(login),
+        self.__logger.info("user '{}' successfully logged in", login,
                            extra={'session_key': session['session_key']})
 
         return web.json_response({'code': 0})
 
     TRANSFER_PATH = BASE_PATH
 
-    async def __transfer_inner(self, client: aiohttp.ClientSession, s_session: web_session.Session,
-                               s_req: web.Request) -> aiohttp.ClientResponse:
-        headers = s_req.headers.copy()
-        del headers['Content-Length']
-        data = (await s_req.json()).copy()
-        data['session_key'] = s_session['session_key']
-        return await client.request(s_req.method, s_req.path, headers=headers, json=data)
-
-    async def __transfer_mnp(self, session: web_session.Session, req: web.Request) -> web.Response:
-        cur_mnp_ind = self.__cur_mnp_ind
-        self.__cur_mnp_ind = (self.__cur_mnp_ind + 1) % len(self.__mnp_clients)
-        client = self.__mnp_clients[cur_mnp_ind]
-
+    # per-connection headers and the ones aiohttp sets itself are not passed between hops, nor are the credentials
+    # of the client: the session cookie is the balancer's, MNP servers get the session key instead.
+    HOP_HEADERS = frozenset(name.lower() for name in (
+        'Connection', 'Keep-Alive', 'Transfer-Encoding', 'Upgrade', 'Proxy-Connection', 'TE', 'Trailer', 'Host', 'Date',
+        'Server', 'Cookie', 'Set-Cookie', 'Authorization', SESSION_KEY_HEADER, DEADLINE_HEADER, WRITE_POSITION_HEADER))
+
+    @classmethod
+    def __pass_headers(cls, headers: Mapping[str, str]) -> CIMultiDict:
+        return CIMultiDict((name, value) for name, value in headers.items() if name.lower() not in cls.HOP_HEADERS)
+
+    def __session_headers(self, session: web_session.Session, req: web.Request) -> CIMultiDict:
+        headers = self.__pass_headers(req.headers)
+        headers[SESSION_KEY_HEADER] = str(session['session_key'])
+        # whichever MNP server gets the request, it reads what the session wrote through any of them.
+        if 'write_position' in session:
+            headers[WRITE_POSITION_HEADER] = str(session['write_position'])
+        return headers
+
+    @staticmethod
+    def __remember_write(session: web_session.Session, headers: Mapping[str, str]) -> bool:
+        """Keeps the write position an MNP server answered with in the session; returns whether it changed."""
+        try:
+            position = int(headers.get(WRITE_POSITION_HEADER, 0))
+        except ValueError:
+            return False
+        if position <= session.get('write_position', 0):
+            return False
+        session['write_position'] = position
+        return True
+
+    async def __send_to_mnp(self, mnp: Backend, session: web_session.Session, req: web.Request,
+                            deadline: Deadline) -> web.StreamResponse:
         self.__logger.debug(
-            "transferring {} request with path '{}' to MNP server {}:{}...".format(
-                req.method, req.path, self.__mnps[cur_mnp_ind]['host'], self.__mnps[cur_mnp_ind]['port']),
-            extra={'session_key': session['session_key']})
-        c_resp = await self.__transfer_inner(client, session, req)
+            "transferring {} request with path '{}' to MNP server {}:{}...",
+            req.method, req.path, mnp.host, mnp.port,
+            extra={'session_key': session['session_key'], 'route': req.path,
+                   'upstream_host': mnp.host, 'upstream_port': mnp.port})
+        headers = self.__session_headers(session, req)
+        self.__pass_deadline(headers, deadline)
+        # bodies are streamed as is in both directions, the session key travels in a header.
+        data = req.content if req.body_exists else None
+        # the request counts as in flight until the upstream body is passed on.
+        start = mnp.start()
+        ok = False
+        # a request the client gave up on (a disconnect or its deadline) says nothing about the MNP server.
+        abandoned = False
+        try:
+            async with mnp.client.request(req.method, req.path_qs, headers=headers, data=data,
+                                          timeout=deadline.client_timeout(mnp.client.timeout.total)) as c_resp:
+                s_resp = web.StreamResponse(status=c_resp.status, reason=c_resp.reason,
+                                            headers=self.__pass_headers(c_resp.headers))
+                ok = c_resp.status < 500
+                abandoned = DEADLINE_EXCEEDED_HEADER in c_resp.headers
+                if self.__remember_write(session, c_resp.headers):
+                    # the session middleware does not save into a streamed response, the cookie goes with the headers.
+                    await self.__session_storage.save_session(req, s_resp, session)
+                await s_resp.prepare(req)
+                try:
+                    async for chunk in c_resp.content.iter_any():
+                        await s_resp.write(chunk)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # the status line is already sent; the client sees a body shorter than its Content-Length.
+                    ok = False
+                    abandoned = deadline.caused(e)
+                    self.__logger.warning("MNP server {} broke off the response: {!r}", mnp, e,
+                                          extra={'session_key': session['session_key'], 'route': req.path,
+                                                 'upstream_host': mnp.host, 'upstream_port': mnp.port})
+                    s_resp.force_close()
+                    return s_resp
+                await s_resp.write_eof()
+        except asyncio.TimeoutError as e:
+            abandoned = deadline.caused(e)
+            raise
+        except asyncio.CancelledError:
+            abandoned = True
+            raise
+        finally:
+            if abandoned:
+                self.__mnps.cancel(mnp, start)
+                duration_ms = None
+            else:
+                duration_ms = self.__mnps.finish(mnp, start, ok)
         self.__logger.debug("transferred request successfully",
-                            extra={'session_key': session['session_key']})
-
-        print(await c_resp.json())
-
-        return web.json_response(await c_resp.json(), status=c_resp.status)
-
-    async def __transfer(self, req: web.Request) -> web.Response:
+                            extra={'session_key': session['session_key'], 'route': req.path,
+                                   'upstream_host': mnp.host, 'upstream_port': mnp.port,
+                                   'duration_ms': duration_ms})
+        return s_resp
+
+    @staticmethod
+    def __pass_deadline(headers: CIMultiDict, deadline: Deadline) -> None:
+        # the MNP server gets what is left of the deadline when the request leaves.
+        header = deadline.header()
+        if header is not None:
+            headers[DEADLINE_HEADER] = header
+
+    def __deadline_exceeded(self, session: web_session.Session, req: web.Request) -> web.Response:
+        self.__logger.warning("deadline exceeded, request abandoned!",
+                              extra={'session_key': session['session_key'], 'route': req.path})
+        return web.json_response({'code': -1, 'description': 'deadline exceeded!'}, status=504,
+                                 headers={DEADLINE_EXCEEDED_HEADER: '1'})
+
+    # idempotent reads, a duplicate of them is harmless; add_mnp is never hedged.
+    HEDGED_PATHS = frozenset((TRANSFER_PATH + '/mnp/get_operator', TRANSFER_PATH + '/mnp/get_latest_mnp',
+                              TRANSFER_PATH + '/mnp/get_mnp_history'))
+
+    async def __fetch_from_mnp(self, mnp: Backend, session: web_session.Session, req: web.Request,
+                               headers: CIMultiDict, body: bytes,
+                               deadline: Deadline) -> (int, Mapping[str, str], bytes):
+        self.__logger.debug(
+            "transferring {} request with path '{}' to MNP server {}:{}...",
+            req.method, req.path, mnp.host, mnp.port,
+            extra={'session_key': session['session_key'], 'route': req.path,
+                   'upstream_host': mnp.host, 'upstream_port': mnp.port})
+        headers = headers.copy()
+        self.__pass_deadline(headers, deadline)
+        start = mnp.start()
+        ok = False
+        abandoned = False
+        try:
+            async with mnp.client.request(req.method, req.path_qs, headers=headers, data=body,
+                                          timeout=deadline.client_timeout(mnp.client.timeout.total)) as c_resp:
+                data = await c_resp.read()
+                ok = c_resp.status < 500
+                abandoned = DEADLINE_EXCEEDED_HEADER in c_resp.headers
+                return c_resp.status, c_resp.headers, data
+        except asyncio.TimeoutError as e:
+            abandoned = deadline.caused(e)
+            raise
+        except asyncio.CancelledError:
+            abandoned = True
+            raise
+        finally:
+            if abandoned:
+                # the other request of a hedged pair won, or the client gave up.
+                self.__mnps.cancel(mnp, start)
+            else:
+                duration_ms = self.__mnps.finish(mnp, start, ok)
+                if ok:
+                    self.__logger.debug("transferred request successfully",
+                                        extra={'session_key': session['session_key'], 'route': req.path,
+                                               'upstream_host': mnp.host, 'upstream_port': mnp.port,
+                                               'duration_ms': duration_ms})
+
+    async def __transfer_hedged(self, session: web_session.Session, req: web.Request,
+                                deadline: Deadline) -> web.Response:
+        primary = self.__mnps.pick()
+        if primary is None:
+            self.__logger.warning('no available MNP server!',
+                                  extra={'session_key': session['session_key'], 'route': req.path})
+            return web.json_response({'code': -1, 'description': 'no available MNP server!'}, status=503)
+        self.__hedging.admit()
+
+        # a duplicate needs the body once more, so it is read up front; bodies of reads are small.
+        body = await req.read()
+        headers = self.__session_headers(session, req)
+
+        start = time.monotonic()
+        primary_fetch = asyncio.ensure_future(self.__fetch_from_mnp(primary, session, req, headers, body, deadline))
+        fetches = {primary_fetch: primary}
+        pending = set(fetches)
+        hedge = None
+        hedged = False
+        error = None
+        # a 5xx answer, returned only if no other request does better.
+        failed = None
+        timeout = self.__hedging.delay_s()
+        try:
+            while len(pending) != 0:
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                answers = [fetch for fetch in done if fetch.exception() is None]
+                for fetch in sorted(answers, key=lambda fetch: fetch.result()[0] >= 500):
+                    status, c_headers, data = fetch.result()
+                    if status >= 500 and len(pending) != 0:
+                        # the other request may still succeed.
+                        failed = fetch
+                        break
+                    if status < 500:
+                        if hedged and fetches[fetch] is hedge:
+                            self.__hedging.hedge_wins += 1
+                        if fetch is primary_fetch:
+                            # the delay is the percentile of the latency of a first request.
+                            self.__hedging.record((time.monotonic() - start) * 1000.0)
+                    return self.__hedged_answer(session, fetch)
+                for fetch in done:
+                    if fetch in answers:
+                        continue
+                    error = fetch.exception()
+                    self.__logger.warning("request to MNP server {} failed: {!r}", fetches[fetch], error,
+                                          extra={'session_key': session['session_key'], 'route': req.path,
+                                                 'upstream_host': fetches[fetch].host,
+                                                 'upstream_port': fetches[fetch].port})
+                if hedge is None and not deadline.expired():
+                    if len(done) == 0 and self.__hedging.can_hedge():
+                        # the first backend is slower than the hedge percentile.
+                        hedge = self.__mnps.pick(exclude=primary)
+                        hedged = hedge is not None
+                        if hedged:
+                            self.__hedging.hedged()
+                    elif isinstance(error, aiohttp.ClientConnectorError):
+                        # the request never reached the server, so it is safe to send it to another one.
+                        hedge = self.__mnps.pick(exclude=primary)
+                    if hedge is not None:
+                        fetch = asyncio.ensure_future(self.__fetch_from_mnp(hedge, session, req, headers, body,
+                                                                            deadline))
+                        fetches[fetch] = hedge
+                        pending.add(fetch)
+                    timeout = None
+        finally:
+            if not primary_fetch.done():
+                # the hedge won, or the client went away: what the first request took so far is a lower bound of
+                # its latency. Leaving it out would make the slow requests that hedging is for look rarer.
+                self.__hedging.record((time.monotonic() - start) * 1000.0)
+            for fetch in fetches:
+                if not fetch.done():
+                    fetch.cancel()
+                elif not fetch.cancelled():
+                    # marks the failure of a request that lost the race as seen.
+                    fetch.exception()
+        if failed is not None:
+            return self.__hedged_answer(session, failed)
+        if error is not None and deadline.caused(error):
+            return self.__deadline_exceeded(session, req)
+        status = 504 if isinstance(error, asyncio.TimeoutError) else 502
+        return web.json_response({'code': -1, 'description': 'MNP server failed!'}, status=status)
+
+    def __hedged_answer(self, session: web_session.Session, fetch: asyncio.Future) -> web.Response:
+        status, c_headers, data = fetch.result()
+        self.__remember_write(session, c_headers)
+        headers = self.__pass_headers(c_headers)
+        headers.popall('Content-Length', None)
+        return web.Response(body=data, status=status, headers=headers)
+
+    async def __transfer_mnp(self, session: web_session.Session, req: web.Request,
+                             deadline: Deadline) -> web.StreamResponse:
+        # e.g. spent waiting for the concurrency limiter.
+        if deadline.expired():
+            return self.__deadline_exceeded(session, req)
+        if self.__hedging is not None and req.path in self.HEDGED_PATHS:
+            return await self.__transfer_hedged(session, req, deadline)
+        mnp = self.__mnps.pick()
+        for attempt in range(2):
+            if attempt != 0 and deadline.expired():
+                return self.__deadline_exceeded(session, req)
+            if mnp is None:
+                self.__logger.warning('no available MNP server!',
+                                      extra={'session_key': session['session_key'], 'route': req.path})
+                return web.json_response({'code': -1, 'description': 'no available MNP server!'}, status=503)
+            try:
+                return await self.__send_to_mnp(mnp, session, req, deadline)
+            except aiohttp.ClientConnectorError as e:
+                self.__logger.warning("unable to connect to MNP server {}: {}", mnp, e,
+                                      extra={'session_key': session['session_key'], 'route': req.path,
+                                             'upstream_host': mnp.host, 'upstream_port': mnp.port})
+                # the request never reached the server, so it is safe to send it to another one.
+                mnp = self.__mnps.pick(exclude=mnp)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.__logger.warning("request to MNP server {} failed: {!r}", mnp, e,
+                                      extra={'session_key': session['session_key'], 'route': req.path,
+                                             'upstream_host': mnp.host, 'upstream_port': mnp.port})
+                if deadline.caused(e):
+                    return self.__deadline_exceeded(session, req)
+                status = 504 if isinstance(e, asyncio.TimeoutError) else 502
+                return web.json_response({'code': -1, 'description': 'MNP server failed!'}, status=status)
+        return web.json_response({'code': -1, 'description': 'MNP server is unavailable!'}, status=502)
+
+    async def __transfer_limited(self, session: web_session.Session, req: web.Request,
+                                 deadline: Deadline) -> web.StreamResponse:
+        if not await self.__limiter.acquire():
+            self.__logger.warning("MNP servers are overloaded, concurrency limit is {}", int(self.__limiter.limit),
+                                  extra={'session_key': session['session_key'], 'route': req.path})
+            return web.json_response({'code': -1, 'description': 'MNP servers are overloaded!'}, status=503)
+        start = time.monotonic()
+        duration_ms = None
+        ok = False
+        try:
+            resp = await self.__transfer_mnp(session, req, deadline)
+            if DEADLINE_EXCEEDED_HEADER not in resp.headers:
+                duration_ms = (time.monotonic() - start) * 1000.0
+                ok = resp.status < 500
+            return resp
+        finally:
+            # a request cancelled by a client disconnect or cut by its deadline says nothing about the MNP servers.
+            self.__limiter.release(duration_ms, ok)
+
+    async def __transfer(self, req: web.Request) -> web.StreamResponse:
+        deadline = Deadline.from_request(req, self.__deadline_ms)
         path = req.path.replace('/api/v1/', '', 1)
-        self.__logger.debug("{} request with path '{}' needs transfer...".format(req.method, path),
-                            extra={'session_key': "???"})
+        self.__logger.debug("{} request with path '{}' needs transfer...", req.method, path,
+                            extra={'session_key': "???", 'route': req.path})
         session = await web_session.get_session(req)
         if 'logged_in' not in session:
             self.__logger.warning('user is not logged in!',
@@ -137,12 +433,23 @@ class Balancer:
         path_parts = path.split('/')
         base = path_parts[0]
         if base == 'mnp':
-            return await self.__transfer_mnp(session, req)
+            if self.__limiter is None:
+                return await self.__transfer_mnp(session, req, deadline)
+            return await self.__transfer_limited(session, req, deadline)
         else:
             self.__logger.warning('could not transfer request!',
                                   extra={'session_key': session['session_key']})
             return web.json_response({'code': -1, 'description': 'could not transfer request!'}, status=400)
 
+    STATS_PATH = BASE_PATH + '/stats'
+
+    async def __get_stats(self, req: web.Request) -> web.Response:
+        return web.json_response({'code': 0, 'data': {
+            'limiter': self.__limiter.stats() if self.__limiter is not None else None,
+            'hedging': self.__hedging.stats() if self.__hedging is not None else None,
+            'mnps': self.__mnps.stats(),
+        }})
+
     LOGOUT_PATH = BASE_PATH + '/logout'
 
     async def __logout(self, req: web.Request) -> web.Response:
@@ -154,10 +461,11 @@ class Balancer:
             return web.json_response({'code': -1, 'description': 'user is not logged in!'}, status=401)
 
         login = session['login']
+        session_key = session['session_key']
         session.clear()
 
-        self.__logger.info("user '{}' successfully logged out".format(login),
-                           extra={'session_key': session['session_key']})
+        self.__logger.info("user '{}' successfully logged out", login,
+                           extra={'session_key': session_key})
 
         return web.json_response({'code': 0})
 
@@ -178,8 +486,29 @@ def main():
     cfg['server']['host'] = args.get('host', cfg['server']['host'])
     cfg['server']['port'] = args.get('port', cfg['server']['port'])
 
-    logger = get_logger(cfg, 'balancer')
-    balancer = Balancer(cfg, logger)
+    workers = cfg['server'].get('workers', 1)
+    if workers <= 1:
+        logger = LazyLogger(get_logger(cfg, 'balancer'))
+        balancer = Balancer(cfg, logger)
+        balancer.run()
+        return
+
+    session_cfg = cfg.setdefault('session', {})
+    if session_cfg.get('secret', '') == '':
+        # workers must accept each other's cookies, the kernel does not keep a client on one of them.
+        session_cfg['secret'] = secrets.token_hex(32)
+    ctx = multiprocessing.get_context('fork')
+    processes = [ctx.Process(target=run_worker, args=(cfg, worker_id)) for worker_id in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def run_worker(cfg: dict, worker_id: int):
+    # the logger is made in the worker, the threads of its handlers do not survive a fork.
+    logger = LazyLogger(get_logger(cfg, 'balancer'))
+    balancer = Balancer(cfg, logger, worker_id=worker_id)
     balancer.run()
 
 
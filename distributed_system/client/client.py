@@ -10,6 +10,7 @@ import aiohttp
 import requests
 import yaml
 
+from utils.lazy_logger import LazyLogger
 from utils.utils import parse_args_as_dict, create_arguments_parser, get_logger
 
 
@@ -285,11 +286,13 @@ class AutoClient(BaseClient):
 
         self.__url_base = 'http://{}:{}'.format(self.__server_host, self.__server_port)
 
+        self.__logs_cfg = {'logs': self.__cfg.get('logs', {'con': True})}
+
         self.__clients = [
             aiohttp.ClientSession('http://{}:{}'.format(self.__server_host, self.__server_port), loop=self.__loop)
             for __ in range(self.__count)]
 
-    async def __async_client(self, client: aiohttp.ClientSession, logger: logging.Logger):
+    async def __async_client(self, client: aiohttp.ClientSession, logger: LazyLogger):
         async def login(login: str, password: str):
             return await client.post(self.LOGIN_PATH, json={'login': login, 'password': password})
 
@@ -309,6 +312,14 @@ class AutoClient(BaseClient):
         async def logout():
             return await client.post(self.LOGOUT_PATH)
 
+        async def log_response(msg: str, resp: aiohttp.ClientResponse):
+            # the body is only decoded when the record is going to be emitted.
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(msg, await resp.json(),
+                            extra={'session_key': "???"})
+            else:
+                resp.release()
+
         def gen_login_and_password() -> (str, str):
             login_str = choice(self.LOGINS)
             return login_str, login_str
@@ -337,33 +348,29 @@ class AutoClient(BaseClient):
                 logger.info("requesting operator for phone number...",
                             extra={'session_key': "???"})
                 resp = await get_operator(gen_phone_number())
-                logger.info("got operator: {}".format(await resp.json()),
-                            extra={'session_key': "???"})
+                await log_response("got operator: {}", resp)
             elif v == 3:
                 logger.info("requesting latest mnp for phone number...",
                             extra={'session_key': "???"})
                 resp = await get_latest_mnp(gen_phone_number())
-                logger.info("got latest mnp: {}".format(await resp.json()),
-                            extra={'session_key': "???"})
+                await log_response("got latest mnp: {}", resp)
             elif v == 4:
                 logger.info("requesting mnp history for phone number...",
                             extra={'session_key': "???"})
                 resp = await get_mnp_history(gen_phone_number())
-                logger.info("got mnp history: {}".format(await resp.json()),
-                            extra={'session_key': "???"})
+                await log_response("got mnp history: {}", resp)
             elif v == 5:
                 logger.info("adding new mnp for phone number...",
                             extra={'session_key': "???"})
                 resp = await add_mnp(gen_phone_number(), gen_operator_name())
-                logger.info("added mnp: {}".format(await resp.json()),
-                            extra={'session_key': "???"})
+                await log_response("added mnp: {}", resp)
             await asyncio.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0)
 
     def run(self):
         tasks = []
         for i, client in enumerate(self.__clients):
             task = self.__loop.create_task(
-                coro=self.__async_client(client, get_logger({'logs': {'con': True}}, 'client-{}'.format(i))),
+                coro=self.__async_client(client, LazyLogger(get_logger(self.__logs_cfg, 'client-{}'.format(i)))),
                 name='client')
             tasks.append(task)
 
@@ -1,5 +1,6 @@
 import asyncio
-import logging
+import json
+import time
 from random import randint, choice
 from typing import Mapping, Any, List
 
@@ -7,7 +8,10 @@ import aiohttp
 import yaml
 from aiohttp import web
 
-from utils.utils import create_arguments_parser, parse_args_as_dict, get_logger
+from utils.deadline import Deadline
+from utils.lazy_logger import Deferred, LazyLogger
+from utils.utils import DEADLINE_EXCEEDED_HEADER, create_arguments_parser, parse_args_as_dict, get_logger, \
+    make_app_runner
 
 
 class DataBase:
@@ -24,10 +28,12 @@ class DataBase:
         app = web.Application()
         app.add_routes([
             web.post(self.EXEC_PATH, self.__exec),
+            web.get(self.STATUS_PATH, self.__status),
+            web.post(self.POSITION_PATH, self.__set_position),
         ])
         return app
 
-    def __init__(self, cfg: dict, logger: logging.Logger):
+    def __init__(self, cfg: dict, logger: LazyLogger):
         self.__loop = asyncio.new_event_loop()
 
         self.__cfg = cfg.copy()
@@ -38,7 +44,7 @@ class DataBase:
         self.__min_timeout_ms = self.__cfg['server']['min_timeout_ms']
         self.__max_timeout_ms = self.__cfg['server']['max_timeout_ms']
 
-        runner = web.AppRunner(self.__make_app())
+        runner = make_app_runner(self.__make_app())
         self.__loop.run_until_complete(runner.setup())
         site = web.TCPSite(runner, self.__host, self.__port)
         self.__loop.run_until_complete(site.start())
@@ -48,6 +54,12 @@ class DataBase:
             rep['host'], rep['port']), loop=self.__loop) for rep in self.__replicas]
         self.__cur_replica_ind = 0
 
+        self.__mode = self.__cfg['server'].get('mode', 'rw')
+        # position of the last write applied and the primary's time of it. The mock replicates nothing: a write
+        # moves the position of the database that took it, a replica's position is set through POSITION_PATH.
+        self.__position = 0
+        self.__position_ts = 0.0
+
         self.__storage = {}
 
     def run(self):
@@ -99,50 +111,103 @@ VALUES
     ($1, NOW(), $2);
 """
 
+    # set-based variants of the lookups above, $1 is an array of phone numbers.
+    GET_OPERATORS_STMT = """
+SELECT DISTINCT ON (mnp.phone_number)
+    mnp.phone_number, mnp.operator_name
+FROM
+    mnp_schema.mnp
+WHERE
+    (mnp.phone_number = ANY($1))
+ORDER BY
+    mnp.phone_number, mnp.ts DESC;
+"""
+
+    GET_LATEST_MNPS_STMT = """
+SELECT DISTINCT ON (mnp.phone_number)
+    mnp.phone_number, mnp.operator_name
+FROM
+    mnp_schema.mnp
+WHERE
+    (mnp.phone_number IN (
+        SELECT phone_number FROM mnp_schema.mnp WHERE (phone_number = ANY($1))
+        GROUP BY phone_number HAVING COUNT(*) > 1))
+ORDER BY
+    mnp.phone_number, mnp.ts DESC;
+"""
+
+    GET_MNP_HISTORIES_STMT = """
+SELECT
+    mnp.phone_number, mnp.operator_name
+FROM
+    mnp_schema.mnp
+WHERE
+    (mnp.phone_number = ANY($1))
+ORDER BY
+    mnp.phone_number, mnp.ts DESC;
+"""
+
+    BATCH_STMTS = (GET_OPERATORS_STMT, GET_LATEST_MNPS_STMT, GET_MNP_HISTORIES_STMT)
+
+    CHUNK_SIZE = 64 * 1024
+
     def __prepare_stmt(self, session_key: int, stmt: str, params: List[Any]):
-        self.__logger.debug("""preparing stmt "{}" with params {} """.format(str(stmt).replace('\n', '\\n'), params),
+        self.__logger.debug("""preparing stmt "{}" with params {} """,
+                            Deferred(lambda: stmt.replace('\n', '\\n')), params,
                             extra={'session_key': session_key})
-        self.__logger.debug("stmt has {} params".format(len(params)),
+        self.__logger.debug("stmt has {} params", len(params),
                             extra={'session_key': session_key})
         for i in range(len(params)):
             if type(params[i]) is str:
                 p = "'{}'".format(params[i].replace("'", "\\'"))
+            elif type(params[i]) is list:
+                p = "ARRAY[{}]".format(', '.join("'{}'".format(str(v).replace("'", "\\'")) for v in params[i]))
             else:
                 p = params[i]
-            self.__logger.debug("param ${} is being replaced by value {}...".format(i + 1, p),
+            self.__logger.debug("param ${} is being replaced by value {}...", i + 1, p,
                                 extra={'session_key': session_key})
             stmt = stmt.replace("$" + str(i + 1), p)
-            self.__logger.debug("param ${} replaced successfully".format(i + 1),
+            self.__logger.debug("param ${} replaced successfully", i + 1,
                                 extra={'session_key': session_key})
-        self.__logger.debug("""statement prepared successfully to "{}" """.format(str(stmt).replace('\n', '\\n')),
+        self.__logger.debug("""statement prepared successfully to "{}" """,
+                            Deferred(lambda: stmt.replace('\n', '\\n')),
                             extra={'session_key': session_key})
         return stmt
 
     def __gen_mnp_history(self):
         return [choice(self.OPERATORS) for __ in range(randint(1, 10))]
 
-    async def __exec(self, req: web.Request) -> web.Response:
+    async def __exec(self, req: web.Request) -> web.StreamResponse:
         self.__logger.info("got exec request",
-                           extra={'session_key': "???"})
+                           extra={'session_key': "???", 'route': req.path})
+        deadline = Deadline.from_request(req)
         try:
-            params: dict = await req.json()
-            session_key = params['session_key']
-            stmt: str = params['stmt']
-            params: List[Any] = params['params']
+            body: dict = await req.json()
+            session_key = body['session_key']
+            stmt: str = body['stmt']
+            params: List[Any] = body['params']
         except (ValueError, KeyError) as e:
             self.__logger.warning("unable to parse request!",
                                   extra={'session_key': "???"})
             return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
 
-        self.__logger.debug("exec request params: {}".format(str(await req.json()).replace('\n', '\\n')),
-                            extra={'session_key': session_key})
+        self.__logger.debug("exec request params: {}", Deferred(lambda: str(body).replace('\n', '\\n')),
+                            extra={'session_key': session_key, 'route': req.path})
 
-        await asyncio.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0)
+        if not await deadline.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0):
+            return self.__deadline_exceeded(req, session_key)
 
         __ = self.__prepare_stmt(session_key, stmt, params)
 
-        await asyncio.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0)
+        if not await deadline.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0):
+            return self.__deadline_exceeded(req, session_key)
 
+        if stmt in self.BATCH_STMTS:
+            if len(params) != 1 or type(params[0]) is not list:
+                self.__logger.warning("batch statement needs one array param!",
+                                      extra={'session_key': session_key})
+                return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
+            return await self.__exec_batch(req, session_key, stmt, params[0], deadline)
         if stmt.startswith('\nSELECT'):
             phone_number = params[0]
             if phone_number not in self.__storage:
@@ -165,12 +230,89 @@ VALUES
                 res = self.__storage[phone_number]
                 res.append(params[1])
                 self.__storage[phone_number] = res
-                return web.json_response({'code': 0})
+                self.__position += 1
+                self.__position_ts = time.time()
+                return web.json_response({'code': 0, 'position': self.__position})
 
         self.__logger.warning("unable to parse request!",
                               extra={'session_key': session_key})
         return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
 
+    def __deadline_exceeded(self, req: web.Request, session_key: int) -> web.Response:
+        # the caller has given up on the statement, it is not run to the end.
+        self.__logger.warning("deadline exceeded, statement abandoned!",
+                              extra={'session_key': session_key, 'route': req.path})
+        return web.json_response({'code': -1, 'description': 'deadline exceeded!'}, status=504,
+                                 headers={DEADLINE_EXCEEDED_HEADER: '1'})
+
+    def __lookup(self, stmt: str, phone_number: str) -> Any:
+        if phone_number not in self.__storage:
+            self.__storage[phone_number] = self.__gen_mnp_history()
+        res = self.__storage[phone_number]
+        if stmt == self.GET_OPERATORS_STMT:
+            return res[-1]
+        elif stmt == self.GET_LATEST_MNPS_STMT:
+            return res[-1] if len(res) > 1 else None
+        return res
+
+    async def __exec_batch(self, req: web.Request, session_key: int, stmt: str, phone_numbers: List[str],
+                           deadline: Deadline) -> web.StreamResponse:
+        resp = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        resp.enable_chunked_encoding()
+        await resp.prepare(req)
+
+        # one line per distinct number, sent as soon as a chunk is full; the trailing line carries the count.
+        chunk, chunk_size = [], 0
+        count = 0
+        for phone_number in dict.fromkeys(phone_numbers):
+            line = json.dumps({'phone_number': phone_number, 'data': self.__lookup(stmt, phone_number)},
+                              ensure_ascii=False).encode('utf-8')
+            chunk.append(line)
+            chunk_size += len(line)
+            count += 1
+            if chunk_size >= self.CHUNK_SIZE:
+                if deadline.expired():
+                    # the status is already sent; the missing trailing line tells the caller the answer is cut.
+                    self.__logger.warning("deadline exceeded after {} numbers, batch abandoned!", count,
+                                          extra={'session_key': session_key, 'route': req.path})
+                    resp.force_close()
+                    return resp
+                await resp.write(b'\n'.join(chunk) + b'\n')
+                chunk, chunk_size = [], 0
+        chunk.append(json.dumps({'code': 0, 'count': count}).encode('utf-8'))
+        await resp.write(b'\n'.join(chunk) + b'\n')
+        await resp.write_eof()
+        return resp
+
+    STATUS_PATH = BASE_PATH + '/status'
+
+    async def __status(self, req: web.Request) -> web.Response:
+        return web.json_response({'code': 0, 'data': {
+            'mode': self.__mode,
+            'position': self.__position,
+            'position_ts': self.__position_ts,
+        }})
+
+    POSITION_PATH = BASE_PATH + '/position'
+
+    async def __set_position(self, req: web.Request) -> web.Response:
+        try:
+            body: dict = await req.json()
+            position: int = body['position']
+            position_ts: float = body.get('position_ts', time.time())
+            if type(position) is not int or not isinstance(position_ts, (int, float)):
+                raise ValueError('position must be an int, position_ts a number')
+        except (ValueError, KeyError) as e:
+            self.__logger.warning("unable to parse request!",
+                                  extra={'session_key': "???"})
+            return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
+
+        self.__logger.info("write position set to {}", position,
+                           extra={'session_key': "???", 'route': req.path})
+        self.__position = position
+        self.__position_ts = position_ts
+        return web.json_response({'code': 0})
+
 
 desc_str = """DataBase mock."""
 
@@ -188,7 +330,7 @@ def main():
     cfg['server']['host'] = args.get('host', cfg['server']['host'])
     cfg['server']['port'] = args.get('port', cfg['server']['port'])
 
-    logger = get_logger(cfg, 'database')
+    logger = LazyLogger(get_logger(cfg, 'database'))
     db = DataBase(cfg, logger)
     db.run()
 
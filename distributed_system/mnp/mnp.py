@@ -1,13 +1,20 @@
 import asyncio
-import logging
+import json
 from random import randint
-from typing import Mapping, Any, List
+from typing import Mapping, Any, List, Optional, Tuple
 
 import aiohttp
 import yaml
 from aiohttp import web
 
-from utils.utils import create_arguments_parser, parse_args_as_dict, get_logger
+from utils.backend_pool import Backend
+from utils.deadline import Deadline
+from utils.lazy_logger import LazyLogger
+from utils.micro_batcher import MicroBatcher
+from utils.read_through_cache import ReadThroughCache
+from utils.replica_router import ReplicaRouter
+from utils.utils import DEADLINE_EXCEEDED_HEADER, DEADLINE_HEADER, SESSION_KEY_HEADER, WRITE_POSITION_HEADER, \
+    create_arguments_parser, parse_args_as_dict, get_logger, make_app_runner
 
 
 class MNP:
@@ -18,10 +25,15 @@ class MNP:
             web.post(self.GET_LATEST_MNP_PATH, self.__get_latest_mnp),
             web.post(self.GET_MNP_HISTORY_PATH, self.__get_mnp_history),
             web.post(self.ADD_MNP_PATH, self.__add_mnp),
+            web.post(self.GET_OPERATORS_PATH, self.__get_operators),
+            web.post(self.GET_LATEST_MNPS_PATH, self.__get_latest_mnps),
+            web.post(self.GET_MNP_HISTORIES_PATH, self.__get_mnp_histories),
+            web.get(self.HEALTH_PATH, self.__health),
+            web.get(self.STATS_PATH, self.__get_stats),
         ])
         return app
 
-    def __init__(self, cfg: dict, logger: logging.Logger):
+    def __init__(self, cfg: dict, logger: LazyLogger):
         self.__loop = asyncio.new_event_loop()
 
         self.__cfg = cfg.copy()
@@ -31,41 +43,162 @@ class MNP:
 
         self.__min_timeout_ms = self.__cfg['server']['min_timeout_ms']
         self.__max_timeout_ms = self.__cfg['server']['max_timeout_ms']
+        self.__max_batch_size = self.__cfg['server'].get('max_batch_size', 10000)
 
-        runner = web.AppRunner(self.__make_app())
+        runner = make_app_runner(self.__make_app())
         self.__loop.run_until_complete(runner.setup())
         site = web.TCPSite(runner, self.__host, self.__port)
         self.__loop.run_until_complete(site.start())
 
         self.__rw_database: Mapping[str, Any] = self.__cfg['rw_database']
-        self.__rw_database_client = aiohttp.ClientSession('http://{}:{}'.format(
-            self.__rw_database['host'], self.__rw_database['port']), loop=self.__loop)
-
         self.__ro_databases: List[Mapping[str, Any]] = self.__cfg['ro_databases']
-        self.__ro_databases_clients = [aiohttp.ClientSession('http://{}:{}'.format(
-            db['host'], db['port']), loop=self.__loop) for db in self.__ro_databases]
-        self.__cur_ro_database_ind = 0
+        self.__routing_cfg = self.__cfg.get('replica_routing', {})
+        self.__router = ReplicaRouter.from_config(self.__routing_cfg, self.__rw_database, self.__ro_databases,
+                                                  self.__loop)
+        self.__loop.create_task(self.__watch_databases())
+
+        batching_cfg = self.__cfg.get('batching')
+        self.__batcher = MicroBatcher.from_config(batching_cfg, self.__dispatch_batch) \
+            if batching_cfg is not None else None
 
-        self.__ro_databases.append(self.__rw_database)
-        self.__ro_databases_clients.append(self.__rw_database_client)
+        cache_cfg = self.__cfg.get('cache')
+        self.__cache = ReadThroughCache.from_config(cache_cfg, self.__sizeof_answer) if cache_cfg is not None else None
 
     def run(self):
         self.__loop.run_forever()
 
-    def get_ro_db(self) -> (aiohttp.ClientSession, Mapping[str, Any]):
-        cur_ro_database_ind = self.__cur_ro_database_ind
-        self.__cur_ro_database_ind = (self.__cur_ro_database_ind + 1) % len(self.__ro_databases_clients)
-        client = self.__ro_databases_clients[cur_ro_database_ind]
-        cfg = self.__ro_databases[cur_ro_database_ind]
-        return client, cfg
-
     BASE_PATH = '/api/v1'
 
+    HEALTH_PATH = BASE_PATH + '/health'
+
+    async def __health(self, req: web.Request) -> web.Response:
+        return web.json_response({'code': 0})
+
     EXEC_PATH = BASE_PATH + '/exec'
 
-    async def __to_db(self, client: aiohttp.ClientSession, session_key: int, stmt: str,
-                      params: List[Any]) -> aiohttp.ClientResponse:
-        return await client.post(self.EXEC_PATH, json={'session_key': session_key, 'stmt': stmt, 'params': params})
+    async def __to_db(self, client: aiohttp.ClientSession, session_key: int, stmt: str, params: List[Any],
+                      deadline: Deadline) -> aiohttp.ClientResponse:
+        # the database gets what is left of the caller's deadline, and is not waited for any longer.
+        header = deadline.header()
+        return await client.post(self.EXEC_PATH, json={'session_key': session_key, 'stmt': stmt, 'params': params},
+                                 headers={DEADLINE_HEADER: header} if header is not None else None,
+                                 timeout=deadline.client_timeout(client.timeout.total))
+
+    async def __to_ro_db(self, session_key: int, stmt: str, params: List[Any], min_position: int, deadline: Deadline,
+                         route: Optional[str] = None) -> (int, bytes, str):
+        """Runs a read on the database the router picks, one that has applied the write at `min_position`.
+
+        Raises asyncio.TimeoutError when the deadline runs out, here or in the database.
+        """
+        db = self.__router.pick_read(min_position)
+        self.__logger.debug("sending request to database {}...", db,
+                            extra={'session_key': session_key, 'route': route,
+                                   'upstream_host': db.host, 'upstream_port': db.port})
+        start = db.start()
+        try:
+            db_resp = await self.__to_db(db.client, session_key, stmt, params, deadline)
+            body = await db_resp.read()
+        except asyncio.CancelledError:
+            db.cancel(start)
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.__finish_failed(db, start, deadline, e)
+            raise
+        if DEADLINE_EXCEEDED_HEADER in db_resp.headers:
+            db.cancel(start)
+            raise asyncio.TimeoutError()
+        duration_ms = db.finish(start, ok=db_resp.status < 500)
+        self.__logger.debug("got response from database",
+                            extra={'session_key': session_key, 'route': route,
+                                   'upstream_host': db.host, 'upstream_port': db.port, 'duration_ms': duration_ms})
+        return db_resp.status, body, db_resp.content_type
+
+    @staticmethod
+    def __finish_failed(db: Backend, start: float, deadline: Deadline, e: BaseException) -> None:
+        # a call cut by the caller's deadline says nothing about the database.
+        if deadline.caused(e):
+            db.cancel(start)
+        else:
+            db.finish(start, ok=False)
+
+    def __min_position(self, req: web.Request, session_key: int, phone_numbers: List[Any]) -> int:
+        # a session reads its own writes, made through any MNP as the balancer tells, and anyone reads the writes
+        # to a number made through this MNP.
+        return max(self.__write_position(req),
+                   self.__router.required_position(('session', session_key),
+                                                   *(('number', n) for n in phone_numbers if isinstance(n, str))))
+
+    @staticmethod
+    def __write_position(req: web.Request) -> int:
+        try:
+            return max(0, int(req.headers.get(WRITE_POSITION_HEADER, 0)))
+        except ValueError:
+            return 0
+
+    DB_STATUS_PATH = BASE_PATH + '/status'
+
+    async def __watch_databases(self):
+        interval_s = self.__routing_cfg.get('refresh_interval_ms', 500) / 1000.0
+        timeout_ms = self.__routing_cfg.get('refresh_timeout_ms', 200)
+        while True:
+            await self.__router.refresh(self.DB_STATUS_PATH, timeout_ms)
+            await asyncio.sleep(interval_s)
+
+    @staticmethod
+    def __session_key(req: web.Request, params: dict) -> int:
+        # the balancer passes the session key in a header, the body field is kept for direct callers.
+        header = req.headers.get(SESSION_KEY_HEADER)
+        return int(header) if header is not None else params['session_key']
+
+    async def __read(self, req: web.Request, session_key: int, phone_number: str, stmt: str,
+                     deadline: Deadline) -> web.Response:
+        min_position = self.__min_position(req, session_key, [phone_number])
+
+        # a fetch shared by the concurrent misses of the cache runs for all of them: no deadline of one caller cuts
+        # it, each caller waits for it until its own deadline, and it is cancelled once none of them waits.
+        shared = self.__cache is not None and isinstance(phone_number, str)
+        fetch_deadline = Deadline() if shared else deadline
+
+        async def fetch() -> (int, bytes, str):
+            if self.__batcher is not None and stmt in self.BATCHED_STMTS and isinstance(phone_number, str):
+                # the batch runs until the latest deadline of its lookups, this one waits for it until its own.
+                return await asyncio.wait_for(
+                    self.__batcher.load(self.BATCHED_STMTS[stmt], phone_number,
+                                        (session_key, min_position, fetch_deadline)),
+                    fetch_deadline.remaining_s())
+            # the database call is cut at the deadline itself.
+            return await self.__to_ro_db(session_key, stmt, [phone_number], min_position, fetch_deadline, req.path)
+
+        try:
+            if shared:
+                # an answer cached before the writes this read must see is not served, the position is its version.
+                status, body, content_type = await asyncio.wait_for(
+                    self.__cache.get(phone_number, stmt, fetch, min_position), deadline.remaining_s())
+            else:
+                status, body, content_type = await fetch()
+        except asyncio.TimeoutError:
+            return self.__deadline_exceeded(req, session_key)
+        return web.Response(body=body, status=status, content_type=content_type)
+
+    def __deadline_exceeded(self, req: web.Request, session_key: int) -> web.Response:
+        self.__logger.warning("deadline exceeded, request abandoned!",
+                              extra={'session_key': session_key, 'route': req.path})
+        return web.json_response({'code': -1, 'description': 'deadline exceeded!'}, status=504,
+                                 headers={DEADLINE_EXCEEDED_HEADER: '1'})
+
+    @staticmethod
+    def __sizeof_answer(answer: (int, bytes, str)) -> Optional[int]:
+        status, body, __ = answer
+        return len(body) if status == 200 else None
+
+    STATS_PATH = BASE_PATH + '/stats'
+
+    async def __get_stats(self, req: web.Request) -> web.Response:
+        return web.json_response({'code': 0, 'data': {
+            'cache': self.__cache.stats() if self.__cache is not None else None,
+            'batching': self.__batcher.stats() if self.__batcher is not None else None,
+            'replica_routing': self.__router.stats(),
+        }})
 
     MNP_PATH = BASE_PATH + '/mnp'
 
@@ -85,31 +218,24 @@ LIMIT 1;
 
     async def __get_operator(self, req: web.Request) -> web.Response:
         self.__logger.info("got get_operator request",
-                           extra={'session_key': "???"})
+                           extra={'session_key': "???", 'route': req.path})
+        deadline = Deadline.from_request(req)
         try:
             params: dict = await req.json()
             phone_number: str = params['phone_number']
-            session_key: str = params['session_key']
+            session_key: str = self.__session_key(req, params)
         except (ValueError, KeyError) as e:
             self.__logger.warning("unable to parse request!",
                                   extra={'session_key': "???"})
             return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
 
-        self.__logger.debug("get_operator request params: {}".format(params),
-                            extra={'session_key': session_key})
-
-        await asyncio.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0)
-
-        client, cfg = self.get_ro_db()
-        self.__logger.debug("sending request to database {}:{}...".format(cfg['host'], cfg['port']),
-                            extra={'session_key': session_key})
-        db_resp = await self.__to_db(client, session_key, self.GET_OPERATOR_STMT, [phone_number])
-        self.__logger.debug("got response from database",
-                            extra={'session_key': session_key})
+        self.__logger.debug("get_operator request params: {}", params,
+                            extra={'session_key': session_key, 'route': req.path})
 
-        print(await db_resp.json())
+        if not await deadline.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0):
+            return self.__deadline_exceeded(req, session_key)
 
-        return web.json_response(await db_resp.json(), status=db_resp.status)
+        return await self.__read(req, session_key, phone_number, self.GET_OPERATOR_STMT, deadline)
 
     GET_LATEST_MNP_PATH = MNP_PATH + '/get_latest_mnp'
 
@@ -127,29 +253,24 @@ LIMIT 1;
 
     async def __get_latest_mnp(self, req: web.Request) -> web.Response:
         self.__logger.info("got get_latest_mnp request",
-                           extra={'session_key': "???"})
+                           extra={'session_key': "???", 'route': req.path})
+        deadline = Deadline.from_request(req)
         try:
             params: dict = await req.json()
             phone_number: str = params['phone_number']
-            session_key: str = params['session_key']
+            session_key: str = self.__session_key(req, params)
         except (ValueError, KeyError) as e:
             self.__logger.warning("unable to parse request!",
                                   extra={'session_key': "???"})
             return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
 
-        self.__logger.debug("get_latest_mnp request params: {}".format(params),
-                            extra={'session_key': session_key})
+        self.__logger.debug("get_latest_mnp request params: {}", params,
+                            extra={'session_key': session_key, 'route': req.path})
 
-        await asyncio.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0)
+        if not await deadline.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0):
+            return self.__deadline_exceeded(req, session_key)
 
-        client, cfg = self.get_ro_db()
-        self.__logger.debug("sending request to database {}:{}...".format(cfg['host'], cfg['port']),
-                            extra={'session_key': session_key})
-        db_resp = await self.__to_db(client, session_key, self.GET_LATEST_MNP_STMT, [phone_number])
-        self.__logger.debug("got response from database",
-                            extra={'session_key': session_key})
-
-        return web.json_response(await db_resp.json(), status=db_resp.status)
+        return await self.__read(req, session_key, phone_number, self.GET_LATEST_MNP_STMT, deadline)
 
     GET_MNP_HISTORY_PATH = MNP_PATH + '/get_mnp_history'
 
@@ -166,29 +287,24 @@ ORDER BY
 
     async def __get_mnp_history(self, req: web.Request) -> web.Response:
         self.__logger.info("got get_mnp_history request",
-                           extra={'session_key': "???"})
+                           extra={'session_key': "???", 'route': req.path})
+        deadline = Deadline.from_request(req)
         try:
             params: dict = await req.json()
             phone_number: str = params['phone_number']
-            session_key: str = params['session_key']
+            session_key: str = self.__session_key(req, params)
         except (ValueError, KeyError) as e:
             self.__logger.warning("unable to parse request!",
                                   extra={'session_key': "???"})
             return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
 
-        self.__logger.debug("get_mnp_history request params: {}".format(params),
-                            extra={'session_key': session_key})
-
-        await asyncio.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0)
+        self.__logger.debug("get_mnp_history request params: {}", params,
+                            extra={'session_key': session_key, 'route': req.path})
 
-        client, cfg = self.get_ro_db()
-        self.__logger.debug("sending request to database {}:{}...".format(cfg['host'], cfg['port']),
-                            extra={'session_key': session_key})
-        db_resp = await self.__to_db(client, session_key, self.GET_MNP_HISTORY_STMT, [phone_number])
-        self.__logger.debug("got response from database",
-                            extra={'session_key': session_key})
+        if not await deadline.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0):
+            return self.__deadline_exceeded(req, session_key)
 
-        return web.json_response(await db_resp.json(), status=db_resp.status)
+        return await self.__read(req, session_key, phone_number, self.GET_MNP_HISTORY_STMT, deadline)
 
     ADD_MNP_PATH = MNP_PATH + '/add_mnp'
 
@@ -201,30 +317,219 @@ VALUES
 
     async def __add_mnp(self, req: web.Request) -> web.Response:
         self.__logger.info("got add_mnp request",
-                           extra={'session_key': "???"})
+                           extra={'session_key': "???", 'route': req.path})
+        deadline = Deadline.from_request(req)
         try:
             params: dict = await req.json()
             phone_number: str = params['phone_number']
             operator_name: str = params['operator_name']
-            session_key: str = params['session_key']
+            session_key: str = self.__session_key(req, params)
         except (ValueError, KeyError) as e:
             self.__logger.warning("unable to parse request!",
                                   extra={'session_key': "???"})
             return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
 
-        self.__logger.debug("add_mnp request params: {}".format(params),
-                            extra={'session_key': session_key})
+        self.__logger.debug("add_mnp request params: {}", params,
+                            extra={'session_key': session_key, 'route': req.path})
 
-        await asyncio.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0)
+        if not await deadline.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0):
+            return self.__deadline_exceeded(req, session_key)
 
-        client, cfg = self.__rw_database_client, self.__rw_database
-        self.__logger.debug("sending request to database {}:{}...".format(cfg['host'], cfg['port']),
-                            extra={'session_key': session_key})
-        db_resp = await self.__to_db(client, session_key, self.ADD_MNP_STMT, [phone_number, operator_name])
+        db = self.__router.primary
+        self.__logger.debug("sending request to database {}...", db,
+                            extra={'session_key': session_key, 'route': req.path,
+                                   'upstream_host': db.host, 'upstream_port': db.port})
+        # writes load the primary too, reads take that into account.
+        start = db.start()
+        try:
+            db_resp = await self.__to_db(db.client, session_key, self.ADD_MNP_STMT, [phone_number, operator_name],
+                                         deadline)
+            body = await db_resp.read()
+        except asyncio.CancelledError:
+            db.cancel(start)
+            raise
+        except asyncio.TimeoutError as e:
+            # the write may still be applied, the caller cannot tell; it is not retried here.
+            self.__finish_failed(db, start, deadline, e)
+            if self.__cache is not None and isinstance(phone_number, str):
+                self.__cache.invalidate(phone_number)
+            return self.__deadline_exceeded(req, session_key)
+        except aiohttp.ClientError:
+            db.finish(start, ok=False)
+            raise
+        if DEADLINE_EXCEEDED_HEADER in db_resp.headers:
+            # the database gave up before the write.
+            db.cancel(start)
+            return self.__deadline_exceeded(req, session_key)
+        duration_ms = db.finish(start, ok=db_resp.status < 500)
         self.__logger.debug("got response from database",
-                            extra={'session_key': session_key})
+                            extra={'session_key': session_key, 'route': req.path,
+                                   'upstream_host': db.host, 'upstream_port': db.port, 'duration_ms': duration_ms})
+        headers = None
+        if db_resp.status == 200 and isinstance(phone_number, str):
+            # reads of the session and of the number go where the write is applied already.
+            position = json.loads(body)['position']
+            self.__router.written(position, ('session', session_key), ('number', phone_number))
+            # the next request of the session may go to another MNP server, the balancer brings the position along.
+            headers = {WRITE_POSITION_HEADER: str(position)}
+        # whatever the outcome, the cached answers about the number may be outdated now.
+        if self.__cache is not None and isinstance(phone_number, str):
+            self.__cache.invalidate(phone_number)
+
+        return web.Response(body=body, status=db_resp.status, content_type=db_resp.content_type, headers=headers)
+
+    # set-based lookups for many numbers at once, answered as ndjson: one line per distinct number and a
+    # trailing {"code": 0, "count": n}. They are not cached, a batch is one statement anyway.
+    GET_OPERATORS_PATH = MNP_PATH + '/get_operators'
+
+    GET_OPERATORS_STMT = """
+SELECT DISTINCT ON (mnp.phone_number)
+    mnp.phone_number, mnp.operator_name
+FROM
+    mnp_schema.mnp
+WHERE
+    (mnp.phone_number = ANY($1))
+ORDER BY
+    mnp.phone_number, mnp.ts DESC;
+"""
+
+    async def __get_operators(self, req: web.Request) -> web.StreamResponse:
+        return await self.__batch(req, 'get_operators', self.GET_OPERATORS_STMT)
+
+    GET_LATEST_MNPS_PATH = MNP_PATH + '/get_latest_mnps'
 
-        return web.json_response(await db_resp.json(), status=db_resp.status)
+    GET_LATEST_MNPS_STMT = """
+SELECT DISTINCT ON (mnp.phone_number)
+    mnp.phone_number, mnp.operator_name
+FROM
+    mnp_schema.mnp
+WHERE
+    (mnp.phone_number IN (
+        SELECT phone_number FROM mnp_schema.mnp WHERE (phone_number = ANY($1))
+        GROUP BY phone_number HAVING COUNT(*) > 1))
+ORDER BY
+    mnp.phone_number, mnp.ts DESC;
+"""
+
+    async def __get_latest_mnps(self, req: web.Request) -> web.StreamResponse:
+        return await self.__batch(req, 'get_latest_mnps', self.GET_LATEST_MNPS_STMT)
+
+    GET_MNP_HISTORIES_PATH = MNP_PATH + '/get_mnp_histories'
+
+    GET_MNP_HISTORIES_STMT = """
+SELECT
+    mnp.phone_number, mnp.operator_name
+FROM
+    mnp_schema.mnp
+WHERE
+    (mnp.phone_number = ANY($1))
+ORDER BY
+    mnp.phone_number, mnp.ts DESC;
+"""
+
+    async def __get_mnp_histories(self, req: web.Request) -> web.StreamResponse:
+        return await self.__batch(req, 'get_mnp_histories', self.GET_MNP_HISTORIES_STMT)
+
+    async def __batch(self, req: web.Request, name: str, stmt: str) -> web.StreamResponse:
+        self.__logger.info("got {} request", name,
+                           extra={'session_key': "???", 'route': req.path})
+        deadline = Deadline.from_request(req)
+        try:
+            params: dict = await req.json()
+            phone_numbers: List[str] = params['phone_numbers']
+            session_key: str = self.__session_key(req, params)
+            if type(phone_numbers) is not list or not all(type(n) is str for n in phone_numbers):
+                raise ValueError('phone_numbers must be a list of strings')
+        except (ValueError, KeyError) as e:
+            self.__logger.warning("unable to parse request!",
+                                  extra={'session_key': "???"})
+            return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
+        if len(phone_numbers) > self.__max_batch_size:
+            self.__logger.warning("{} request for {} numbers is over the limit of {}!", name, len(phone_numbers),
+                                  self.__max_batch_size,
+                                  extra={'session_key': session_key, 'route': req.path})
+            return web.json_response({'code': -1, 'description': 'too many phone numbers!'}, status=413)
+
+        self.__logger.debug("{} request for {} numbers", name, len(phone_numbers),
+                            extra={'session_key': session_key, 'route': req.path})
+
+        if not await deadline.sleep(randint(self.__min_timeout_ms, self.__max_timeout_ms) / 1000.0):
+            return self.__deadline_exceeded(req, session_key)
+
+        db = self.__router.pick_read(self.__min_position(req, session_key, phone_numbers))
+        self.__logger.debug("sending request to database {}...", db,
+                            extra={'session_key': session_key, 'route': req.path,
+                                   'upstream_host': db.host, 'upstream_port': db.port})
+        start = db.start()
+        try:
+            db_resp = await self.__to_db(db.client, session_key, stmt, [phone_numbers], deadline)
+        except asyncio.CancelledError:
+            db.cancel(start)
+            raise
+        except asyncio.TimeoutError as e:
+            self.__finish_failed(db, start, deadline, e)
+            return self.__deadline_exceeded(req, session_key)
+        except aiohttp.ClientError:
+            db.finish(start, ok=False)
+            raise
+        if DEADLINE_EXCEEDED_HEADER in db_resp.headers:
+            db_resp.release()
+            db.cancel(start)
+            return self.__deadline_exceeded(req, session_key)
+        try:
+            # lines are passed on as the database sends them.
+            resp = web.StreamResponse(status=db_resp.status,
+                                      headers={'Content-Type': db_resp.headers.get('Content-Type',
+                                                                                   'application/json')})
+            await resp.prepare(req)
+            async for chunk in db_resp.content.iter_any():
+                await resp.write(chunk)
+            await resp.write_eof()
+        except BaseException:
+            db.cancel(start)
+            raise
+        finally:
+            db_resp.release()
+        duration_ms = db.finish(start, ok=db_resp.status < 500)
+        self.__logger.debug("got response from database",
+                            extra={'session_key': session_key, 'route': req.path,
+                                   'upstream_host': db.host, 'upstream_port': db.port, 'duration_ms': duration_ms})
+        return resp
+
+    # the batch statement that answers a single lookup for many numbers at once.
+    BATCHED_STMTS = {
+        GET_OPERATOR_STMT: GET_OPERATORS_STMT,
+        GET_LATEST_MNP_STMT: GET_LATEST_MNPS_STMT,
+        GET_MNP_HISTORY_STMT: GET_MNP_HISTORIES_STMT,
+    }
+
+    async def __dispatch_batch(self, stmt: str, phone_numbers: List[str],
+                               tags: List[Tuple[int, int, Deadline]]) -> Mapping[str, Tuple[int, bytes, str]]:
+        """Sends the concurrent single lookups of a MicroBatcher as one batch; answers are single lookup ones.
+
+        Tags are (session key, min position, deadline) of the lookups, the batch goes to a database that satisfies
+        all of them and runs as long as one of them still waits.
+        """
+        session_keys = [session_key for session_key, __, __ in tags]
+        # the database logs the batch under the first session, the others are listed here.
+        self.__logger.debug("batch of {} lookups of sessions {}", len(phone_numbers), session_keys,
+                            extra={'session_key': session_keys[0]})
+        status, body, content_type = await self.__to_ro_db(session_keys[0], stmt, [phone_numbers],
+                                                           max(min_position for __, min_position, __ in tags),
+                                                           Deadline.latest(*(deadline for __, __, deadline in tags)))
+        if status != 200:
+            answer = (status, body, content_type)
+            return {phone_number: answer for phone_number in phone_numbers}
+
+        answers = {}
+        for line in body.splitlines():
+            row = json.loads(line)
+            if 'phone_number' in row:
+                answers[row['phone_number']] = (200, json.dumps({'data': row['data'], 'code': 0}).encode('utf-8'),
+                                                'application/json')
+        # numbers without rows (e.g. never ported ones for get_latest_mnp) get no line.
+        none = (200, json.dumps({'data': None, 'code': 0}).encode('utf-8'), 'application/json')
+        return {phone_number: answers.get(phone_number, none) for phone_number in phone_numbers}
 
 
 desc_str = """MNP server."""
@@ -243,7 +548,7 @@ def main():
     cfg['server']['host'] = args.get('host', cfg['server']['host'])
     cfg['server']['port'] = args.get('port', cfg['server']['port'])
 
-    logger = get_logger(cfg, 'mnp')
+    logger = LazyLogger(get_logger(cfg, 'mnp'))
     mnp = MNP(cfg, logger)
     mnp.run()
 
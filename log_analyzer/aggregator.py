@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from typing import Any, Dict, List, Mapping, Tuple
+
+from aiohttp import web
+
+from log_analyzer.anomaly_detector import AnomalyDetector
+from log_analyzer.log_storage import LogStorage
+from log_analyzer.session_tracer import SessionTracer
+from log_analyzer.template_miner import TemplateMiner
+
+
+class Aggregator:
+    """Merge layer of a multi-worker LogAnalyzer.
+
+    Workers periodically push closed detector buckets and session events into `channel`. The aggregator
+    maps worker-local template ids to global ones (and tells the workers about them), merges the buckets
+    of all workers and evaluates them with its own AnomalyDetector, and stitches sessions across workers.
+    Alerts and sessions are served on the aggregator port.
+    """
+
+    MSG_BUCKET = 'bucket'
+    MSG_SESSIONS = 'sessions'
+
+    # a bucket is evaluated without a stalled (e.g. crashed) worker once this many newer buckets are pending.
+    MAX_PENDING_BUCKETS = 3
+
+    def __make_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+            web.get(self.ALERTS_PATH, self.__get_alerts),
+            web.get(self.SESSION_PATH, self.__get_session),
+        ])
+        return app
+
+    def __init__(self, cfg: dict, logger: logging.Logger, channel: multiprocessing.Queue,
+                 replies: List[multiprocessing.Queue]):
+        self.__loop = asyncio.new_event_loop()
+
+        self.__cfg = cfg.copy()
+        self.__logger = logger
+        self.__host = self.__cfg['server'].get('aggregator_host', self.__cfg['server']['host'])
+        self.__port = self.__cfg['server']['aggregator_port']
+        self.__channel = channel
+        self.__replies = replies
+        self.__workers = len(replies)
+
+        storage_cfg = self.__cfg.get('storage', {})
+        path = storage_cfg.get('path', './storage')
+        os.makedirs(path, exist_ok=True)
+        self.__flush_interval_ms = storage_cfg.get('flush_interval_ms', 1000)
+
+        self.__template_miner = TemplateMiner.from_config(self.__cfg.get('templates', {}))
+        self.__templates_path = os.path.join(path, 'templates.json')
+        self.__template_miner.load(self.__templates_path)
+        # (worker, local template id) -> global template id
+        self.__global_ids: Dict[Tuple[int, int], int] = {}
+
+        self.__detector = AnomalyDetector.from_config(self.__cfg.get('detector', {}))
+        self.__pending: Dict[int, Dict[int, Mapping[str, Any]]] = {}
+        self.__next_bucket = None
+
+        self.__sessions_storage = LogStorage.from_config(storage_cfg, os.path.join(path, 'sessions'))
+        self.__session_tracer = SessionTracer.from_config(self.__cfg.get('sessions', {}),
+                                                          self.__sessions_storage.append)
+
+        self.__loop.create_task(self.__receive())
+        self.__loop.create_task(self.__maintain())
+
+        runner = web.AppRunner(self.__make_app())
+        self.__loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, self.__host, self.__port)
+        self.__loop.run_until_complete(site.start())
+
+    def run(self):
+        try:
+            self.__loop.run_forever()
+        finally:
+            self.__session_tracer.flush_all()
+            self.__sessions_storage.close()
+            self.__template_miner.save(self.__templates_path)
+
+    async def __receive(self):
+        while True:
+            kind, worker_id, payload = await self.__loop.run_in_executor(None, self.__channel.get)
+            if kind == self.MSG_BUCKET:
+                self.__add_bucket(worker_id, payload)
+            elif kind == self.MSG_SESSIONS:
+                now_ns = time.time_ns()
+                for record in payload:
+                    self.__session_tracer.add(record, now_ns)
+
+    async def __maintain(self):
+        while True:
+            await asyncio.sleep(self.__flush_interval_ms / 1000.0)
+            self.__session_tracer.expire(time.time_ns())
+            self.__sessions_storage.flush()
+            self.__sessions_storage.enforce_retention()
+            self.__template_miner.save(self.__templates_path)
+
+    def __add_bucket(self, worker_id: int, export: Mapping[str, Any]):
+        bucket = export['bucket']
+        if self.__next_bucket is not None and bucket < self.__next_bucket:
+            self.__logger.warning('dropped late bucket {} of worker {}'.format(bucket, worker_id),
+                                  extra={'session_key': "???"})
+            return
+
+        new_ids = {}
+        counts = []
+        for service, levelname, local_id, template, count in export['counts']:
+            global_id = self.__global_ids.get((worker_id, local_id))
+            if global_id is None:
+                global_id, __ = self.__template_miner.add(template)
+                self.__global_ids[(worker_id, local_id)] = global_id
+                new_ids[local_id] = global_id
+            counts.append((service, levelname, global_id, count))
+        if len(new_ids) != 0:
+            try:
+                self.__replies[worker_id].put_nowait(new_ids)
+            except queue.Full:
+                pass
+
+        merged = dict(export)
+        merged['counts'] = counts
+        self.__pending.setdefault(bucket, {})[worker_id] = merged
+
+        while len(self.__pending) != 0:
+            first = min(self.__pending)
+            if len(self.__pending[first]) < self.__workers and len(self.__pending) <= self.MAX_PENDING_BUCKETS:
+                break
+            exports = self.__pending.pop(first)
+            self.__detector.merge(first, list(exports.values()))
+            self.__next_bucket = first + 1
+        self.__report_alerts()
+
+    def __report_alerts(self):
+        for alert in self.__detector.take_new_alerts():
+            self.__logger.warning('anomaly detected: {}'.format(self.__describe(alert)),
+                                  extra={'session_key': "???"})
+
+    def __describe(self, alert: Mapping[str, Any]) -> Mapping[str, Any]:
+        if 'template_id' in alert:
+            alert = dict(alert)
+            alert['template'] = str(self.__template_miner.template(alert['template_id']))
+        return alert
+
+    BASE_PATH = '/api/v1'
+
+    SESSION_PATH = BASE_PATH + '/sessions/{session_key}'
+
+    async def __get_session(self, req: web.Request) -> web.Response:
+        try:
+            session_key = int(req.match_info['session_key'])
+        except ValueError:
+            return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
+        trace = self.__session_tracer.get(session_key)
+        if trace is None:
+            return web.json_response({'code': -1, 'description': 'no active session!'}, status=404)
+        return web.json_response({'code': 0, 'data': trace.summary()})
+
+    ALERTS_PATH = BASE_PATH + '/alerts'
+
+    async def __get_alerts(self, req: web.Request) -> web.Response:
+        return web.json_response({'code': 0, 'data': [self.__describe(alert) for alert in self.__detector.alerts()]})
@@ -0,0 +1,324 @@
+import array
+import collections
+import math
+import re
+from typing import Any, Callable, Deque, Dict, List, Mapping, Optional
+
+
+class CountMinSketch:
+    """Fixed-size frequency sketch for high-cardinality keys (session keys, phone numbers)."""
+
+    MASK = (1 << 64) - 1
+    GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+
+    def __init__(self, width: int, depth: int):
+        self.__width = width
+        self.__depth = depth
+        self.__table = array.array('L', bytes(array.array('L').itemsize * width * depth))
+        self.__zero = array.array('L', bytes(array.array('L').itemsize * width * depth))
+        self.__dirty = False
+        # fixed seeds: sketches of forked analyzer workers index alike and stay mergeable.
+        self.__seeds = [((i + 1) * self.GOLDEN_GAMMA) & self.MASK for i in range(depth)]
+        # cells of the last key, refilled in place: add() runs for every record and must not allocate.
+        self.__cells = [0] * depth
+
+    @property
+    def dirty(self) -> bool:
+        return self.__dirty
+
+    def __indexes(self, key: Any) -> List[int]:
+        # hash() of an int is the int itself: Snowflake session keys share their low bits and differ in a few
+        # high ones. Every row mixes hash() with its own seed through the splitmix64 finalizer, so each row
+        # spreads such keys on its own. hash() of str is salted per interpreter, forked workers share the salt.
+        h = hash(key) & self.MASK
+        mask = self.MASK
+        width = self.__width
+        cells = self.__cells
+        offset = 0
+        i = 0
+        for seed in self.__seeds:
+            z = (h + seed) & mask
+            z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & mask
+            z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & mask
+            cells[i] = offset + (z ^ (z >> 31)) % width
+            offset += width
+            i += 1
+        return cells
+
+    def add(self, key: Any) -> int:
+        self.__dirty = True
+        table = self.__table
+        estimate = -1
+        for ind in self.__indexes(key):
+            v = table[ind] + 1
+            table[ind] = v
+            if estimate < 0 or v < estimate:
+                estimate = v
+        return estimate
+
+    def estimate(self, key: Any) -> int:
+        table = self.__table
+        estimate = -1
+        for ind in self.__indexes(key):
+            v = table[ind]
+            if estimate < 0 or v < estimate:
+                estimate = v
+        return estimate
+
+    def tobytes(self) -> bytes:
+        return self.__table.tobytes()
+
+    def merge(self, table: bytes) -> None:
+        other = array.array('L')
+        other.frombytes(table)
+        for i, v in enumerate(other):
+            if v != 0:
+                self.__table[i] += v
+        self.__dirty = True
+
+    def reset(self) -> None:
+        if self.__dirty:
+            self.__table[:] = self.__zero
+            self.__dirty = False
+
+
+class AnomalyDetector:
+    """Streaming rate anomaly detector.
+
+    Counts records per (service, level, template) in fixed buckets of event time. When a bucket closes every
+    key is compared against its EWMA baseline (mean + threshold_sigma * std) and against the same bucket one
+    season ago (seasonal naive). High-cardinality keys only go to count-min sketches, which are reset every
+    bucket, so memory does not depend on traffic.
+
+    With `on_bucket` set (analyzer worker) closed buckets are exported instead of evaluated: counts, sketch
+    tables and heavy hitter candidates go to an aggregating detector, which sums them with merge() and runs
+    exactly the same evaluation, so results match a single-process analyzer.
+    """
+
+    PHONE_RE = re.compile(r"'?\+?\d{11}'?\.*")
+
+    def __init__(self, bucket_s: int = 10, ewma_alpha: float = 0.1, threshold_sigma: float = 4.0,
+                 min_count: int = 20, warmup_buckets: int = 6, season_s: int = 86400, seasonal_factor: float = 3.0,
+                 sketch_width: int = 2048, sketch_depth: int = 4, heavy_hitter_count: int = 100,
+                 max_alerts: int = 1000, on_bucket: Optional[Callable[[Mapping[str, Any]], None]] = None,
+                 workers: int = 1):
+        self.__bucket_ns = bucket_s * 10 ** 9
+        self.__alpha = ewma_alpha
+        self.__threshold_sigma = threshold_sigma
+        self.__min_count = min_count
+        self.__warmup_buckets = warmup_buckets
+        self.__season_buckets = max(season_s // bucket_s, 1)
+        self.__seasonal_factor = seasonal_factor
+        self.__heavy_hitter_count = heavy_hitter_count
+        self.__on_bucket = on_bucket
+        # a key above the threshold globally is above threshold / workers on at least one worker.
+        self.__candidate_count = -(-heavy_hitter_count // workers)
+
+        # service -> level -> template_id -> slot; counters for a slot live in flat arrays.
+        self.__slots: Dict[str, Dict[str, Dict[int, int]]] = {}
+        self.__slot_keys: List[tuple] = []
+        self.__counts = array.array('L')
+        self.__mean = array.array('d')
+        self.__var = array.array('d')
+        self.__observed = array.array('L')
+        self.__seasons: List[array.array] = []
+
+        self.__session_sketch = CountMinSketch(sketch_width, sketch_depth)
+        self.__phone_sketch = CountMinSketch(sketch_width, sketch_depth)
+        self.__heavy_hitters = set()
+
+        self.__bucket: Optional[int] = None
+        self.__closed_buckets = 0
+
+        self.__alerts: Deque[Mapping[str, Any]] = collections.deque(maxlen=max_alerts)
+        self.__new_alerts: List[Mapping[str, Any]] = []
+
+    @classmethod
+    def from_config(cls, detector_cfg: dict, on_bucket: Optional[Callable[[Mapping[str, Any]], None]] = None,
+                    workers: int = 1) -> 'AnomalyDetector':
+        return cls(bucket_s=detector_cfg.get('bucket_s', 10),
+                   ewma_alpha=detector_cfg.get('ewma_alpha', 0.1),
+                   threshold_sigma=detector_cfg.get('threshold_sigma', 4.0),
+                   min_count=detector_cfg.get('min_count', 20),
+                   warmup_buckets=detector_cfg.get('warmup_buckets', 6),
+                   season_s=detector_cfg.get('season_s', 86400),
+                   seasonal_factor=detector_cfg.get('seasonal_factor', 3.0),
+                   sketch_width=detector_cfg.get('sketch_width', 2048),
+                   sketch_depth=detector_cfg.get('sketch_depth', 4),
+                   heavy_hitter_count=detector_cfg.get('heavy_hitter_count', 100),
+                   max_alerts=detector_cfg.get('max_alerts', 1000),
+                   on_bucket=on_bucket,
+                   workers=workers)
+
+    def stats(self) -> Mapping[str, int]:
+        return {
+            'keys': len(self.__slot_keys),
+            'closed_buckets': self.__closed_buckets,
+            'alerts': len(self.__alerts),
+        }
+
+    def alerts(self) -> List[Mapping[str, Any]]:
+        return list(self.__alerts)
+
+    def take_new_alerts(self) -> List[Mapping[str, Any]]:
+        new_alerts, self.__new_alerts = self.__new_alerts, []
+        return new_alerts
+
+    def add(self, record: Mapping[str, Any]) -> None:
+        bucket = record['ts_ns'] // self.__bucket_ns
+        if self.__bucket is None:
+            self.__bucket = bucket
+        elif bucket > self.__bucket:
+            self.__close_buckets(bucket)
+        # late records are accounted to the current bucket.
+
+        # a collapsed record (see utils.log_filters) stands for `repeat` records.
+        self.__counts[self.__slot(record['service'], record['levelname'], record['template_id'])] += \
+            record.get('repeat') or 1
+
+        session_key = record['session_key']
+        if session_key is not None:
+            n = self.__session_sketch.add(session_key)
+            if n >= self.__candidate_count:
+                self.__heavy_hitter('session_key', session_key, n, self.__bucket)
+        for param in record['params']:
+            if self.PHONE_RE.fullmatch(param) is not None:
+                phone_number = param.strip("'.")
+                n = self.__phone_sketch.add(phone_number)
+                if n >= self.__candidate_count:
+                    self.__heavy_hitter('phone_number', phone_number, n, self.__bucket)
+
+    def tick(self, now_ns: int) -> None:
+        # closes buckets when ingest goes quiet, so silence also updates the baselines.
+        bucket = now_ns // self.__bucket_ns
+        if self.__bucket is None:
+            self.__bucket = bucket
+        elif bucket > self.__bucket + 1:
+            self.__close_buckets(bucket - 1)
+
+    def merge(self, bucket: int, exports: List[Mapping[str, Any]]) -> None:
+        # evaluates one bucket from the exports of all workers; template ids must already be global.
+        for export in exports:
+            for service, levelname, template_id, count in export['counts']:
+                self.__counts[self.__slot(service, levelname, template_id)] += count
+            if export['session_sketch'] is not None:
+                self.__session_sketch.merge(export['session_sketch'])
+            if export['phone_sketch'] is not None:
+                self.__phone_sketch.merge(export['phone_sketch'])
+        for export in exports:
+            for field, value in export['candidates']:
+                sketch = self.__session_sketch if field == 'session_key' else self.__phone_sketch
+                n = sketch.estimate(value)
+                if n >= self.__heavy_hitter_count:
+                    self.__heavy_hitter(field, value, n, bucket)
+        self.__close_bucket(bucket)
+        self.__clear_bucket()
+        self.__bucket = bucket + 1
+
+    def __slot(self, service: str, levelname: str, template_id: int) -> int:
+        by_level = self.__slots.get(service)
+        if by_level is None:
+            by_level = self.__slots[service] = {}
+        by_template = by_level.get(levelname)
+        if by_template is None:
+            by_template = by_level[levelname] = {}
+        slot = by_template.get(template_id)
+        if slot is None:
+            slot = by_template[template_id] = self.__new_slot(service, levelname, template_id)
+        return slot
+
+    def __new_slot(self, service: str, levelname: str, template_id: int) -> int:
+        self.__slot_keys.append((service, levelname, template_id))
+        self.__counts.append(0)
+        self.__mean.append(0.0)
+        self.__var.append(0.0)
+        # a key seen for the first time was silent during all closed buckets, so bursts of brand new
+        # templates (e.g. a new warning) are not hidden behind the warmup.
+        self.__observed.append(self.__closed_buckets)
+        self.__seasons.append(array.array('I', bytes(4 * self.__season_buckets)))
+        return len(self.__slot_keys) - 1
+
+    def __close_buckets(self, bucket: int) -> None:
+        # gaps longer than a season carry no extra information.
+        for b in range(max(self.__bucket, bucket - self.__season_buckets), bucket):
+            if self.__on_bucket is not None:
+                self.__export_bucket(b)
+            else:
+                self.__close_bucket(b)
+            self.__clear_bucket()
+        self.__bucket = bucket
+
+    def __clear_bucket(self) -> None:
+        for i in range(len(self.__counts)):
+            self.__counts[i] = 0
+        self.__session_sketch.reset()
+        self.__phone_sketch.reset()
+        self.__heavy_hitters.clear()
+
+    def __export_bucket(self, bucket: int) -> None:
+        self.__on_bucket({
+            'bucket': bucket,
+            'counts': [self.__slot_keys[slot] + (count,) for slot, count in enumerate(self.__counts) if count != 0],
+            'session_sketch': self.__session_sketch.tobytes() if self.__session_sketch.dirty else None,
+            'phone_sketch': self.__phone_sketch.tobytes() if self.__phone_sketch.dirty else None,
+            'candidates': list(self.__heavy_hitters),
+        })
+        self.__closed_buckets += 1
+
+    def __close_bucket(self, bucket: int) -> None:
+        season_ind = bucket % self.__season_buckets
+        alpha = self.__alpha
+        for slot in range(len(self.__counts)):
+            x = self.__counts[slot]
+            mean = self.__mean[slot]
+            observed = self.__observed[slot]
+            season = self.__seasons[slot]
+
+            if x >= self.__min_count and observed >= self.__warmup_buckets:
+                # Poisson floor: a key that was flat at ~0 still needs a real burst to alert.
+                std = max(math.sqrt(self.__var[slot]), math.sqrt(mean), 1.0)
+                expected = mean + self.__threshold_sigma * std
+                if x > expected:
+                    self.__alert('rate_spike', bucket, slot, x, expected)
+                elif observed >= self.__season_buckets:
+                    expected = self.__seasonal_factor * max(season[season_ind], 1)
+                    if x > expected:
+                        self.__alert('seasonal_spike', bucket, slot, x, expected)
+
+            diff = x - mean
+            self.__mean[slot] = mean + alpha * diff
+            self.__var[slot] = (1.0 - alpha) * (self.__var[slot] + alpha * diff * diff)
+            self.__observed[slot] = observed + 1
+            season[season_ind] = min(x, 0xffffffff)
+        self.__closed_buckets += 1
+
+    def __alert(self, kind: str, bucket: int, slot: int, observed: int, expected: float) -> None:
+        service, levelname, template_id = self.__slot_keys[slot]
+        self.__push_alert({
+            'kind': kind,
+            'ts_ns': bucket * self.__bucket_ns,
+            'service': service,
+            'levelname': levelname,
+            'template_id': template_id,
+            'observed': observed,
+            'expected': expected,
+        })
+
+    def __heavy_hitter(self, field: str, value: Any, n: int, bucket: int) -> None:
+        if (field, value) in self.__heavy_hitters:
+            return
+        self.__heavy_hitters.add((field, value))
+        if self.__on_bucket is not None:
+            # only a candidate, the aggregator decides on the merged sketch.
+            return
+        self.__push_alert({
+            'kind': 'heavy_hitter',
+            'ts_ns': bucket * self.__bucket_ns,
+            field: value,
+            'observed': n,
+            'expected': self.__heavy_hitter_count,
+        })
+
+    def __push_alert(self, alert: Mapping[str, Any]) -> None:
+        self.__alerts.append(alert)
+        self.__new_alerts.append(alert)
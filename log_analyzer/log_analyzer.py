@@ -1,38 +1,185 @@
 #!/usr/bin/python3
 import asyncio
+import json
 import logging
-from typing import Mapping, Any
+import math
+import multiprocessing
+import os
+import queue
+import time
+import zlib
+from typing import Mapping, Any, AsyncIterator, Dict, List, Optional, Tuple
 from urllib import parse
 
 import yaml
-from aiohttp import web
+from aiohttp import hdrs, web
 
+from log_analyzer.aggregator import Aggregator
+from log_analyzer.anomaly_detector import AnomalyDetector
+from log_analyzer.log_index import LogIndex
+from log_analyzer.log_query import LogQuery, Partition
+from log_analyzer.log_sampler import LogSampler
+from log_analyzer.log_storage import LogStorage
+from log_analyzer.session_tracer import SessionTracer
+from log_analyzer.template_miner import TemplateMiner
+from utils.log_record import normalize_record
 from utils.utils import get_logger, create_arguments_parser, parse_args_as_dict
 
 
 class LogAnalyzer:
     def __make_app(self) -> web.Application:
-        app = web.Application()
+        # request bodies are inflated by __iter_chunks, at most CHUNK_SIZE bytes at a time; aiohttp knows no bound.
+        app = web.Application(handler_args={'auto_decompress': False})
         app.add_routes([
             web.post(self.ADD_LOG_PATH, self.__add_log),
+            web.post(self.ADD_LOGS_PATH, self.__add_logs),
+            web.get(self.QUERY_PATH, self.__query),
+            web.get(self.STATS_PATH, self.__get_stats),
         ])
+        if self.__worker_id is None:
+            # a multi-worker analyzer serves these from the aggregator.
+            app.add_routes([
+                web.get(self.ALERTS_PATH, self.__get_alerts),
+                web.get(self.SESSION_PATH, self.__get_session),
+            ])
         return app
 
-    def __init__(self, cfg: dict, logger: logging.Logger):
+    def __init__(self, cfg: dict, logger: logging.Logger, worker_id: Optional[int] = None,
+                 channel: Optional[multiprocessing.Queue] = None, replies: Optional[multiprocessing.Queue] = None):
         self.__loop = asyncio.new_event_loop()
 
         self.__cfg = cfg.copy()
         self.__logger = logger
         self.__host = self.__cfg['server']['host']
         self.__port = self.__cfg['server']['port']
+        self.__max_record_bytes = self.__cfg['server'].get('max_record_bytes', 64 * 1024)
+
+        # parsed records wait here for the ingest task; when it is full senders get 429 + Retry-After.
+        ingest_cfg = self.__cfg.get('ingest', {})
+        self.__queue_size = ingest_cfg.get('queue_size', 100000)
+        self.__max_retry_after_s = ingest_cfg.get('max_retry_after_s', 30)
+        self.__work: asyncio.Queue = asyncio.Queue()
+        self.__queued = 0
+        self.__drained = asyncio.Event()
+        self.__drain_rate = 0.0
+        self.__sampler = LogSampler.from_config(ingest_cfg)
+        self.__ingest_stats = {'processed': 0, 'stored': 0, 'failed': 0, 'throttled_requests': 0}
+
+        self.__worker_id = worker_id
+        self.__workers = self.__cfg['server'].get('workers', 1)
+        self.__channel = channel
+        self.__replies = replies
+        self.__session_events: List[Mapping[str, Any]] = []
+
+        storage_cfg = self.__cfg.get('storage', {})
+        self.__storage_cfg = storage_cfg
+        self.__storage_path = storage_cfg.get('path', './storage')
+        if self.__worker_id is not None:
+            self.__storage_path = os.path.join(self.__storage_path, self.worker_dir(self.__worker_id))
+        self.__storage = LogStorage.from_config(storage_cfg, self.__storage_path)
+        self.__storage_flush_interval_ms = storage_cfg.get('flush_interval_ms', 1000)
+        self.__index = LogIndex.from_config(storage_cfg, self.__storage)
+        # read-only views of the other workers' partitions, opened by the first query and refreshed by the next.
+        self.__peer_partitions: Dict[int, Tuple[LogStorage, LogIndex]] = {}
+        self.__max_query_limit = self.__cfg.get('query', {}).get('max_limit', 10000)
+
+        self.__template_miner = TemplateMiner.from_config(self.__cfg.get('templates', {}))
+        self.__templates_path = os.path.join(self.__storage_path, 'templates.json')
+        self.__template_miner.load(self.__templates_path)
+
+        if self.__worker_id is None:
+            self.__sessions_storage = LogStorage.from_config(storage_cfg, os.path.join(self.__storage_path, 'sessions'))
+            self.__session_tracer = SessionTracer.from_config(self.__cfg.get('sessions', {}),
+                                                              self.__sessions_storage.append)
+            self.__detector = AnomalyDetector.from_config(self.__cfg.get('detector', {}))
+        else:
+            self.__sessions_storage = None
+            self.__session_tracer = None
+            self.__detector = AnomalyDetector.from_config(self.__cfg.get('detector', {}),
+                                                          on_bucket=self.__export_bucket, workers=self.__workers)
+        self.__loop.create_task(self.__maintain_storage())
+        self.__loop.create_task(self.__ingest())
 
         runner = web.AppRunner(self.__make_app())
         self.__loop.run_until_complete(runner.setup())
-        site = web.TCPSite(runner, self.__host, self.__port)
+        # workers share the listening port, the kernel spreads connections between them.
+        site = web.TCPSite(runner, self.__host, self.__port, reuse_port=self.__worker_id is not None)
         self.__loop.run_until_complete(site.start())
 
+    @staticmethod
+    def worker_dir(worker_id: int) -> str:
+        return 'worker-{}'.format(worker_id)
+
     def run(self):
-        self.__loop.run_forever()
+        try:
+            self.__loop.run_forever()
+        finally:
+            if self.__session_tracer is not None:
+                self.__session_tracer.flush_all()
+                self.__sessions_storage.close()
+            self.__storage.close()
+            self.__index.close()
+            self.__template_miner.save(self.__templates_path)
+
+    async def __maintain_storage(self):
+        while True:
+            await asyncio.sleep(self.__storage_flush_interval_ms / 1000.0)
+            now_ns = time.time_ns()
+            if self.__session_tracer is not None:
+                self.__session_tracer.expire(now_ns)
+                self.__sessions_storage.flush()
+                self.__sessions_storage.enforce_retention()
+            else:
+                self.__sync_with_aggregator()
+            self.__storage.flush()
+            self.__template_miner.save(self.__templates_path)
+            self.__detector.tick(now_ns)
+            self.__report_alerts()
+            removed = self.__storage.enforce_retention()
+            self.__index.drop(removed)
+            if len(removed) != 0:
+                self.__logger.info('removed {} expired storage segments'.format(len(removed)),
+                                   extra={'session_key': "???"})
+
+    def __export_bucket(self, export: Mapping[str, Any]):
+        export = dict(export)
+        export['counts'] = [(service, levelname, template_id, str(self.__template_miner.template(template_id)), count)
+                            for service, levelname, template_id, count in export['counts']]
+        self.__channel.put((Aggregator.MSG_BUCKET, self.__worker_id, export))
+
+    def __sync_with_aggregator(self):
+        if len(self.__session_events) != 0:
+            self.__channel.put((Aggregator.MSG_SESSIONS, self.__worker_id, self.__session_events))
+            self.__session_events = []
+        while True:
+            try:
+                global_ids = self.__replies.get_nowait()
+            except queue.Empty:
+                break
+            for template_id, global_id in global_ids.items():
+                self.__template_miner.set_global_id(template_id, global_id)
+
+    def __partitions(self) -> List[Partition]:
+        if self.__worker_id is None:
+            return [(self.__storage, self.__index, None)]
+        # other workers' partitions are read through read-only views, caught up with their owners for this query.
+        partitions = []
+        base = self.__storage_cfg.get('path', './storage')
+        for worker_id in range(self.__workers):
+            if worker_id == self.__worker_id:
+                partitions.append((self.__storage, self.__index, self.__template_miner.local_ids()))
+                continue
+            path = os.path.join(base, self.worker_dir(worker_id))
+            peer = self.__peer_partitions.get(worker_id)
+            if peer is None:
+                storage = LogStorage.from_config(self.__storage_cfg, path, read_only=True)
+                peer = self.__peer_partitions[worker_id] = (storage, LogIndex.from_config(self.__storage_cfg, storage))
+            else:
+                peer[0].refresh()
+                peer[1].refresh()
+            partitions.append((peer[0], peer[1],
+                               TemplateMiner.load_local_ids(os.path.join(path, 'templates.json'))))
+        return partitions
 
     BASE_PATH = '/api/v1'
 
@@ -41,32 +188,319 @@ class LogAnalyzer:
     async def __add_log(self, req: web.Request) -> web.Response:
         self.__logger.info('got new log request',
                            extra={'session_key': "???"})
+        if self.__queued >= self.__queue_size:
+            return self.__throttle()
         try:
-            params = parse.parse_qs(await req.text())
-        except (ValueError, KeyError) as e:
+            body = b''
+            async for chunk in self.__iter_chunks(req):
+                body += chunk
+                if len(body) > self.__max_record_bytes:
+                    raise ValueError('log record is too long')
+            params = parse.parse_qs(body.decode(req.charset or 'utf-8'))
+        except (ValueError, KeyError, LookupError, zlib.error) as e:
             self.__logger.warning("unable to parse request!",
                                   extra={'session_key': "???"})
             return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
 
-        # self.__logger.debug('new log request params: {}'.format(params))
-        params = self.__clean_params(params)
-        self.__logger.debug('new log request params: {}'.format(params),
+        record = normalize_record(self.__clean_params(params))
+        if record is None:
+            self.__logger.warning("unable to parse request!",
+                                  extra={'session_key': "???"})
+            return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
+        self.__logger.debug('new log request params: {}'.format(record),
                             extra={'session_key': "???"})
+        await self.__enqueue([record])
 
-        self.__logger.info('successfully processed new log',
+        self.__logger.info('successfully queued new log',
                            extra={'session_key': "???"})
 
         return web.json_response({'code': 0})
 
+    ADD_LOGS_PATH = BASE_PATH + '/add_logs'
+
+    CHUNK_SIZE = 64 * 1024
+
+    GZIP_MAGIC = b'\x1f\x8b'
+
+    GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+    # Content-Encoding -> wbits of its decompressor, 0 for none.
+    ENCODING_WBITS = {
+        'identity': 0,
+        'gzip': GZIP_WBITS,
+        'x-gzip': GZIP_WBITS,
+        'deflate': zlib.MAX_WBITS,
+    }
+
+    async def __iter_chunks(self, req: web.Request) -> AsyncIterator[bytes]:
+        # "Content-Encoding: gzip" is what the log shippers send, but senders may also post a raw gzip
+        # file (e.g. "Content-Type: application/gzip"), so the magic bytes of a plain body are sniffed too.
+        wbits = self.ENCODING_WBITS.get(req.headers.get(hdrs.CONTENT_ENCODING, 'identity').lower())
+        if wbits is None:
+            raise ValueError('unsupported content encoding')
+        sniffing = wbits == 0
+        head = b''
+        decompressor = zlib.decompressobj(wbits) if wbits != 0 else None
+        async for chunk in req.content.iter_chunked(self.CHUNK_SIZE):
+            if sniffing:
+                # the magic may arrive split over network chunks.
+                head += chunk
+                if len(head) < len(self.GZIP_MAGIC):
+                    continue
+                sniffing = False
+                chunk, head = head, b''
+                if chunk.startswith(self.GZIP_MAGIC):
+                    wbits = self.GZIP_WBITS
+                    decompressor = zlib.decompressobj(wbits)
+            if decompressor is None:
+                yield chunk
+                continue
+            # a small compressed chunk may inflate to a lot, it is let out CHUNK_SIZE bytes at a time.
+            while len(chunk) != 0:
+                yield decompressor.decompress(chunk, self.CHUNK_SIZE)
+                chunk = decompressor.unconsumed_tail
+                if decompressor.eof:
+                    # concatenated files (e.g. rotated logs) are gzip members of their own.
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits)
+        if len(head) != 0:
+            # a body shorter than the magic.
+            yield head
+        if decompressor is not None:
+            yield decompressor.flush()
+
+    async def __iter_lines(self, req: web.Request) -> AsyncIterator[bytes]:
+        tail = b''
+        async for chunk in self.__iter_chunks(req):
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop()
+            for line in lines:
+                if len(line) > self.__max_record_bytes:
+                    raise ValueError('log record is too long')
+                yield line
+            if len(tail) > self.__max_record_bytes:
+                raise ValueError('log record is too long')
+        yield tail
+
+    async def __add_logs(self, req: web.Request) -> web.Response:
+        self.__logger.info('got new logs batch request',
+                           extra={'session_key': "???"})
+        if self.__queued >= self.__queue_size:
+            return self.__throttle()
+        accepted, rejected = 0, 0
+        records = []
+        try:
+            async for line in self.__iter_lines(req):
+                if line.strip() == b'':
+                    continue
+                try:
+                    params = json.loads(line)
+                    if not isinstance(params, dict):
+                        raise ValueError('log record must be an object')
+                except ValueError:
+                    rejected += 1
+                    continue
+                record = normalize_record(params)
+                if record is None:
+                    rejected += 1
+                    continue
+                records.append(record)
+                accepted += 1
+                if len(records) == self.ENQUEUE_BATCH_SIZE:
+                    await self.__enqueue(records)
+                    records = []
+            await self.__enqueue(records)
+        except (ValueError, zlib.error) as e:
+            self.__logger.warning("unable to parse logs batch: {}".format(e),
+                                  extra={'session_key': "???"})
+            return web.json_response({'code': -1, 'description': 'unable to parse request!',
+                                      'accepted': accepted - len(records), 'rejected': rejected}, status=400)
+
+        self.__logger.info('successfully queued logs batch: {} accepted, {} rejected'.format(accepted, rejected),
+                           extra={'session_key': "???"})
+
+        return web.json_response({'code': 0, 'accepted': accepted, 'rejected': rejected})
+
     def __clean_params(self, params: dict):
-        return {k: v[0] for k, v in params.items() if k in ['name', 'msg', 'levelname', 'asctime']}
+        return {k: v[0] for k, v in params.items()}
 
+    # records of a request enter the work queue in slices of this size.
+    ENQUEUE_BATCH_SIZE = 1000
 
-desc_str = """Log analysis server."""
+    def __throttle(self) -> web.Response:
+        self.__ingest_stats['throttled_requests'] += 1
+        retry_after = self.__queued / self.__drain_rate if self.__drain_rate > 0.0 else self.__max_retry_after_s
+        retry_after = min(max(math.ceil(retry_after), 1), self.__max_retry_after_s)
+        self.__logger.warning('ingest queue is full, throttling sender for {} s'.format(retry_after),
+                              extra={'session_key': "???"})
+        return web.json_response({'code': -1, 'description': 'log analyzer is overloaded!'}, status=429,
+                                 headers={'Retry-After': str(retry_after)})
+
+    async def __enqueue(self, records: List[Mapping[str, Any]]):
+        # an admitted request is never cut in half: it waits for room, which also stops reading its body.
+        while self.__queued != 0 and self.__queued + len(records) > self.__queue_size:
+            self.__drained.clear()
+            await self.__drained.wait()
+        if len(records) != 0:
+            self.__queued += len(records)
+            self.__work.put_nowait(records)
+
+    async def __ingest(self):
+        while True:
+            records = await self.__work.get()
+            start = time.monotonic()
+            try:
+                for record in records:
+                    # one bad record (or a failed write) must not stop the ingest of every later one.
+                    try:
+                        self.__process_record(record)
+                    except Exception as e:
+                        self.__ingest_stats['failed'] += 1
+                        self.__logger.error("unable to process record: {!r}".format(e),
+                                            extra={'session_key': "???"})
+            finally:
+                self.__queued -= len(records)
+            self.__ingest_stats['processed'] += len(records)
+            elapsed = time.monotonic() - start
+            if elapsed > 0.0:
+                rate = len(records) / elapsed
+                self.__drain_rate = rate if self.__drain_rate == 0.0 else 0.9 * self.__drain_rate + 0.1 * rate
+            self.__drained.set()
+            self.__report_alerts()
+            # lets request handlers run between slices of work.
+            await asyncio.sleep(0)
+
+    def __process_record(self, record: Mapping[str, Any]):
+        # records are kept exactly as they were validated against RECORD_SCHEMA, plus their template.
+        template_id, params = self.__template_miner.add(record['msg'])
+        record = dict(record)
+        record['template_id'] = template_id
+        record['params'] = params
+        # the detector counts every record, sampling only saves storage, indexing and tracing.
+        self.__detector.add(record)
+        weight = self.__sampler.sample(record, self.__queued / self.__queue_size, time.time_ns())
+        if weight == 0:
+            return
+        if weight != 1:
+            record['sample_weight'] = weight
+        seq, offset = self.__storage.append(record)
+        self.__ingest_stats['stored'] += 1
+        self.__index.add(seq, offset, record)
+        if self.__session_tracer is not None:
+            self.__session_tracer.add(record, time.time_ns())
+        elif record['session_key'] is not None:
+            self.__session_events.append({
+                'ts_ns': record['ts_ns'],
+                'session_key': record['session_key'],
+                'service': record['service'],
+                'levelname': record['levelname'],
+                'route': record['route'],
+                'template_id': self.__template_miner.template(template_id).global_id,
+                'upstream_host': record['upstream_host'],
+                'upstream_port': record['upstream_port'],
+                'duration_ms': record['duration_ms'],
+            })
+
+    def __report_alerts(self):
+        for alert in self.__detector.take_new_alerts():
+            if 'template_id' in alert:
+                alert = dict(alert)
+                alert['template'] = str(self.__template_miner.template(alert['template_id']))
+            self.__logger.warning('anomaly detected: {}'.format(alert),
+                                  extra={'session_key': "???"})
+
+    SESSION_PATH = BASE_PATH + '/sessions/{session_key}'
+
+    async def __get_session(self, req: web.Request) -> web.Response:
+        try:
+            session_key = int(req.match_info['session_key'])
+        except ValueError:
+            return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
+        trace = self.__session_tracer.get(session_key)
+        if trace is None:
+            return web.json_response({'code': -1, 'description': 'no active session!'}, status=404)
+        return web.json_response({'code': 0, 'data': trace.summary()})
+
+    QUERY_PATH = BASE_PATH + '/query'
+
+    async def __query(self, req: web.Request) -> web.StreamResponse:
+        try:
+            query = LogQuery.from_params(req.query)
+            limit = min(int(req.query.get('limit', 1000)), self.__max_query_limit)
+            if limit < 1:
+                raise ValueError('limit must be positive')
+        except (ValueError, KeyError) as e:
+            self.__logger.warning("unable to parse query!",
+                                  extra={'session_key': "???", 'route': req.path})
+            return web.json_response({'code': -1, 'description': 'unable to parse request!'}, status=400)
+
+        resp = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        resp.enable_chunked_encoding()
+        await resp.prepare(req)
+
+        # records go out as soon as a chunk is full; the trailing line carries the cursor of the next page.
+        chunk, chunk_size = [], 0
+        count, last, next_cursor = 0, None, None
+        for part, seq, offset, record in query.execute(self.__partitions()):
+            if count == limit:
+                next_cursor = LogQuery.format_cursor(*last)
+                break
+            line = json.dumps(record, ensure_ascii=False).encode('utf-8')
+            chunk.append(line)
+            chunk_size += len(line)
+            count += 1
+            last = (part, seq, offset)
+            if chunk_size >= self.CHUNK_SIZE:
+                await resp.write(b'\n'.join(chunk) + b'\n')
+                chunk, chunk_size = [], 0
+        chunk.append(json.dumps({'code': 0, 'count': count, 'next_cursor': next_cursor}).encode('utf-8'))
+        await resp.write(b'\n'.join(chunk) + b'\n')
+        await resp.write_eof()
+        return resp
+
+    STATS_PATH = BASE_PATH + '/stats'
+
+    async def __get_stats(self, req: web.Request) -> web.Response:
+        ingest = dict(self.__ingest_stats)
+        ingest.update({
+            'queued': self.__queued,
+            'queue_size': self.__queue_size,
+            'drain_rate': self.__drain_rate,
+        })
+        ingest.update(self.__sampler.stats())
+        return web.json_response({'code': 0, 'data': {
+            'worker_id': self.__worker_id,
+            'ingest': ingest,
+            'storage': self.__storage.stats(),
+            'templates': self.__template_miner.stats(),
+            'detector': self.__detector.stats(),
+        }})
+
+    ALERTS_PATH = BASE_PATH + '/alerts'
+
+    async def __get_alerts(self, req: web.Request) -> web.Response:
+        alerts = []
+        for alert in self.__detector.alerts():
+            alert = dict(alert)
+            if 'template_id' in alert:
+                alert['template'] = str(self.__template_miner.template(alert['template_id']))
+            alerts.append(alert)
+        return web.json_response({'code': 0, 'data': alerts})
+
+
+desc_str = """Log analysis server, run from the repository root: python -m log_analyzer.log_analyzer -c CONFIG.
+
+With --replay runs the analysis over existing log files (or directories of rotated ones) instead."""
 
 
 def parse_args() -> Mapping[str, Any]:
     parser = create_arguments_parser('log_analyzer', desc_str)
+    parser.add_argument('--replay', type=str, nargs='+', metavar='PATH',
+                        help=r"analyze these log files or directories offline and exit")
+    parser.add_argument('--jobs', type=int, default=0,
+                        help=r"replay processes (default: one per CPU)")
+    parser.add_argument('--out', type=str, default='./replay',
+                        help=r"directory for replay templates and alerts (default: %(default)s)")
     return parse_args_as_dict(parser)
 
 
@@ -78,8 +512,36 @@ def main():
     cfg['server']['host'] = args.get('host', cfg['server']['host'])
     cfg['server']['port'] = args.get('port', cfg['server']['port'])
 
+    if 'replay' in args:
+        # imported here, numpy is only needed for replays.
+        from log_analyzer.log_replay import LogReplay
+        LogReplay(cfg, get_logger(cfg, 'log_analyzer'), jobs=args['jobs']).run(args['replay'], args['out'])
+        return
+
+    workers = cfg['server'].get('workers', 1)
+    if workers <= 1:
+        log_analyzer = LogAnalyzer(cfg, get_logger(cfg, 'log_analyzer'))
+        log_analyzer.run()
+        return
+
+    # forked workers share the str hash salt, which keeps their count-min sketches mergeable.
+    ctx = multiprocessing.get_context('fork')
+    channel = ctx.Queue()
+    replies = [ctx.Queue() for __ in range(workers)]
+    processes = [ctx.Process(target=run_worker, args=(cfg, worker_id, channel, replies[worker_id]), daemon=True)
+                 for worker_id in range(workers)]
+    for process in processes:
+        process.start()
+    # made once the workers are forked, like theirs: the threads of its filters and handlers do not survive a fork.
+    logger = get_logger(cfg, 'log_analyzer')
+    aggregator = Aggregator(cfg, logger, channel, replies)
+    aggregator.run()
+
+
+def run_worker(cfg: dict, worker_id: int, channel: multiprocessing.Queue, replies: multiprocessing.Queue):
+    # the logger is made in the worker, the threads of its handlers do not survive a fork.
     logger = get_logger(cfg, 'log_analyzer')
-    log_analyzer = LogAnalyzer(cfg, logger)
+    log_analyzer = LogAnalyzer(cfg, logger, worker_id=worker_id, channel=channel, replies=replies)
     log_analyzer.run()
 
 
@@ -0,0 +1,167 @@
+import collections
+import json
+import os
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple
+
+from log_analyzer.log_storage import LogStorage
+
+
+class LogIndex:
+    """Secondary indexes over LogStorage: session_key and template_id -> record offsets.
+
+    Postings are kept per segment, so they are written next to the segment once it is sealed
+    and dropped together with it by retention. Only the postings of the active segment stay in memory,
+    the sealed ones are loaded by lookups and kept in an LRU of `cache_segments` segments. An index over
+    a read-only store only knows the sealed segments, the others are reported by `unindexed()` and have
+    to be scanned.
+    """
+
+    FIELDS = ('session_key', 'template_id')
+
+    SUFFIX = '.pst'
+
+    def __init__(self, storage: LogStorage, cache_segments: int = 16):
+        self.__storage = storage
+        self.__cache_segments = cache_segments
+        # postings of the active segment: field -> value -> offsets (ascending, records are appended in offset
+        # order).
+        self.__active_postings: Optional[Dict[str, Dict[Any, List[int]]]] = None
+        self.__active_seq = None
+        # segments with postings saved next to them.
+        self.__sealed: Set[int] = set()
+        self.__cache: 'collections.OrderedDict[int, Dict[str, Dict[Any, List[int]]]]' = collections.OrderedDict()
+
+        segments = self.__storage.segments()
+        for i, (seq, __, __) in enumerate(segments):
+            if i != len(segments) - 1 and os.path.exists(self.__path(seq)):
+                self.__sealed.add(seq)
+                continue
+            if self.__storage.read_only:
+                continue
+            # the active segment (or a segment sealed by a crash) is re-indexed from data.
+            self.__active_seq = seq
+            self.__active_postings = self.__new_postings()
+            for cur_seq, offset, record in self.__storage.scan_with_offsets(0, 2 ** 64 - 1, min_seq=seq):
+                if cur_seq != seq:
+                    break
+                self.add(seq, offset, record)
+            if i != len(segments) - 1:
+                self.__seal()
+
+    @classmethod
+    def from_config(cls, storage_cfg: dict, storage: LogStorage) -> 'LogIndex':
+        return cls(storage, cache_segments=storage_cfg.get('postings_cache_segments', 16))
+
+    def add(self, seq: int, offset: int, record: Mapping[str, Any]) -> None:
+        if seq != self.__active_seq:
+            if self.__active_seq is not None:
+                self.__seal()
+            self.__active_seq = seq
+            self.__active_postings = self.__new_postings()
+        postings = self.__active_postings
+        for field in self.FIELDS:
+            value = record.get(field)
+            if value is None:
+                continue
+            offsets = postings[field].get(value)
+            if offsets is None:
+                offsets = postings[field][value] = []
+            offsets.append(offset)
+
+    def refresh(self) -> None:
+        """Catches an index over a read-only store up with the store: segments the owner saved postings for
+        since become indexed, removed segments are forgotten."""
+        if not self.__storage.read_only:
+            return
+        segments = self.__storage.segments()
+        seqs = {seq for seq, __, __ in segments}
+        for seq in [seq for seq in self.__sealed if seq not in seqs]:
+            self.__sealed.discard(seq)
+            self.__cache.pop(seq, None)
+        for seq, __, __ in segments[:-1]:
+            if seq not in self.__sealed and os.path.exists(self.__path(seq)):
+                self.__sealed.add(seq)
+
+    def unindexed(self) -> List[int]:
+        return [seq for seq, __, __ in self.__storage.segments()
+                if seq not in self.__sealed and seq != self.__active_seq]
+
+    def lookup(self, field: str, value: Any, start_ns: int = 0,
+               end_ns: int = 2 ** 64 - 1) -> List[Tuple[int, List[int]]]:
+        # segments outside of the time range are not loaded.
+        res = []
+        for seq, min_ts, max_ts in self.__storage.segments():
+            if min_ts is None or min_ts > end_ns or max_ts < start_ns:
+                continue
+            if seq == self.__active_seq:
+                postings = self.__active_postings
+            elif seq in self.__sealed:
+                postings = self.__sealed_postings(seq)
+            else:
+                postings = None
+            if postings is None:
+                continue
+            offsets = postings[field].get(value)
+            if offsets is not None:
+                res.append((seq, offsets))
+        return res
+
+    def drop(self, seqs: List[int]) -> None:
+        for seq in seqs:
+            self.__sealed.discard(seq)
+            self.__cache.pop(seq, None)
+            if seq == self.__active_seq:
+                self.__active_seq = None
+                self.__active_postings = None
+            path = self.__path(seq)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self) -> None:
+        if self.__active_seq is not None and not self.__storage.read_only:
+            self.__save(self.__active_seq, self.__active_postings)
+
+    def __new_postings(self) -> Dict[str, Dict[Any, List[int]]]:
+        return {field: {} for field in self.FIELDS}
+
+    def __path(self, seq: int) -> str:
+        return os.path.join(self.__storage.path, '{:010d}{}'.format(seq, self.SUFFIX))
+
+    def __seal(self) -> None:
+        self.__save(self.__active_seq, self.__active_postings)
+        self.__sealed.add(self.__active_seq)
+        self.__active_seq = None
+        self.__active_postings = None
+
+    def __sealed_postings(self, seq: int) -> Optional[Dict[str, Dict[Any, List[int]]]]:
+        postings = self.__cache.get(seq)
+        if postings is not None:
+            self.__cache.move_to_end(seq)
+            return postings
+        try:
+            postings = self.__load(self.__path(seq))
+        except FileNotFoundError:
+            # removed by the owner of a read-only store.
+            self.__sealed.discard(seq)
+            return None
+        self.__cache[seq] = postings
+        if len(self.__cache) > self.__cache_segments:
+            self.__cache.popitem(last=False)
+        return postings
+
+    def __save(self, seq: int, postings: Dict[str, Dict[Any, List[int]]]) -> None:
+        path = self.__path(seq)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({field: [[value, offsets] for value, offsets in by_value.items()]
+                       for field, by_value in postings.items()}, f)
+        os.replace(tmp_path, path)
+
+    def __load(self, path: str) -> Dict[str, Dict[Any, List[int]]]:
+        with open(path, 'r') as f:
+            saved = json.load(f)
+        postings = self.__new_postings()
+        for field in self.FIELDS:
+            for value, offsets in saved.get(field, []):
+                postings[field][value] = offsets
+        return postings
@@ -0,0 +1,119 @@
+import bisect
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Set, Tuple
+
+from log_analyzer.log_index import LogIndex
+from log_analyzer.log_storage import LogStorage
+
+# one partition per analyzer worker, a single-process analyzer has exactly one. Workers mine templates
+# locally, so their partitions come with a global template id -> local template ids map (None: ids are global).
+Partition = Tuple[LogStorage, LogIndex, Optional[Dict[int, List[int]]]]
+
+Cursor = Tuple[int, int, int]
+
+
+class LogQuery:
+    """Filter over stored records with cursor pagination.
+
+    session_key and template_id filters are answered from LogIndex postings, pure time/service/level
+    filters from the sparse time index of LogStorage. Results come in storage order, which is what the
+    cursor ("<partition>-<segment>-<offset>" of the last returned record) refers to.
+    """
+
+    MAX_TS = 2 ** 64 - 1
+
+    def __init__(self, start_ns: int = 0, end_ns: int = MAX_TS, service: Optional[str] = None,
+                 levelname: Optional[str] = None, template_id: Optional[int] = None,
+                 session_key: Optional[int] = None, cursor: Optional[Cursor] = None):
+        self.start_ns = start_ns
+        self.end_ns = end_ns
+        self.service = service
+        self.levelname = levelname
+        self.template_id = template_id
+        self.session_key = session_key
+        self.cursor = cursor
+
+    @classmethod
+    def from_params(cls, params: Mapping[str, str]) -> 'LogQuery':
+        cursor = None
+        if params.get('cursor'):
+            part, seq, offset = params['cursor'].split('-', 2)
+            cursor = (int(part), int(seq), int(offset))
+        return cls(start_ns=int(params.get('start_ns', 0)),
+                   end_ns=int(params.get('end_ns', cls.MAX_TS)),
+                   service=params.get('service'),
+                   levelname=params.get('levelname'),
+                   template_id=int(params['template_id']) if 'template_id' in params else None,
+                   session_key=int(params['session_key']) if 'session_key' in params else None,
+                   cursor=cursor)
+
+    @staticmethod
+    def format_cursor(part: int, seq: int, offset: int) -> str:
+        return '{}-{}-{}'.format(part, seq, offset)
+
+    def matches(self, record: Mapping[str, Any], template_ids: Optional[Set[int]] = None) -> bool:
+        return (self.start_ns <= record['ts_ns'] <= self.end_ns and
+                (self.service is None or record['service'] == self.service) and
+                (self.levelname is None or record['levelname'] == self.levelname) and
+                (template_ids is None or record.get('template_id') in template_ids) and
+                (self.session_key is None or record['session_key'] == self.session_key))
+
+    def execute(self, partitions: List[Partition]) -> Iterator[Tuple[int, int, int, Mapping[str, Any]]]:
+        for part, (storage, index, local_ids) in enumerate(partitions):
+            if self.cursor is not None and part < self.cursor[0]:
+                continue
+            template_ids = None
+            if self.template_id is not None:
+                template_ids = {self.template_id} if local_ids is None else set(local_ids.get(self.template_id, ()))
+            if self.session_key is not None or template_ids is not None:
+                records = self.__from_postings(part, storage, index, template_ids)
+            else:
+                records = self.__from_time_index(part, storage)
+            for seq, offset, record in records:
+                if self.matches(record, template_ids):
+                    yield part, seq, offset, record
+
+    def __after_cursor(self, part: int, seq: int, offset: int) -> bool:
+        return self.cursor is None or (part, seq, offset) > self.cursor
+
+    def __from_time_index(self, part: int, storage: LogStorage) -> Iterator[Tuple[int, int, Mapping[str, Any]]]:
+        min_seq = self.cursor[1] if self.cursor is not None and part == self.cursor[0] else 0
+        for seq, offset, record in storage.scan_with_offsets(self.start_ns, self.end_ns, min_seq=min_seq):
+            if self.__after_cursor(part, seq, offset):
+                yield seq, offset, record
+
+    def __from_postings(self, part: int, storage: LogStorage, index: LogIndex,
+                        template_ids: Optional[Set[int]]) -> Iterator[Tuple[int, int, Mapping[str, Any]]]:
+        postings = []
+        if self.session_key is not None:
+            postings.append(dict(index.lookup('session_key', self.session_key, self.start_ns, self.end_ns)))
+        if template_ids is not None:
+            by_seq: Dict[int, List[int]] = {}
+            for template_id in template_ids:
+                for seq, offsets in index.lookup('template_id', template_id, self.start_ns, self.end_ns):
+                    by_seq.setdefault(seq, []).extend(offsets)
+            postings.append({seq: sorted(offsets) for seq, offsets in by_seq.items()})
+        # the most selective list drives, the others are intersected with it.
+        postings.sort(key=lambda p: sum(len(offsets) for offsets in p.values()))
+        unindexed = set(index.unindexed())
+
+        bounds = {seq: (lo, hi) for seq, lo, hi in storage.segments()}
+        for seq in sorted(set(postings[0]) | unindexed):
+            if self.cursor is not None and (part, seq) < self.cursor[:2]:
+                continue
+            lo, hi = bounds.get(seq, (None, None))
+            if lo is None or lo > self.end_ns or hi < self.start_ns:
+                continue
+            if seq in unindexed:
+                # segments being written by another worker have no postings yet.
+                for offset, record in storage.scan_segment(seq, self.start_ns, self.end_ns):
+                    if self.__after_cursor(part, seq, offset):
+                        yield seq, offset, record
+                continue
+            offsets: List[int] = postings[0][seq]
+            for other in postings[1:]:
+                other_offsets = set(other.get(seq, ()))
+                offsets = [offset for offset in offsets if offset in other_offsets]
+            if self.cursor is not None and (part, seq) == self.cursor[:2]:
+                offsets = offsets[bisect.bisect_right(offsets, self.cursor[2]):]
+            for offset, record in storage.read_many(seq, offsets):
+                yield seq, offset, record
@@ -0,0 +1,233 @@
+import glob
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import time
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+from log_analyzer.anomaly_detector import AnomalyDetector
+from log_analyzer.template_miner import TemplateMiner
+from utils.log_filters import REPEAT_SUFFIX_RE
+
+# (path, start, end, first_ts_ns) of a line-aligned piece of a log file.
+Chunk = Tuple[str, int, int, int]
+
+# '%(asctime)s - %(name)s - %(session_key)s - %(levelname)s - %(message)s', see utils.get_logger.
+SEPARATOR = ' - '
+ASCTIME_RE = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}')
+ASCTIME_BYTES_RE = re.compile(rb'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}', re.MULTILINE)
+
+COLUMNS = ('ts_ns', 'service', 'levelname', 'template_id', 'session_key', 'repeat')
+
+# template miner of a pool process, templates evolve across the chunks that process gets.
+_miner: Optional[TemplateMiner] = None
+
+
+def _init_worker(templates_cfg: dict) -> None:
+    global _miner
+    _miner = TemplateMiner.from_config(templates_cfg)
+
+
+def _to_ts_ns(asctimes: List[str]) -> np.ndarray:
+    # asctime is local wall clock time; the whole column is parsed by numpy at once, then every distinct
+    # hour is shifted by its own UTC offset, so DST switches inside a file come out right.
+    wall_ms = np.char.replace(np.array(asctimes), ',', '.').astype('datetime64[ms]').astype(np.int64)
+    hours, inverse = np.unique(wall_ms // 3600000, return_inverse=True)
+    offsets_ms = np.array([int(h * 3600 - time.mktime(time.gmtime(h * 3600)[:8] + (-1,))) * 1000
+                           for h in hours.tolist()], dtype=np.int64)
+    return (wall_ms - offsets_ms[inverse]) * 10 ** 6
+
+
+def _parse_chunk(chunk: Chunk) -> Mapping[str, Any]:
+    """Parses and mines one chunk in a pool process.
+
+    Template ids in the result are local to the process, `templates` maps them to the template text.
+    """
+    path, start, end, __ = chunk
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = mm[start:end].decode('utf-8', errors='replace')
+
+    asctimes, services, levels, msgs, session_keys, repeats = [], [], [], [], [], []
+    for line in data.split('\n'):
+        parts = line.split(SEPARATOR, 4)
+        if len(parts) == 5 and ASCTIME_RE.fullmatch(parts[0]) is not None:
+            asctimes.append(parts[0])
+            services.append(parts[1])
+            session_keys.append(int(parts[2]) if parts[2].isdigit() else -1)
+            levels.append(parts[3])
+            msgs.append(parts[4])
+            repeats.append(1)
+        elif len(msgs) != 0 and line != '':
+            # continuation of a multi-line message (e.g. a traceback).
+            msgs[-1] += '\n' + line
+
+    template_ids = np.empty(len(msgs), dtype=np.int32)
+    phones: List[Tuple[int, str]] = []
+    for i, msg in enumerate(msgs):
+        repeat = REPEAT_SUFFIX_RE.search(msg)
+        if repeat is not None:
+            msg = msg[:repeat.start()]
+            repeats[i] = int(repeat.group(1))
+        template_id, params = _miner.add(msg)
+        template_ids[i] = template_id
+        for param in params:
+            if AnomalyDetector.PHONE_RE.fullmatch(param) is not None:
+                phones.append((i, param))
+
+    return {
+        'ts_ns': _to_ts_ns(asctimes) if len(asctimes) != 0 else np.empty(0, dtype=np.int64),
+        'service': np.array(services, dtype=object),
+        'levelname': np.array(levels, dtype=object),
+        'template_id': template_ids,
+        'session_key': np.array(session_keys, dtype=np.int64),
+        'repeat': np.array(repeats, dtype=np.int64),
+        'phones': phones,
+        'templates': {template_id: str(_miner.template(template_id)) for template_id in set(template_ids.tolist())},
+    }
+
+
+class LogReplay:
+    """Offline run of the analysis pipeline over log files written by the services' FileHandler.
+
+    Files are mmap-ed and cut into line-aligned chunks that a process pool parses and mines in parallel.
+    Pool processes mine templates locally, the results are mapped to global templates here and fed to one
+    AnomalyDetector in timestamp order: chunks are handed out by their first timestamp, so a record is safe
+    to feed once it is older than the first timestamp of every chunk not yet received.
+    """
+
+    def __init__(self, cfg: dict, logger: logging.Logger, jobs: int = 0, chunk_bytes: int = 4 * 1024 * 1024):
+        self.__cfg = cfg
+        self.__logger = logger
+        self.__jobs = jobs if jobs > 0 else os.cpu_count()
+        self.__chunk_bytes = chunk_bytes
+
+        self.__templates_cfg = self.__cfg.get('templates', {})
+        self.__template_miner = TemplateMiner.from_config(self.__templates_cfg)
+        self.__detector = AnomalyDetector.from_config(self.__cfg.get('detector', {}))
+        self.__bucket_ns = self.__cfg.get('detector', {}).get('bucket_s', 10) * 10 ** 9
+
+        self.__records = 0
+        self.__last_ts_ns = 0
+
+    @staticmethod
+    def find_files(paths: List[str]) -> List[str]:
+        # rotated files (x.log.2, x.log.1) come before the live one (x.log).
+        def rotation(path: str) -> Tuple[str, int]:
+            base, __, suffix = path.rpartition('.log.')
+            if base != '' and suffix.isdigit():
+                return base, -int(suffix)
+            return path[:-len('.log')] if path.endswith('.log') else path, 0
+
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(glob.glob(os.path.join(path, '*.log')))
+                files.extend(glob.glob(os.path.join(path, '*.log.[0-9]*')))
+            else:
+                files.append(path)
+        return sorted(files, key=rotation)
+
+    def split(self, path: str) -> List[Chunk]:
+        chunks = []
+        size = os.path.getsize(path)
+        if size == 0:
+            return chunks
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while start < size:
+                end = mm.find(b'\n', min(start + self.__chunk_bytes, size) - 1)
+                end = size if end < 0 else end + 1
+                first = ASCTIME_BYTES_RE.search(mm, start, min(end, start + 64 * 1024))
+                if first is not None:
+                    first_ts_ns = int(_to_ts_ns([first.group().decode()])[0])
+                    chunks.append((path, start, end, first_ts_ns))
+                elif len(chunks) != 0:
+                    # no record starts here, only continuation lines of the previous chunk.
+                    prev_path, prev_start, __, prev_ts_ns = chunks.pop()
+                    chunks.append((prev_path, prev_start, end, prev_ts_ns))
+                start = end
+        return chunks
+
+    def run(self, paths: List[str], out: str) -> None:
+        files = self.find_files(paths)
+        chunks = [chunk for path in files for chunk in self.split(path)]
+        # rotated files of one service follow each other, so ordering by the first timestamp keeps every
+        # file's chunks in file order.
+        chunks.sort(key=lambda chunk: chunk[3])
+        self.__logger.info('replaying {} files in {} chunks with {} processes'.format(len(files), len(chunks),
+                                                                                      self.__jobs),
+                           extra={'session_key': "???"})
+
+        start = time.monotonic()
+        pending: Optional[Dict[str, np.ndarray]] = None
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(self.__jobs, initializer=_init_worker, initargs=(self.__templates_cfg,)) as pool:
+            for i, result in enumerate(pool.imap(_parse_chunk, chunks)):
+                pending = self.__merge(pending, self.__to_global(result))
+                watermark = chunks[i + 1][3] if i + 1 < len(chunks) else None
+                pending = self.__feed(pending, watermark)
+
+        if self.__records != 0:
+            # closes the last bucket.
+            self.__detector.tick(self.__last_ts_ns + 2 * self.__bucket_ns)
+        elapsed = time.monotonic() - start
+
+        os.makedirs(out, exist_ok=True)
+        self.__template_miner.save(os.path.join(out, 'templates.json'))
+        alerts = [self.__describe(alert) for alert in self.__detector.alerts()]
+        with open(os.path.join(out, 'alerts.json'), 'w') as f:
+            for alert in alerts:
+                f.write(json.dumps(alert) + '\n')
+        self.__logger.info('replayed {} records in {:.1f} s: {} templates, {} alerts, results in {}'.format(
+            self.__records, elapsed, len(self.__template_miner.templates()), len(alerts), out),
+            extra={'session_key': "???"})
+
+    def __to_global(self, result: Mapping[str, Any]) -> Dict[str, np.ndarray]:
+        global_ids = {template_id: self.__template_miner.add(template)[0]
+                      for template_id, template in result['templates'].items()}
+        columns = {column: result[column] for column in COLUMNS}
+        columns['template_id'] = np.array([global_ids[template_id] for template_id in result['template_id'].tolist()],
+                                          dtype=np.int32)
+        phones = np.empty(len(columns['ts_ns']), dtype=object)
+        for i, param in result['phones']:
+            phones[i] = [param] if phones[i] is None else phones[i] + [param]
+        columns['params'] = phones
+        return columns
+
+    @staticmethod
+    def __merge(pending: Optional[Dict[str, np.ndarray]], columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        if pending is not None:
+            columns = {column: np.concatenate((pending[column], columns[column])) for column in columns}
+        order = np.argsort(columns['ts_ns'], kind='stable')
+        return {column: values[order] for column, values in columns.items()}
+
+    def __feed(self, pending: Dict[str, np.ndarray], watermark: Optional[int]) -> Dict[str, np.ndarray]:
+        n = len(pending['ts_ns']) if watermark is None else int(np.searchsorted(pending['ts_ns'], watermark))
+        for ts_ns, service, levelname, template_id, session_key, repeat, params in zip(
+                pending['ts_ns'][:n].tolist(), pending['service'][:n], pending['levelname'][:n],
+                pending['template_id'][:n].tolist(), pending['session_key'][:n].tolist(),
+                pending['repeat'][:n].tolist(), pending['params'][:n]):
+            self.__detector.add({
+                'ts_ns': ts_ns,
+                'service': service,
+                'levelname': levelname,
+                'template_id': template_id,
+                'session_key': session_key if session_key >= 0 else None,
+                'repeat': repeat,
+                'params': params if params is not None else (),
+            })
+        if n != 0:
+            self.__records += n
+            self.__last_ts_ns = int(pending['ts_ns'][n - 1])
+        return {column: values[n:] for column, values in pending.items()}
+
+    def __describe(self, alert: Mapping[str, Any]) -> Mapping[str, Any]:
+        if 'template_id' in alert:
+            alert = dict(alert)
+            alert['template'] = str(self.__template_miner.template(alert['template_id']))
+        return alert
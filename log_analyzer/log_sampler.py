@@ -0,0 +1,73 @@
+import random
+from typing import Any, Dict, Mapping, Tuple
+
+SampleKey = Tuple[str, str, int]
+
+
+class LogSampler:
+    """Load-adaptive sampling of the ingest stream.
+
+    While the work queue is below `watermark` every record is kept. Above it WARNING+ records are still
+    always kept, DEBUG/INFO records are sampled by the frequency of their (service, level, template) key:
+    the first `per_template` records of a key in a window of `window_ms` are kept, frequent keys are thinned
+    to about that many, and the budget shrinks towards one record per window as the queue fills up. So rare
+    messages survive and the noisy ones pay for the overload.
+
+    Nothing is lost for rates: the next kept record of a key carries the number of records it stands for
+    (itself plus the ones sampled away before it, a collapsed record counting `repeat` times) as
+    `sample_weight`, summing it over a query gives the original count.
+    """
+
+    ALWAYS_KEEP = ('WARNING', 'ERROR', 'CRITICAL')
+
+    def __init__(self, watermark: float = 0.5, per_template: int = 100, window_ms: int = 1000):
+        self.__watermark = watermark
+        self.__per_template = per_template
+        self.__window_ns = window_ms * 10 ** 6
+
+        self.__window = 0
+        self.__counts: Dict[SampleKey, int] = {}
+        # records sampled away since the last kept record of a key.
+        self.__pending: Dict[SampleKey, int] = {}
+
+        self.__sampled_away: Dict[str, int] = {}
+
+    @classmethod
+    def from_config(cls, ingest_cfg: dict) -> 'LogSampler':
+        watermark = ingest_cfg.get('sample_watermark', 0.5)
+        # the budget shrinks over (watermark, 1], which must not be empty.
+        if not 0.0 <= watermark < 1.0:
+            raise ValueError('sample_watermark must be in [0, 1), got {}'.format(watermark))
+        return cls(watermark=watermark,
+                   per_template=ingest_cfg.get('sample_per_template', 100),
+                   window_ms=ingest_cfg.get('sample_window_ms', 1000))
+
+    def stats(self) -> Mapping[str, Any]:
+        return {
+            'sampled_away': dict(self.__sampled_away),
+            'pending': sum(self.__pending.values()),
+        }
+
+    def sample(self, record: Mapping[str, Any], load: float, now_ns: int) -> int:
+        """Returns the weight of a kept record, 0 if the record is sampled away."""
+        levelname = record['levelname']
+        key = (record['service'], levelname, record['template_id'])
+        # a collapsed record (see utils.log_filters) stands for `repeat` records.
+        weight = record.get('repeat') or 1
+        pending = self.__pending.pop(key, 0)
+        if levelname in self.ALWAYS_KEEP or load < self.__watermark:
+            return weight + pending
+
+        window = now_ns // self.__window_ns
+        if window != self.__window:
+            self.__window = window
+            self.__counts.clear()
+        n = self.__counts.get(key, 0) + 1
+        self.__counts[key] = n
+
+        budget = max(1, int(self.__per_template * (1.0 - load) / (1.0 - self.__watermark)))
+        if n <= budget or random.random() * n < budget:
+            return weight + pending
+        self.__pending[key] = pending + weight
+        self.__sampled_away[levelname] = self.__sampled_away.get(levelname, 0) + weight
+        return 0
@@ -0,0 +1,350 @@
+import json
+import mmap
+import os
+import struct
+import time
+from typing import Any, Iterator, List, Mapping, Optional, Tuple
+
+
+class Segment:
+    """One append-only data file plus its sparse time index.
+
+    Data file: sequence of records, each is a RECORD_HEADER (payload length, ts_ns) followed by JSON payload.
+    Index file: one INDEX_ENTRY (block offset, block length, min ts_ns, max ts_ns) per ~index_interval_bytes
+    of data, so a time-range scan only touches blocks whose [min, max] overlaps the range.
+    Records may arrive slightly out of order, that is why every block keeps both bounds.
+    """
+
+    RECORD_HEADER = struct.Struct('<IQ')
+    INDEX_ENTRY = struct.Struct('<QQQQ')
+
+    DATA_SUFFIX = '.seg'
+    INDEX_SUFFIX = '.idx'
+
+    def __init__(self, path: str, seq: int, index_interval_bytes: int):
+        self.seq = seq
+        self.data_path = os.path.join(path, '{:010d}{}'.format(seq, self.DATA_SUFFIX))
+        self.index_path = os.path.join(path, '{:010d}{}'.format(seq, self.INDEX_SUFFIX))
+
+        self.__index_interval_bytes = index_interval_bytes
+
+        # sealed blocks: (offset, length, min_ts, max_ts).
+        self.blocks: List[Tuple[int, int, int, int]] = []
+        self.min_ts: Optional[int] = None
+        self.max_ts: Optional[int] = None
+        self.size = 0
+        self.created = time.time()
+
+        self.__block_offset = 0
+        self.__block_min_ts: Optional[int] = None
+        self.__block_max_ts: Optional[int] = None
+
+        self.__data_f = None
+        self.__index_f = None
+
+    def load(self, read_only: bool = False) -> None:
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                buf = f.read()
+            n = len(buf) // self.INDEX_ENTRY.size
+            for i in range(n):
+                self.blocks.append(self.INDEX_ENTRY.unpack_from(buf, i * self.INDEX_ENTRY.size))
+        self.size = os.path.getsize(self.data_path)
+        for __, __, lo, hi in self.blocks:
+            self.__update_bounds(lo, hi)
+        self.__block_offset = self.blocks[-1][0] + self.blocks[-1][1] if len(self.blocks) != 0 else 0
+        # the tail after the last index entry has no index yet (crash or active segment), rebuild its bounds.
+        valid = self.__block_offset
+        for offset, ts, payload in self.__iter_ranges([(self.__block_offset, self.size)]):
+            self.__add_to_block(ts)
+            valid = offset + self.RECORD_HEADER.size + len(payload)
+        self.created = self.min_ts / 1e9 if self.min_ts is not None else os.path.getmtime(self.data_path)
+        if valid < self.size and not read_only:
+            # drop a partially written record left by a crash.
+            with open(self.data_path, 'r+b') as f:
+                f.truncate(valid)
+            self.size = valid
+
+    def open_for_append(self) -> None:
+        self.__data_f = open(self.data_path, 'ab')
+        self.__index_f = open(self.index_path, 'ab')
+
+    def append(self, ts: int, payload: bytes) -> int:
+        offset = self.size
+        self.__data_f.write(self.RECORD_HEADER.pack(len(payload), ts))
+        self.__data_f.write(payload)
+        self.size += self.RECORD_HEADER.size + len(payload)
+        self.__add_to_block(ts)
+        if self.size - self.__block_offset >= self.__index_interval_bytes:
+            self.__seal_block()
+        return offset
+
+    def flush(self) -> None:
+        if self.__data_f is not None:
+            self.__data_f.flush()
+            self.__index_f.flush()
+
+    def seal(self) -> None:
+        if self.__data_f is None:
+            return
+        self.__seal_block()
+        self.__data_f.close()
+        self.__index_f.close()
+        self.__data_f = None
+        self.__index_f = None
+
+    def remove(self) -> None:
+        self.seal()
+        for path in (self.data_path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def overlaps(self, start_ns: int, end_ns: int) -> bool:
+        return self.min_ts is not None and self.min_ts <= end_ns and self.max_ts >= start_ns
+
+    def scan(self, start_ns: int, end_ns: int) -> Iterator[Tuple[int, Mapping[str, Any]]]:
+        self.flush()
+        ranges = [(off, off + length) for off, length, lo, hi in self.blocks if lo <= end_ns and hi >= start_ns]
+        if self.__block_min_ts is not None and self.__block_min_ts <= end_ns and self.__block_max_ts >= start_ns:
+            ranges.append((self.__block_offset, self.size))
+        for offset, ts, payload in self.__iter_ranges(ranges):
+            if start_ns <= ts <= end_ns:
+                yield offset, json.loads(payload)
+
+    def read_at(self, offset: int) -> Optional[Mapping[str, Any]]:
+        self.flush()
+        for __, __, payload in self.__iter_ranges([(offset, offset + 1)]):
+            return json.loads(payload)
+        return None
+
+    def iter_offsets(self, offsets: List[int]) -> Iterator[Tuple[int, Mapping[str, Any]]]:
+        self.flush()
+        for offset, __, payload in self.__iter_ranges([(offset, offset + 1) for offset in offsets]):
+            yield offset, json.loads(payload)
+
+    def __iter_ranges(self, ranges: List[Tuple[int, int]]) -> Iterator[Tuple[int, int, bytes]]:
+        # yields (offset, ts, payload) for every record starting in one of [begin, end) ranges.
+        if len(ranges) == 0:
+            return
+        try:
+            f = open(self.data_path, 'rb')
+        except FileNotFoundError:
+            # segment of a read-only store removed by retention of its owner.
+            return
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with mm:
+                limit = len(mm)
+                for begin, end in ranges:
+                    offset = begin
+                    while offset < end and offset + self.RECORD_HEADER.size <= limit:
+                        length, ts = self.RECORD_HEADER.unpack_from(mm, offset)
+                        payload_end = offset + self.RECORD_HEADER.size + length
+                        if payload_end > limit:
+                            break
+                        yield offset, ts, mm[offset + self.RECORD_HEADER.size:payload_end]
+                        offset = payload_end
+
+    def __update_bounds(self, lo: int, hi: int) -> None:
+        self.min_ts = lo if self.min_ts is None else min(self.min_ts, lo)
+        self.max_ts = hi if self.max_ts is None else max(self.max_ts, hi)
+
+    def __add_to_block(self, ts: int) -> None:
+        self.__block_min_ts = ts if self.__block_min_ts is None else min(self.__block_min_ts, ts)
+        self.__block_max_ts = ts if self.__block_max_ts is None else max(self.__block_max_ts, ts)
+        self.__update_bounds(ts, ts)
+
+    def __seal_block(self) -> None:
+        if self.__block_min_ts is None:
+            return
+        entry = (self.__block_offset, self.size - self.__block_offset, self.__block_min_ts, self.__block_max_ts)
+        self.blocks.append(entry)
+        if self.__index_f is not None:
+            self.__index_f.write(self.INDEX_ENTRY.pack(*entry))
+        self.__block_offset = self.size
+        self.__block_min_ts = None
+        self.__block_max_ts = None
+
+
+class LogStorage:
+    """Append-only segmented log store with size/time rollover and age/size retention.
+
+    A read-only store is a snapshot of a store owned by another process (e.g. another analyzer worker),
+    refresh() catches it up with the owner.
+    """
+
+    def __init__(self, path: str, segment_max_bytes: int = 64 * 1024 * 1024, segment_max_age_s: int = 3600,
+                 index_interval_bytes: int = 4096, retention_age_s: int = 7 * 24 * 3600,
+                 retention_bytes: int = 10 * 1024 * 1024 * 1024, read_only: bool = False):
+        self.path = path
+        self.__segment_max_bytes = segment_max_bytes
+        self.__segment_max_age_s = segment_max_age_s
+        self.__index_interval_bytes = index_interval_bytes
+        self.__retention_age_ns = retention_age_s * 10 ** 9
+        self.__retention_bytes = retention_bytes
+        self.read_only = read_only
+
+        if not self.read_only:
+            os.makedirs(self.path, exist_ok=True)
+
+        self.__segments: List[Segment] = []
+        for name in sorted(os.listdir(self.path)) if os.path.isdir(self.path) else []:
+            if not name.endswith(Segment.DATA_SUFFIX):
+                continue
+            segment = Segment(self.path, int(name[:-len(Segment.DATA_SUFFIX)]), self.__index_interval_bytes)
+            try:
+                segment.load(read_only)
+            except FileNotFoundError:
+                # removed by retention of the owner while we were listing.
+                continue
+            self.__segments.append(segment)
+
+        if not self.read_only:
+            if len(self.__segments) == 0:
+                self.__roll()
+            else:
+                self.__segments[-1].open_for_append()
+
+        self.__appended = 0
+        self.__removed_segments = 0
+
+    @classmethod
+    def from_config(cls, storage_cfg: dict, path: str, read_only: bool = False) -> 'LogStorage':
+        return cls(path,
+                   segment_max_bytes=storage_cfg.get('segment_max_bytes', 64 * 1024 * 1024),
+                   segment_max_age_s=storage_cfg.get('segment_max_age_s', 3600),
+                   index_interval_bytes=storage_cfg.get('index_interval_bytes', 4096),
+                   retention_age_s=storage_cfg.get('retention_age_s', 7 * 24 * 3600),
+                   retention_bytes=storage_cfg.get('retention_bytes', 10 * 1024 * 1024 * 1024),
+                   read_only=read_only)
+
+    def stats(self) -> Mapping[str, int]:
+        return {
+            'segments': len(self.__segments),
+            'bytes': sum(segment.size for segment in self.__segments),
+            'appended': self.__appended,
+            'removed_segments': self.__removed_segments,
+        }
+
+    def append(self, record: Mapping[str, Any]) -> Tuple[int, int]:
+        active = self.__segments[-1]
+        if active.size >= self.__segment_max_bytes or \
+                (active.size != 0 and time.time() - active.created >= self.__segment_max_age_s):
+            active = self.__roll()
+        payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        offset = active.append(record['ts_ns'], payload)
+        self.__appended += 1
+        return active.seq, offset
+
+    def scan(self, start_ns: int, end_ns: int) -> Iterator[Mapping[str, Any]]:
+        for __, __, record in self.scan_with_offsets(start_ns, end_ns):
+            yield record
+
+    def scan_with_offsets(self, start_ns: int, end_ns: int,
+                          min_seq: int = 0) -> Iterator[Tuple[int, int, Mapping[str, Any]]]:
+        for segment in list(self.__segments):
+            if segment.seq < min_seq or not segment.overlaps(start_ns, end_ns):
+                continue
+            for offset, record in segment.scan(start_ns, end_ns):
+                yield segment.seq, offset, record
+
+    def scan_segment(self, seq: int, start_ns: int, end_ns: int) -> Iterator[Tuple[int, Mapping[str, Any]]]:
+        segment = self.__find(seq)
+        if segment is None or not segment.overlaps(start_ns, end_ns):
+            return iter(())
+        return segment.scan(start_ns, end_ns)
+
+    def segments(self) -> List[Tuple[int, Optional[int], Optional[int]]]:
+        return [(segment.seq, segment.min_ts, segment.max_ts) for segment in self.__segments]
+
+    def read_at(self, seq: int, offset: int) -> Optional[Mapping[str, Any]]:
+        segment = self.__find(seq)
+        if segment is None:
+            return None
+        return segment.read_at(offset)
+
+    def read_many(self, seq: int, offsets: List[int]) -> Iterator[Tuple[int, Mapping[str, Any]]]:
+        segment = self.__find(seq)
+        if segment is None:
+            return iter(())
+        return segment.iter_offsets(offsets)
+
+    def refresh(self) -> None:
+        """Loads the segments of a read-only store its owner rolled or appended to since, drops removed ones.
+
+        Only segments that are new, or the last one if it grew, are read again: older ones are sealed.
+        """
+        if not self.read_only:
+            return
+        names = sorted(os.listdir(self.path)) if os.path.isdir(self.path) else []
+        last = self.__segments[-1].seq if len(self.__segments) != 0 else None
+        known = {segment.seq: segment for segment in self.__segments}
+        segments = []
+        for name in names:
+            if not name.endswith(Segment.DATA_SUFFIX):
+                continue
+            seq = int(name[:-len(Segment.DATA_SUFFIX)])
+            segment = known.get(seq)
+            try:
+                if segment is not None and (seq != last or os.path.getsize(segment.data_path) == segment.size):
+                    segments.append(segment)
+                    continue
+                segment = Segment(self.path, seq, self.__index_interval_bytes)
+                segment.load(read_only=True)
+            except FileNotFoundError:
+                # removed by retention of the owner while we were listing.
+                continue
+            segments.append(segment)
+        self.__segments = segments
+
+    def has_segment(self, seq: int) -> bool:
+        return self.__find(seq) is not None
+
+    def flush(self) -> None:
+        if not self.read_only:
+            self.__segments[-1].flush()
+
+    def close(self) -> None:
+        if not self.read_only:
+            self.__segments[-1].seal()
+
+    def enforce_retention(self) -> List[int]:
+        removed = []
+        now_ns = time.time_ns()
+        total = sum(segment.size for segment in self.__segments)
+        # the active segment is never removed.
+        while len(self.__segments) > 1:
+            oldest = self.__segments[0]
+            expired = oldest.max_ts is None or oldest.max_ts < now_ns - self.__retention_age_ns
+            if not expired and total <= self.__retention_bytes:
+                break
+            total -= oldest.size
+            oldest.remove()
+            self.__segments.pop(0)
+            removed.append(oldest.seq)
+        self.__removed_segments += len(removed)
+        return removed
+
+    def __find(self, seq: int) -> Optional[Segment]:
+        lo, hi = 0, len(self.__segments)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__segments[mid].seq < seq:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.__segments) and self.__segments[lo].seq == seq:
+            return self.__segments[lo]
+        return None
+
+    def __roll(self) -> Segment:
+        seq = 0
+        if len(self.__segments) != 0:
+            self.__segments[-1].seal()
+            seq = self.__segments[-1].seq + 1
+        segment = Segment(self.path, seq, self.__index_interval_bytes)
+        segment.open_for_append()
+        self.__segments.append(segment)
+        return segment
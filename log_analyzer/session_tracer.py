@@ -0,0 +1,138 @@
+import collections
+from typing import Any, Callable, List, Mapping, Optional, Tuple
+
+# (ts_ns, service, levelname, route, template_id, upstream_host, upstream_port, duration_ms)
+Event = Tuple[int, str, str, Optional[str], int, Optional[str], Optional[int], Optional[float]]
+
+
+class SessionTrace:
+    __slots__ = ('session_key', 'events', 'first_ts', 'last_ts', 'last_seen_ns', 'truncated')
+
+    def __init__(self, session_key: int):
+        self.session_key = session_key
+        self.events: List[Event] = []
+        self.first_ts = 0
+        self.last_ts = 0
+        self.last_seen_ns = 0
+        self.truncated = False
+
+    def summary(self) -> Mapping[str, Any]:
+        # the other fields may be None, which does not compare with anything.
+        events = sorted(self.events, key=lambda e: e[0])
+        return {
+            'ts_ns': self.first_ts,
+            'end_ts_ns': self.last_ts,
+            'session_key': self.session_key,
+            'services': sorted({e[1] for e in events}),
+            'events': len(events),
+            'truncated': self.truncated,
+            'requests': self.__hops(events),
+        }
+
+    @staticmethod
+    def __hops(events: List[Event]) -> List[Mapping[str, Any]]:
+        # every hop logs its upstream call duration when the call returns, so the call spans
+        # [ts - duration, ts]; a DB call of MNP nests into the balancer call that contains it.
+        db_calls = [(ts - int(duration * 1e6), ts, duration, host, port)
+                    for ts, service, __, __, __, host, port, duration in events
+                    if service == 'mnp' and duration is not None]
+        requests = []
+        for ts, service, __, route, __, host, port, duration in events:
+            if service != 'balancer' or duration is None:
+                continue
+            start = ts - int(duration * 1e6)
+            db_ms = 0.0
+            db = None
+            for db_start, db_end, db_duration, db_host, db_port in db_calls:
+                if start <= db_start and db_end <= ts:
+                    db_ms += db_duration
+                    db = '{}:{}'.format(db_host, db_port)
+            requests.append({
+                'ts_ns': start,
+                'route': route,
+                'mnp': '{}:{}'.format(host, port),
+                'database': db,
+                'total_ms': duration,
+                'balancer_to_mnp_ms': duration - db_ms,
+                'mnp_to_db_ms': db_ms,
+            })
+        return requests
+
+
+class SessionTracer:
+    """Stitches records of all services into per-session timelines as they arrive.
+
+    Sessions live in an LRU ordered by last activity and are flushed (as a timeline summary with per-hop
+    latencies) after `ttl_s` of idleness, or earlier when the table holds more than `max_sessions`.
+    """
+
+    def __init__(self, flush: Callable[[Mapping[str, Any]], None], ttl_s: int = 300,
+                 max_sessions: int = 100000, max_events: int = 1000):
+        self.__flush = flush
+        self.__ttl_ns = ttl_s * 10 ** 9
+        self.__max_sessions = max_sessions
+        self.__max_events = max_events
+
+        self.__sessions: 'collections.OrderedDict[int, SessionTrace]' = collections.OrderedDict()
+
+        self.__flushed = 0
+        self.__evicted = 0
+
+    @classmethod
+    def from_config(cls, sessions_cfg: dict, flush: Callable[[Mapping[str, Any]], None]) -> 'SessionTracer':
+        return cls(flush,
+                   ttl_s=sessions_cfg.get('ttl_s', 300),
+                   max_sessions=sessions_cfg.get('max_sessions', 100000),
+                   max_events=sessions_cfg.get('max_events', 1000))
+
+    def stats(self) -> Mapping[str, int]:
+        return {
+            'active': len(self.__sessions),
+            'flushed': self.__flushed,
+            'evicted': self.__evicted,
+        }
+
+    def get(self, session_key: int) -> Optional[SessionTrace]:
+        return self.__sessions.get(session_key)
+
+    def add(self, record: Mapping[str, Any], now_ns: int) -> None:
+        session_key = record['session_key']
+        if session_key is None:
+            return
+        trace = self.__sessions.get(session_key)
+        if trace is None:
+            trace = self.__sessions[session_key] = SessionTrace(session_key)
+            trace.first_ts = record['ts_ns']
+        else:
+            self.__sessions.move_to_end(session_key)
+        trace.last_seen_ns = now_ns
+        trace.first_ts = min(trace.first_ts, record['ts_ns'])
+        trace.last_ts = max(trace.last_ts, record['ts_ns'])
+        if len(trace.events) < self.__max_events:
+            trace.events.append((record['ts_ns'], record['service'], record['levelname'], record['route'],
+                                 record['template_id'], record['upstream_host'], record['upstream_port'],
+                                 record['duration_ms']))
+        else:
+            trace.truncated = True
+
+        while len(self.__sessions) > self.__max_sessions:
+            __, oldest = self.__sessions.popitem(last=False)
+            self.__evicted += 1
+            self.__flush_trace(oldest)
+
+    def expire(self, now_ns: int) -> None:
+        while len(self.__sessions) != 0:
+            oldest = next(iter(self.__sessions.values()))
+            if now_ns - oldest.last_seen_ns < self.__ttl_ns:
+                break
+            self.__sessions.popitem(last=False)
+            self.__flush_trace(oldest)
+
+    def flush_all(self) -> None:
+        while len(self.__sessions) != 0:
+            __, oldest = self.__sessions.popitem(last=False)
+            self.__flush_trace(oldest)
+
+    def __flush_trace(self, trace: SessionTrace) -> None:
+        self.__flushed += 1
+        self.__flush(trace.summary())
@@ -0,0 +1,197 @@
+import collections
+import json
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+WILDCARD = '<*>'
+
+
+class Template:
+    def __init__(self, template_id: int, tokens: List[str], path: List[str]):
+        self.id = template_id
+        self.tokens = tokens
+        # keys of the tree nodes down to its leaf, taken by the message that made it; the tokens may be more
+        # general by now.
+        self.path = path
+        self.count = 0
+        # id assigned by the aggregator of a multi-worker analyzer.
+        self.global_id: Optional[int] = None
+
+    def __str__(self):
+        return ' '.join(self.tokens)
+
+
+class Node:
+    __slots__ = ('children', 'templates')
+
+    def __init__(self):
+        self.children: Dict[str, 'Node'] = {}
+        self.templates: List[Template] = []
+
+
+class TemplateMiner:
+    """Online log template miner (Drain).
+
+    Messages are routed through a fixed-depth prefix tree (token count, then the first `depth - 2` tokens)
+    to a leaf with a handful of templates, and joined to the most similar one. Repeated message shapes skip
+    the tree entirely through an LRU of recently matched shapes.
+    """
+
+    # tokens with digits are almost always parameters (ports, phone numbers, session keys, ...).
+    PARAM_RE = re.compile(r'\d')
+
+    def __init__(self, depth: int = 4, sim_th: float = 0.5, max_children: int = 100, lru_size: int = 10000):
+        self.__depth = max(depth, 3)
+        self.__sim_th = sim_th
+        self.__max_children = max_children
+        self.__lru_size = lru_size
+
+        self.__root = Node()
+        self.__templates: List[Template] = []
+        self.__lru: 'collections.OrderedDict[Tuple[str, ...], Template]' = collections.OrderedDict()
+
+        self.__lru_hits = 0
+        self.__tree_matches = 0
+
+    @classmethod
+    def from_config(cls, templates_cfg: dict) -> 'TemplateMiner':
+        return cls(depth=templates_cfg.get('depth', 4),
+                   sim_th=templates_cfg.get('sim_th', 0.5),
+                   max_children=templates_cfg.get('max_children', 100),
+                   lru_size=templates_cfg.get('lru_size', 10000))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'templates': len(self.__templates),
+            'lru_size': len(self.__lru),
+            'lru_hits': self.__lru_hits,
+            'tree_matches': self.__tree_matches,
+        }
+
+    def template(self, template_id: int) -> Optional[Template]:
+        if 0 <= template_id < len(self.__templates):
+            return self.__templates[template_id]
+        return None
+
+    def templates(self) -> List[Template]:
+        return list(self.__templates)
+
+    def set_global_id(self, template_id: int, global_id: int) -> None:
+        template = self.template(template_id)
+        if template is not None:
+            template.global_id = global_id
+
+    def local_ids(self) -> Dict[int, List[int]]:
+        return self.__local_ids([(t.id, t.global_id) for t in self.__templates])
+
+    @classmethod
+    def load_local_ids(cls, path: str) -> Dict[int, List[int]]:
+        # global id -> local ids of the templates saved by another worker.
+        try:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        return cls.__local_ids([(t['id'], t.get('global_id')) for t in saved])
+
+    @staticmethod
+    def __local_ids(ids: List[Tuple[int, Optional[int]]]) -> Dict[int, List[int]]:
+        res: Dict[int, List[int]] = {}
+        for local_id, global_id in ids:
+            if global_id is not None:
+                res.setdefault(global_id, []).append(local_id)
+        return res
+
+    def add(self, msg: str) -> Tuple[int, List[str]]:
+        tokens = tuple(msg.split())
+        shape = tuple(WILDCARD if self.PARAM_RE.search(tok) else tok for tok in tokens)
+
+        template = self.__lru.get(shape)
+        if template is not None:
+            # templates only ever get more general, so a cached match stays valid.
+            self.__lru.move_to_end(shape)
+            self.__lru_hits += 1
+        else:
+            template = self.__tree_add(shape)
+            self.__tree_matches += 1
+            self.__lru[shape] = template
+            if len(self.__lru) > self.__lru_size:
+                self.__lru.popitem(last=False)
+
+        template.count += 1
+        return template.id, [tok for t, tok in zip(template.tokens, tokens) if t == WILDCARD]
+
+    def save(self, path: str) -> None:
+        # the cached shapes go along: wildcards do not count as similar, so the tree alone can miss the template
+        # a shape has been matched to.
+        shapes: Dict[int, List[Tuple[str, ...]]] = {}
+        for shape, template in self.__lru.items():
+            shapes.setdefault(template.id, []).append(shape)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump([{'id': t.id, 'tokens': t.tokens, 'path': t.path, 'shapes': shapes.get(t.id, []),
+                        'count': t.count, 'global_id': t.global_id}
+                       for t in self.__templates], f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> None:
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as f:
+            saved = json.load(f)
+        for t in sorted(saved, key=lambda t: t['id']):
+            # files saved without paths place templates by their tokens.
+            path = t.get('path')
+            if path is None:
+                __, path = self.__leaf(tuple(t['tokens']))
+            template = Template(len(self.__templates), t['tokens'], path)
+            template.count = t['count']
+            template.global_id = t.get('global_id')
+            self.__templates.append(template)
+            # the leaf add() reaches with the messages of the template, whatever the tree looks like now.
+            node = self.__root
+            for key in path:
+                node = node.children.setdefault(key, Node())
+            node.templates.append(template)
+            for shape in t.get('shapes', []):
+                self.__lru[tuple(shape)] = template
+        while len(self.__lru) > self.__lru_size:
+            self.__lru.popitem(last=False)
+
+    def __leaf(self, shape: Tuple[str, ...]) -> Tuple[Node, List[str]]:
+        path = [str(len(shape))]
+        node = self.__root.children.setdefault(path[0], Node())
+        for tok in shape[:self.__depth - 2]:
+            child = node.children.get(tok)
+            if child is None:
+                if len(node.children) >= self.__max_children:
+                    tok = WILDCARD
+                child = node.children.setdefault(tok, Node())
+            path.append(tok)
+            node = child
+        return node, path
+
+    def __tree_add(self, shape: Tuple[str, ...]) -> Template:
+        leaf, path = self.__leaf(shape)
+
+        best, best_sim, best_wildcards = None, -1.0, -1
+        for template in leaf.templates:
+            same, wildcards = 0, 0
+            for t, tok in zip(template.tokens, shape):
+                if t == WILDCARD:
+                    wildcards += 1
+                elif t == tok:
+                    same += 1
+            sim = same / len(shape) if len(shape) != 0 else 1.0
+            if sim > best_sim or (sim == best_sim and wildcards > best_wildcards):
+                best, best_sim, best_wildcards = template, sim, wildcards
+
+        if best is not None and (best_sim >= self.__sim_th or len(shape) == 0):
+            best.tokens = [t if t == tok else WILDCARD for t, tok in zip(best.tokens, shape)]
+            return best
+
+        template = Template(len(self.__templates), list(shape), path)
+        self.__templates.append(template)
+        leaf.templates.append(template)
+        return template
@@ -0,0 +1,127 @@
+import unittest
+from typing import Any, List, Mapping
+
+from log_analyzer.anomaly_detector import AnomalyDetector, CountMinSketch
+
+BUCKET_NS = 10 ** 9
+
+
+def record(bucket: int, template_id: int = 1, session_key: int = None, params: List[str] = (),
+           **fields) -> Mapping[str, Any]:
+    res = {'ts_ns': bucket * BUCKET_NS, 'service': 'mnp', 'levelname': 'INFO', 'template_id': template_id,
+           'session_key': session_key, 'params': list(params)}
+    res.update(fields)
+    return res
+
+
+class CountMinSketchTest(unittest.TestCase):
+    def test_counts_are_never_underestimated(self):
+        sketch = CountMinSketch(64, 4)
+        for key in range(200):
+            for __ in range(key % 5):
+                sketch.add(key)
+        for key in range(200):
+            self.assertGreaterEqual(sketch.estimate(key), key % 5)
+
+    def test_add_returns_the_estimate(self):
+        sketch = CountMinSketch(2048, 4)
+        self.assertEqual([sketch.add('79000000000') for __ in range(3)], [1, 2, 3])
+        self.assertEqual(sketch.estimate('79000000000'), 3)
+        self.assertEqual(sketch.estimate('79000000001'), 0)
+
+    def test_snowflake_keys_do_not_collapse(self):
+        # Snowflake ids of one worker differ only above bit 22, and hash() of an int is the int.
+        sketch = CountMinSketch(2048, 4)
+        keys = [(1700000000000 + i) << 22 for i in range(1000)]
+        for key in keys:
+            sketch.add(key)
+        self.assertLessEqual(max(sketch.estimate(key) for key in keys), 3)
+
+    def test_merge_and_reset(self):
+        first, second = CountMinSketch(256, 4), CountMinSketch(256, 4)
+        first.add(42)
+        second.add(42)
+        second.add(42)
+        first.merge(second.tobytes())
+        self.assertEqual(first.estimate(42), 3)
+        self.assertTrue(first.dirty)
+        first.reset()
+        self.assertFalse(first.dirty)
+        self.assertEqual(first.estimate(42), 0)
+
+
+class AnomalyDetectorTest(unittest.TestCase):
+    def detector(self, **kwargs) -> AnomalyDetector:
+        kwargs.setdefault('bucket_s', 1)
+        kwargs.setdefault('min_count', 5)
+        kwargs.setdefault('warmup_buckets', 3)
+        return AnomalyDetector(**kwargs)
+
+    def feed(self, detector: AnomalyDetector, counts: List[int], template_id: int = 1) -> None:
+        for bucket, count in enumerate(counts):
+            for __ in range(count):
+                detector.add(record(bucket, template_id))
+        # closes the last bucket.
+        detector.tick((len(counts) + 1) * BUCKET_NS)
+
+    def test_burst_over_the_baseline_alerts(self):
+        detector = self.detector()
+        self.feed(detector, [10] * 8 + [100])
+        alerts = detector.take_new_alerts()
+        self.assertEqual([(a['kind'], a['ts_ns'], a['template_id'], a['observed']) for a in alerts],
+                         [('rate_spike', 8 * BUCKET_NS, 1, 100)])
+        self.assertEqual(detector.take_new_alerts(), [])
+        self.assertEqual(detector.alerts(), alerts)
+
+    def test_steady_rate_does_not_alert(self):
+        detector = self.detector()
+        self.feed(detector, [10, 12, 9, 11, 10, 13, 10, 11])
+        self.assertEqual(detector.alerts(), [])
+        self.assertEqual(detector.stats()['closed_buckets'], 8)
+
+    def test_no_alert_during_warmup_or_under_min_count(self):
+        detector = self.detector(warmup_buckets=5)
+        self.feed(detector, [1, 1, 100])
+        self.feed(self.detector(min_count=50), [1] * 8 + [40])
+        self.assertEqual(detector.alerts(), [])
+
+    def test_repeat_counts_as_many_records(self):
+        detector = self.detector()
+        for bucket in range(8):
+            detector.add(record(bucket, repeat=10))
+        detector.add(record(8, repeat=100))
+        detector.tick(10 * BUCKET_NS)
+        self.assertEqual([a['observed'] for a in detector.alerts()], [100])
+
+    def test_heavy_hitters(self):
+        detector = self.detector(heavy_hitter_count=5)
+        for __ in range(6):
+            detector.add(record(0, session_key=7, params=["'79000000000'"]))
+        detector.add(record(0, session_key=8))
+        self.assertCountEqual([(a['kind'], a.get('session_key'), a.get('phone_number'), a['observed'])
+                               for a in detector.alerts()],
+                              [('heavy_hitter', None, '79000000000', 5), ('heavy_hitter', 7, None, 5)])
+
+    def test_workers_merged_alert_like_a_single_detector(self):
+        exports = {}
+        workers = [self.detector(heavy_hitter_count=6, workers=2,
+                                 on_bucket=lambda export: exports.setdefault(export['bucket'], []).append(export))
+                   for __ in range(2)]
+        for bucket in range(9):
+            for i in range(10 if bucket < 8 else 100):
+                # each worker sees the session key 3 times in the last bucket, 6 in total.
+                session_key = 7 if bucket == 8 and i < 6 else None
+                workers[i % 2].add(record(bucket, session_key=session_key))
+        for worker in workers:
+            worker.tick(10 * BUCKET_NS)
+            self.assertEqual(worker.alerts(), [])
+
+        aggregator = self.detector(heavy_hitter_count=6)
+        for bucket in sorted(exports):
+            aggregator.merge(bucket, exports[bucket])
+        self.assertEqual(sorted((a['kind'], a['observed']) for a in aggregator.alerts()),
+                         [('heavy_hitter', 6), ('rate_spike', 100)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+import collections
+import unittest
+from typing import List
+from unittest import mock
+
+from utils.backend_pool import Backend, BackendPool, CircuitBreaker
+
+
+class Clock:
+    """Stands in for time.monotonic() of utils.backend_pool."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class BackendPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('utils.backend_pool.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def backends(n: int, weights: List[int] = None, **kwargs) -> List[Backend]:
+        weights = weights or [1] * n
+        # clients are never used by the pool itself.
+        return [Backend('mnp', 10000 + i, None, weight=weights[i], **kwargs) for i in range(n)]
+
+    def answer(self, backend: Backend, latency_ms: float, ok: bool = True, pool: BackendPool = None) -> None:
+        start = backend.start()
+        self.clock.now += latency_ms / 1000.0
+        if pool is not None:
+            pool.finish(backend, start, ok)
+        else:
+            backend.finish(start, ok)
+
+    def picks(self, pool: BackendPool, n: int) -> List[int]:
+        return [pool.backends.index(pool.pick()) for __ in range(n)]
+
+
+class BackendPoolStrategyTest(BackendPoolTestCase):
+    def test_round_robin(self):
+        pool = BackendPool(self.backends(3))
+        self.assertEqual(self.picks(pool, 6), [0, 1, 2, 0, 1, 2])
+
+    def test_round_robin_skips_what_is_excluded(self):
+        pool = BackendPool(self.backends(3))
+        self.assertEqual([pool.backends.index(pool.pick(exclude=pool.backends[1])) for __ in range(4)], [0, 2, 0, 2])
+
+    def test_least_outstanding(self):
+        pool = BackendPool(self.backends(3), strategy=BackendPool.STRATEGY_LEAST_OUTSTANDING)
+        pool.backends[0].in_flight = 2
+        pool.backends[1].in_flight = 1
+        self.assertEqual(pool.pick(), pool.backends[2])
+        pool.backends[2].in_flight = 1
+        # ties go round instead of always to the first backend.
+        self.assertEqual({pool.backends.index(pool.pick()) for __ in range(4)}, {1, 2})
+
+    def test_weighted_round_robin_is_smooth(self):
+        pool = BackendPool(self.backends(3, weights=[5, 1, 1]), strategy=BackendPool.STRATEGY_WEIGHTED_ROUND_ROBIN)
+        self.assertEqual(self.picks(pool, 7), [0, 0, 1, 0, 2, 0, 0])
+        self.assertEqual(collections.Counter(self.picks(pool, 70)), {0: 50, 1: 10, 2: 10})
+
+    def test_p2c_ewma_prefers_the_faster_backend(self):
+        pool = BackendPool(self.backends(2), strategy=BackendPool.STRATEGY_P2C_EWMA)
+        fast, slow = pool.backends
+        self.answer(fast, 10.0)
+        self.answer(slow, 100.0)
+        self.assertEqual(self.picks(pool, 10), [0] * 10)
+
+    def test_p2c_ewma_weighs_latency_by_the_queue(self):
+        pool = BackendPool(self.backends(2), strategy=BackendPool.STRATEGY_P2C_EWMA)
+        fast, slow = pool.backends
+        self.answer(fast, 10.0)
+        self.answer(slow, 30.0)
+        fast.in_flight = 5
+        self.assertEqual(pool.pick(), slow)
+
+    def test_p2c_ewma_tries_unknown_backends_first(self):
+        pool = BackendPool(self.backends(2), strategy=BackendPool.STRATEGY_P2C_EWMA)
+        self.answer(pool.backends[0], 1.0)
+        self.assertEqual(pool.pick(), pool.backends[1])
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            BackendPool(self.backends(1), strategy='random')
+        with self.assertRaises(ValueError):
+            BackendPool([])
+
+
+class BackendTest(BackendPoolTestCase):
+    def test_latency_is_an_ewma(self):
+        backend = self.backends(1, ewma_alpha=0.5)[0]
+        self.answer(backend, 100.0)
+        self.assertAlmostEqual(backend.latency_ms, 100.0)
+        self.answer(backend, 50.0)
+        self.assertAlmostEqual(backend.latency_ms, 75.0)
+        self.assertEqual(backend.in_flight, 0)
+
+    def test_cancelled_request_raises_the_latency(self):
+        backend = self.backends(1, ewma_alpha=0.5)[0]
+        self.answer(backend, 10.0)
+        start = backend.start()
+        self.clock.now += 0.03
+        backend.cancel(start)
+        self.assertAlmostEqual(backend.latency_ms, 20.0)
+        self.assertEqual(backend.in_flight, 0)
+        # a request abandoned sooner than usual says nothing.
+        start = backend.start()
+        backend.cancel(start)
+        self.assertAlmostEqual(backend.latency_ms, 20.0)
+
+    def test_stale_latency_decays_toward_the_median(self):
+        backend = self.backends(1, decay_s=10.0)[0]
+        self.answer(backend, 1000.0)
+        self.assertAlmostEqual(backend.score(100.0), 1000.0)
+        self.clock.now += 10.0
+        self.assertAlmostEqual(backend.score(100.0), 100.0 + 900.0 / 2.718281828, places=3)
+        self.clock.now += 1000.0
+        self.assertAlmostEqual(backend.score(100.0), 100.0)
+
+    def test_idle_fast_backend_does_not_look_faster_than_its_peers(self):
+        backend = self.backends(1)[0]
+        self.answer(backend, 1.0)
+        self.clock.now += 1000.0
+        self.assertAlmostEqual(backend.score(50.0), 50.0)
+
+    def test_median_latency(self):
+        backends = self.backends(4)
+        for backend, latency_ms in zip(backends[:3], (30.0, 10.0, 20.0)):
+            self.answer(backend, latency_ms)
+        self.assertAlmostEqual(Backend.median_latency_ms(backends), 20.0)
+        self.assertEqual(Backend.median_latency_ms(backends[3:]), 0.0)
+
+
+class CircuitBreakerTest(BackendPoolTestCase):
+    def test_consecutive_failures_trip(self):
+        breaker = CircuitBreaker(max_consecutive_failures=3, min_requests=100)
+        self.assertEqual([breaker.record(ok) for ok in (False, False, True, False, False, False)],
+                         [False, False, False, False, False, True])
+
+    def test_error_rate_over_the_window_trips(self):
+        breaker = CircuitBreaker(window=4, min_requests=4, max_error_rate=0.5, max_consecutive_failures=100)
+        self.assertEqual([breaker.record(ok) for ok in (True, False, True, False)], [False] * 4)
+        # the oldest success leaves the window: 3 errors of 4.
+        self.assertTrue(breaker.record(False))
+
+    def test_ejection_then_half_open_trial(self):
+        breaker = CircuitBreaker(base_ejection_s=5.0)
+        breaker.trip()
+        self.assertEqual((breaker.state, breaker.available()), (CircuitBreaker.OPEN, False))
+        self.clock.now += 5.0
+        self.assertTrue(breaker.available())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.acquire()
+        # only one trial at a time.
+        self.assertFalse(breaker.available())
+        self.assertFalse(breaker.record(True))
+        self.assertEqual((breaker.state, breaker.available()), (CircuitBreaker.CLOSED, True))
+
+    def test_failed_trial_doubles_the_ejection(self):
+        breaker = CircuitBreaker(base_ejection_s=5.0, max_ejection_s=12.0)
+        breaker.trip()
+        for ejection_s in (10.0, 12.0):
+            self.clock.now += ejection_s / 2
+            self.assertTrue(breaker.available())
+            breaker.acquire()
+            self.assertTrue(breaker.record(False))
+            breaker.trip()
+            self.clock.now += ejection_s - 0.001
+            self.assertFalse(breaker.available())
+            self.clock.now += 0.001
+        self.assertEqual(breaker.ejected, 3)
+
+    def test_released_trial_is_given_back(self):
+        breaker = CircuitBreaker(base_ejection_s=1.0)
+        breaker.trip()
+        self.clock.now += 1.0
+        self.assertTrue(breaker.available())
+        breaker.acquire()
+        breaker.release()
+        self.assertTrue(breaker.available())
+
+    def test_answers_of_an_ejected_backend_are_ignored(self):
+        breaker = CircuitBreaker(max_consecutive_failures=1)
+        breaker.trip()
+        self.assertFalse(breaker.record(False))
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+
+class FakeResponse:
+    def __init__(self, status: int):
+        self.status = status
+
+    async def __aenter__(self) -> 'FakeResponse':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+
+class FakeClient:
+    def __init__(self, status: int):
+        self.status = status
+
+    def get(self, path: str, **kwargs) -> FakeResponse:
+        return FakeResponse(self.status)
+
+
+class EjectionTest(BackendPoolTestCase):
+    def test_failing_backend_is_ejected_and_tried_again(self):
+        pool = BackendPool(self.backends(3))
+        bad = pool.backends[0]
+        for __ in range(5):
+            self.answer(bad, 1.0, ok=False, pool=pool)
+        self.assertEqual(bad.breaker.state, CircuitBreaker.OPEN)
+        self.assertNotIn(0, self.picks(pool, 4))
+        self.clock.now += 5.0
+        self.assertIn(0, self.picks(pool, 3))
+
+    def test_no_more_than_max_ejection_percent(self):
+        pool = BackendPool(self.backends(2), max_ejection_percent=50)
+        for backend in pool.backends:
+            for __ in range(5):
+                self.answer(backend, 1.0, ok=False, pool=pool)
+        self.assertEqual([b.breaker.state for b in pool.backends], [CircuitBreaker.OPEN, CircuitBreaker.CLOSED])
+        self.assertEqual(pool.pick(), pool.backends[1])
+
+    def test_slow_outlier_is_ejected(self):
+        pool = BackendPool(self.backends(3), outlier_factor=5.0, min_outlier_latency_ms=100.0)
+        for backend, latency_ms in zip(pool.backends, (10.0, 12.0, 200.0)):
+            self.answer(backend, latency_ms, pool=pool)
+        self.assertEqual([b.breaker.state for b in pool.backends],
+                         [CircuitBreaker.CLOSED, CircuitBreaker.CLOSED, CircuitBreaker.OPEN])
+
+    def test_fast_backends_are_never_outliers(self):
+        pool = BackendPool(self.backends(3), outlier_factor=5.0, min_outlier_latency_ms=100.0)
+        for backend, latency_ms in zip(pool.backends, (1.0, 1.0, 50.0)):
+            self.answer(backend, latency_ms, pool=pool)
+        self.assertEqual(pool.backends[2].breaker.state, CircuitBreaker.CLOSED)
+
+    def test_none_available(self):
+        pool = BackendPool(self.backends(1), max_ejection_percent=100)
+        pool.backends[0].breaker.trip()
+        self.assertIsNone(pool.pick())
+
+
+class HealthCheckTest(unittest.IsolatedAsyncioTestCase):
+    async def test_failed_checks_in_a_row_eject(self):
+        pool = BackendPool([Backend('mnp', 10000 + i, FakeClient(status)) for i, status in enumerate((200, 200, 500))],
+                           unhealthy_threshold=2)
+        await pool.check_health('/health', 100)
+        self.assertEqual(pool.backends[2].breaker.state, CircuitBreaker.CLOSED)
+        await pool.check_health('/health', 100)
+        self.assertEqual(pool.backends[2].breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(pool.backends[0].breaker.state, CircuitBreaker.CLOSED)
+
+
+if __name__ == '__main__':
+    unittest.main()
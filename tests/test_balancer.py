@@ -0,0 +1,126 @@
+import logging
+import os
+import socket
+import sys
+import threading
+import unittest
+from typing import Any, Mapping
+
+import aiohttp
+from aiohttp import web
+
+from utils.lazy_logger import LazyLogger
+from utils.utils import SESSION_KEY_HEADER, WRITE_POSITION_HEADER
+
+# the servers are scripts next to their configs, not packages.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'distributed_system', 'balancer'))
+from balancer import Balancer  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class BalancerTestCase(unittest.IsolatedAsyncioTestCase):
+    """Runs one Balancer per test class in a thread of its own, in front of a stub MNP server run by each test."""
+
+    @classmethod
+    def config(cls, port: int, mnp_port: int) -> dict:
+        return {
+            'server': {'host': '127.0.0.1', 'port': port, 'min_timeout_ms': 1, 'max_timeout_ms': 1},
+            'session': {'secret': 'test'},
+            'balancing': {'strategy': 'round_robin', 'request_timeout_ms': 5000, 'hedging': {}},
+            'mnps': [{'host': '127.0.0.1', 'port': mnp_port}],
+        }
+
+    @classmethod
+    def setUpClass(cls):
+        port = free_port()
+        cls.mnp_port = free_port()
+        cls.url = 'http://127.0.0.1:{}/api/v1'.format(port)
+        logger = logging.getLogger('test.balancer')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        started = threading.Event()
+
+        def run():
+            balancer = Balancer(cls.config(port, cls.mnp_port), LazyLogger(logger))
+            started.set()
+            balancer.run()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+
+    async def asyncSetUp(self):
+        self.received = []
+        app = web.Application()
+        app.add_routes([web.route('*', '/api/v1/mnp/{tail:.*}', self.mnp)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        self.addAsyncCleanup(runner.cleanup)
+        await web.TCPSite(runner, '127.0.0.1', self.mnp_port).start()
+        # the cookies of the balancer are set for 127.0.0.1.
+        self.session = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True))
+        self.addAsyncCleanup(self.session.close)
+        async with self.session.post(self.url + '/login', json={'login': 'user', 'password': 'user'}) as resp:
+            self.assertEqual(resp.status, 200)
+
+    async def mnp(self, req: web.Request) -> web.Response:
+        self.received.append((req.headers.copy(), await req.read()))
+        return web.json_response({'code': 0}, headers={
+            'X-Upstream': 'mnp', 'Set-Cookie': 'mnp=1', 'Server': 'stub', 'Keep-Alive': 'timeout=1',
+            WRITE_POSITION_HEADER: '7'})
+
+
+class HopHeadersTest(BalancerTestCase):
+    CLIENT_HEADERS = {'X-Request-Id': 'abc', 'Authorization': 'Basic dXNlcjp1c2Vy', 'Cookie': 'mnp=0',
+                      SESSION_KEY_HEADER: '1', WRITE_POSITION_HEADER: '100', 'Keep-Alive': 'timeout=5'}
+
+    async def transfer(self, method: str, path: str, **kwargs) -> Mapping[str, Any]:
+        async with self.session.request(method, self.url + path, headers=self.CLIENT_HEADERS, **kwargs) as resp:
+            self.assertEqual(resp.status, 200)
+            self.assertEqual(await resp.json(), {'code': 0})
+            return resp.headers
+
+    async def test_request_headers(self):
+        # add_mnp is streamed, get_operator goes through hedging.
+        for method, path, kwargs in (('POST', '/mnp/add_mnp', {'json': {'phone': '79000000000'}}),
+                                     ('GET', '/mnp/get_operator?phone=79000000000', {})):
+            with self.subTest(path=path):
+                await self.transfer(method, path, **kwargs)
+                headers, __ = self.received[-1]
+                self.assertEqual(headers['X-Request-Id'], 'abc')
+                self.assertNotIn('Authorization', headers)
+                self.assertNotIn('Keep-Alive', headers)
+                # neither the client's nor the balancer's cookies reach the MNP server.
+                self.assertNotIn('Cookie', headers)
+                # the session key and write position are the session's, whatever the client sent.
+                self.assertNotEqual(headers[SESSION_KEY_HEADER], '1')
+                self.assertNotEqual(headers.get(WRITE_POSITION_HEADER), '100')
+
+    async def test_session_headers_are_the_same_on_both_paths(self):
+        await self.transfer('POST', '/mnp/add_mnp', data=b'{"phone": "79000000000"}')
+        await self.transfer('GET', '/mnp/get_operator?phone=79000000000')
+        (streamed, body), (hedged, __) = self.received
+        self.assertEqual(body, b'{"phone": "79000000000"}')
+        self.assertEqual(streamed[SESSION_KEY_HEADER], hedged[SESSION_KEY_HEADER])
+        # the write position the MNP server answered with comes back with the next request.
+        self.assertEqual(hedged[WRITE_POSITION_HEADER], '7')
+
+    async def test_response_headers(self):
+        for method, path in (('POST', '/mnp/add_mnp'), ('GET', '/mnp/get_operator?phone=79000000000')):
+            with self.subTest(path=path):
+                headers = await self.transfer(method, path)
+                self.assertEqual(headers['X-Upstream'], 'mnp')
+                self.assertNotEqual(headers.get('Server'), 'stub')
+                self.assertNotIn('Keep-Alive', headers)
+                self.assertNotIn('mnp=1', headers.getall('Set-Cookie', []))
+                self.assertNotIn(WRITE_POSITION_HEADER, headers)
+                self.assertNotIn('mnp', [cookie.key for cookie in self.session.cookie_jar])
+
+
+if __name__ == '__main__':
+    unittest.main()
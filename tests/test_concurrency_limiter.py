@@ -0,0 +1,85 @@
+import asyncio
+import unittest
+
+from utils.concurrency_limiter import ConcurrencyLimiter
+
+
+class ConcurrencyLimiterHandoffTest(unittest.IsolatedAsyncioTestCase):
+    def limiter(self, **kwargs) -> ConcurrencyLimiter:
+        return ConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=1, **kwargs)
+
+    async def test_release_hands_the_slot_to_the_first_waiter(self):
+        limiter = self.limiter(max_wait_ms=1000.0)
+        self.assertTrue(await limiter.acquire())
+        first = asyncio.ensure_future(limiter.acquire())
+        second = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        self.assertEqual(limiter.stats()['queued'], 2)
+
+        limiter.release(10.0)
+        self.assertTrue(await first)
+        self.assertFalse(second.done())
+        # the slot went from the releaser to the waiter without ever being free.
+        self.assertEqual(limiter.in_flight, 1)
+        self.assertFalse(limiter.try_acquire())
+
+        limiter.release(10.0)
+        self.assertTrue(await second)
+        limiter.release(10.0)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_waiter_times_out_and_leaves_the_queue(self):
+        limiter = self.limiter(max_wait_ms=10.0)
+        self.assertTrue(await limiter.acquire())
+        self.assertFalse(await limiter.acquire())
+        self.assertEqual(limiter.stats()['queued'], 0)
+        self.assertEqual(limiter.rejected, 1)
+        limiter.release(10.0)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_full_queue_rejects_at_once(self):
+        limiter = self.limiter(max_wait_ms=1000.0, max_queue=1)
+        self.assertTrue(await limiter.acquire())
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        self.assertFalse(await limiter.acquire())
+        limiter.release(10.0)
+        self.assertTrue(await waiting)
+
+    async def test_cancelled_waiter_gives_back_a_slot_handed_to_it(self):
+        limiter = self.limiter(max_wait_ms=1000.0)
+        self.assertTrue(await limiter.acquire())
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        # the slot is handed over and the waiter is cancelled before it runs again.
+        limiter.release(10.0)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertTrue(limiter.try_acquire())
+
+    async def test_cancelled_waiter_leaves_the_queue(self):
+        limiter = self.limiter(max_wait_ms=1000.0)
+        self.assertTrue(await limiter.acquire())
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(limiter.stats()['queued'], 0)
+        limiter.release(10.0)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_abandoned_request_does_not_move_the_limit(self):
+        limiter = ConcurrencyLimiter(algorithm=ConcurrencyLimiter.AIMD, initial_limit=10, backoff=0.5)
+        self.assertTrue(await limiter.acquire())
+        limiter.release()
+        self.assertEqual(limiter.limit, 10.0)
+        self.assertTrue(await limiter.acquire())
+        limiter.release(10.0, ok=False)
+        self.assertEqual(limiter.limit, 5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from aiohttp.test_utils import make_mocked_request
+
+from utils.deadline import Deadline
+from utils.utils import DEADLINE_HEADER
+
+
+class Clock:
+    """Stands in for time.monotonic() of utils.deadline."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('utils.deadline.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def from_header(self, header: str, default_ms: float = None) -> Deadline:
+        headers = {DEADLINE_HEADER: header} if header is not None else {}
+        return Deadline.from_request(make_mocked_request('GET', '/', headers=headers), default_ms)
+
+    def test_no_deadline(self):
+        deadline = Deadline()
+        self.clock.now += 10 ** 6
+        self.assertEqual((deadline.remaining_s(), deadline.expired(), deadline.header()), (None, False, None))
+        self.assertIsNone(deadline.client_timeout().total)
+        self.assertEqual(deadline.client_timeout(5.0).total, 5.0)
+
+    def test_header_is_what_is_left(self):
+        deadline = Deadline(1000.0)
+        self.clock.now += 0.25
+        self.assertEqual(deadline.header(), '750')
+        self.assertFalse(deadline.expired())
+        self.clock.now += 0.75
+        self.assertEqual((deadline.remaining_s(), deadline.header()), (0.0, '0'))
+        self.assertTrue(deadline.expired())
+
+    def test_from_request(self):
+        for header, default_ms, remaining_s in (('500', None, 0.5), ('500', 200.0, 0.2), ('100', 200.0, 0.1),
+                                                (None, 200.0, 0.2), (None, None, None), ('soon', 200.0, 0.2),
+                                                ('inf', None, None), ('nan', 200.0, 0.2)):
+            with self.subTest(header=header, default_ms=default_ms):
+                if remaining_s is None:
+                    self.assertIsNone(self.from_header(header, default_ms).remaining_s())
+                else:
+                    self.assertAlmostEqual(self.from_header(header, default_ms).remaining_s(), remaining_s)
+
+    def test_client_timeout_is_the_sooner_of_both(self):
+        deadline = Deadline(1000.0)
+        self.assertAlmostEqual(deadline.client_timeout(5.0).total, 1.0)
+        self.assertEqual(deadline.client_timeout(0.5).total, 0.5)
+        self.assertAlmostEqual(deadline.client_timeout().total, 1.0)
+
+    def test_caused(self):
+        deadline = Deadline(1000.0)
+        self.clock.now += 0.5
+        self.assertFalse(deadline.caused(asyncio.TimeoutError()))
+        # the timer of the call fired a clock tick early.
+        self.clock.now += 0.5 - Deadline.SLACK_S / 2
+        self.assertTrue(deadline.caused(asyncio.TimeoutError()))
+        self.assertFalse(deadline.caused(ConnectionError()))
+        self.assertFalse(Deadline().caused(asyncio.TimeoutError()))
+
+    def test_latest(self):
+        first, last = Deadline(100.0), Deadline(300.0)
+        self.assertAlmostEqual(Deadline.latest(first, last).remaining_s(), 0.3)
+        self.assertIsNone(Deadline.latest(first, Deadline()).remaining_s())
+        self.assertIsNone(Deadline.latest().remaining_s())
+
+
+class DeadlineSleepTest(unittest.IsolatedAsyncioTestCase):
+    async def test_sleep_is_cut_by_the_deadline(self):
+        self.assertFalse(await Deadline(10.0).sleep(10.0))
+        self.assertTrue(await Deadline(1000.0).sleep(0.001))
+        self.assertTrue(await Deadline().sleep(0.001))
+
+
+if __name__ == '__main__':
+    unittest.main()
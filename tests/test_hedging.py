@@ -0,0 +1,70 @@
+import unittest
+
+from utils.hedging import HedgingPolicy
+
+
+class HedgingPolicyTest(unittest.TestCase):
+    def test_initial_delay_until_enough_samples(self):
+        policy = HedgingPolicy(initial_delay_ms=500.0, window=100, min_samples=50)
+        for __ in range(49):
+            policy.record(10.0)
+        self.assertAlmostEqual(policy.delay_s(), 0.5)
+        policy.record(10.0)
+        self.assertAlmostEqual(policy.delay_s(), 0.01)
+
+    def test_delay_is_the_percentile_of_the_window(self):
+        policy = HedgingPolicy(percentile=90.0, window=100, min_samples=100)
+        for latency_ms in range(1, 101):
+            policy.record(float(latency_ms))
+        self.assertAlmostEqual(policy.delay_s(), 0.091)
+        # the window slides: the fast requests are forgotten.
+        for __ in range(100):
+            policy.record(200.0)
+        self.assertAlmostEqual(policy.delay_s(), 0.2)
+
+    def test_delay_is_recomputed_every_tenth_of_the_window(self):
+        policy = HedgingPolicy(percentile=50.0, window=100, min_samples=10)
+        for __ in range(10):
+            policy.record(10.0)
+        for __ in range(9):
+            policy.record(1000.0)
+        self.assertAlmostEqual(policy.delay_s(), 0.01)
+        policy.record(1000.0)
+        self.assertAlmostEqual(policy.delay_s(), 1.0)
+
+    def test_min_delay(self):
+        policy = HedgingPolicy(min_delay_ms=5.0, initial_delay_ms=1.0, window=10, min_samples=1)
+        self.assertAlmostEqual(policy.delay_s(), 0.005)
+        policy.record(1.0)
+        self.assertAlmostEqual(policy.delay_s(), 0.005)
+
+    def test_hedges_stay_within_the_budget(self):
+        policy = HedgingPolicy(budget=0.125, max_tokens=10.0)
+        hedges = 0
+        for __ in range(1000):
+            policy.admit()
+            if policy.can_hedge():
+                policy.hedged()
+                hedges += 1
+        self.assertEqual(hedges, 125)
+        self.assertEqual(policy.stats()['requests'], 1000)
+        self.assertEqual(policy.stats()['hedges'], 125)
+
+    def test_quiet_period_saves_up_to_max_tokens(self):
+        policy = HedgingPolicy(budget=0.5, max_tokens=2.0)
+        for __ in range(100):
+            policy.admit()
+        hedges = 0
+        while policy.can_hedge():
+            policy.hedged()
+            hedges += 1
+        self.assertEqual(hedges, 2)
+
+    def test_from_config(self):
+        policy = HedgingPolicy.from_config({'initial_delay_ms': 100, 'min_delay_ms': 200})
+        self.assertAlmostEqual(policy.delay_s(), 0.2)
+        self.assertFalse(policy.can_hedge())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from unittest import mock
+
+from utils.id_generator import SnowflakeGenerator
+
+NOW_NS = (SnowflakeGenerator.DEFAULT_EPOCH_MS + 1000) * 10 ** 6
+
+
+class SnowflakeGeneratorTest(unittest.TestCase):
+    def setUp(self):
+        self.now_ns = NOW_NS
+        patcher = mock.patch('utils.id_generator.time.time_ns', lambda: self.now_ns)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_layout(self):
+        generator = SnowflakeGenerator(node_id=3, worker_id=5)
+        self.assertEqual(generator.next_id(), (1000 << 22) | (3 << 17) | (5 << 12))
+        self.assertEqual(generator.next_id(), (1000 << 22) | (3 << 17) | (5 << 12) | 1)
+
+    def test_workers_never_collide(self):
+        ids = set()
+        for node_id in (0, SnowflakeGenerator.MAX_NODE_ID):
+            for worker_id in range(SnowflakeGenerator.MAX_WORKER_ID + 1):
+                generator = SnowflakeGenerator(node_id=node_id, worker_id=worker_id)
+                ids.update(generator.next_id() for __ in range(100))
+        self.assertEqual(len(ids), 2 * 32 * 100)
+
+    def test_sequence_overflow_borrows_the_next_ms(self):
+        generator = SnowflakeGenerator()
+        ids = [generator.next_id() for __ in range(4097)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(ids[-1], 1001 << 22)
+        # the clock catches up without a duplicate.
+        self.now_ns += 10 ** 6
+        self.assertGreater(generator.next_id(), ids[-1])
+
+    def test_clock_stepping_back_keeps_ids_growing(self):
+        generator = SnowflakeGenerator()
+        first = generator.next_id()
+        self.now_ns -= 5 * 10 ** 6
+        self.assertEqual(generator.next_id(), first + 1)
+
+    def test_restart_does_not_repeat_ids(self):
+        first = SnowflakeGenerator().next_id()
+        self.now_ns += 10 ** 6
+        self.assertGreater(SnowflakeGenerator().next_id(), first)
+
+    def test_ids_out_of_range(self):
+        for kwargs in ({'node_id': 32}, {'node_id': -1}, {'worker_id': 32}):
+            with self.subTest(**kwargs):
+                with self.assertRaises(ValueError):
+                    SnowflakeGenerator(**kwargs)
+
+
+if __name__ == '__main__':
+    unittest.main()
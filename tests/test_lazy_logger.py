@@ -0,0 +1,73 @@
+import logging
+import unittest
+from typing import List
+
+from utils.lazy_logger import BraceMessage, Deferred, LazyLogger
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records: List[logging.LogRecord] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+
+class LazyLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('test.lazy_logger.' + self.id())
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.handler = ListHandler()
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def test_brace_formatting_and_extra(self):
+        LazyLogger(self.logger).info("got {} from {}:{}", 'x', 'mnp', 10000, extra={'session_key': 42})
+        record = self.handler.records[0]
+        self.assertEqual(record.getMessage(), 'got x from mnp:10000')
+        self.assertEqual(record.session_key, 42)
+
+    def test_message_without_arguments_is_not_formatted(self):
+        LazyLogger(self.logger).info("braces {} stay")
+        self.assertEqual(self.handler.records[0].getMessage(), 'braces {} stay')
+
+    def test_disabled_level_evaluates_nothing(self):
+        calls = []
+        LazyLogger(self.logger).debug("value {}", Deferred(lambda: calls.append(1)))
+        self.assertEqual((calls, self.handler.records), ([], []))
+
+    def test_unformatted_record_evaluates_nothing(self):
+        # a handler that drops the record never formats it.
+        self.handler.addFilter(lambda record: False)
+        calls = []
+        LazyLogger(self.logger).info("value {}", Deferred(lambda: calls.append(1)))
+        self.assertEqual(calls, [])
+
+
+class DeferredTest(unittest.TestCase):
+    def test_computed_once_on_use(self):
+        calls = []
+
+        def fn():
+            calls.append(1)
+            return 3.14159
+
+        value = Deferred(fn)
+        self.assertEqual(calls, [])
+        self.assertEqual('{:.2f} {}'.format(value, value), '3.14 3.14159')
+        self.assertEqual(calls, [1])
+
+
+class BraceMessageTest(unittest.TestCase):
+    def test_formatted_once(self):
+        calls = []
+        msg = BraceMessage("{} {}", (Deferred(lambda: calls.append(1) or 'a'), 'b'))
+        self.assertEqual(msg.fmt, "{} {}")
+        self.assertEqual((str(msg), str(msg)), ('a b', 'a b'))
+        self.assertEqual(calls, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import asyncio
+import gzip
+import json
+import logging
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from typing import Any, List, Mapping
+
+import aiohttp
+
+from log_analyzer.log_analyzer import LogAnalyzer
+
+MAX_RECORD_BYTES = 1024
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def record(msg: str, **fields) -> Mapping[str, Any]:
+    res = {'ts_ns': 1, 'service': 'mnp', 'name': 'mnp', 'levelname': 'INFO', 'msg': msg}
+    res.update(fields)
+    return res
+
+
+def ndjson(records: List[Mapping[str, Any]]) -> bytes:
+    return b''.join(json.dumps(r).encode('utf-8') + b'\n' for r in records)
+
+
+class LogAnalyzerTestCase(unittest.IsolatedAsyncioTestCase):
+    """Runs one LogAnalyzer per test class in a thread of its own, with storage in a temporary directory."""
+
+    @classmethod
+    def config(cls, path: str, port: int) -> dict:
+        return {
+            'server': {'host': '127.0.0.1', 'port': port, 'max_record_bytes': MAX_RECORD_BYTES},
+            'logs': {},
+            # no maintenance runs during the tests, the analyzer thread outlives the temporary directory.
+            'storage': {'path': path, 'flush_interval_ms': 60000},
+        }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.path = tempfile.mkdtemp()
+        port = free_port()
+        cls.url = 'http://127.0.0.1:{}/api/v1'.format(port)
+        logger = logging.getLogger('test.log_analyzer')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        started = threading.Event()
+
+        def run():
+            analyzer = LogAnalyzer(cls.config(cls.path, port), logger)
+            started.set()
+            analyzer.run()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path, ignore_errors=True)
+
+    async def asyncSetUp(self):
+        self.session = aiohttp.ClientSession(auto_decompress=False)
+
+    async def asyncTearDown(self):
+        await self.session.close()
+
+    async def post(self, path: str, data: Any, headers: Mapping[str, str] = None) -> (int, Mapping[str, Any]):
+        async with self.session.post(self.url + path, data=data, headers=headers) as resp:
+            return resp.status, await resp.json()
+
+
+class AddLogsTest(LogAnalyzerTestCase):
+    async def test_ndjson_body(self):
+        body = ndjson([record('a'), record('b')]) + b'not json\n' + json.dumps(record('c', ts_ns=-1)).encode()
+        self.assertEqual(await self.post('/add_logs', body), (200, {'code': 0, 'accepted': 2, 'rejected': 2}))
+
+    async def test_gzip_file_body(self):
+        body = gzip.compress(ndjson([record('a'), record('b')]))
+        self.assertEqual(await self.post('/add_logs', body), (200, {'code': 0, 'accepted': 2, 'rejected': 0}))
+
+    async def test_gzip_magic_split_over_chunks(self):
+        body = gzip.compress(ndjson([record('a')]))
+
+        async def chunks():
+            yield body[:1]
+            await asyncio.sleep(0.05)
+            yield body[1:]
+
+        self.assertEqual(await self.post('/add_logs', chunks()), (200, {'code': 0, 'accepted': 1, 'rejected': 0}))
+
+    async def test_concatenated_gzip_members(self):
+        body = gzip.compress(ndjson([record('a')])) + gzip.compress(ndjson([record('b'), record('c')]))
+        self.assertEqual(await self.post('/add_logs', body), (200, {'code': 0, 'accepted': 3, 'rejected': 0}))
+
+    async def test_content_encoding_gzip(self):
+        body = gzip.compress(ndjson([record('a'), record('b')]))
+        status, answer = await self.post('/add_logs', body, headers={'Content-Encoding': 'gzip'})
+        self.assertEqual((status, answer), (200, {'code': 0, 'accepted': 2, 'rejected': 0}))
+
+    async def test_content_encoding_gzip_is_inflated_with_a_bound(self):
+        # 8 MiB without a line break, 8 KiB on the wire.
+        body = gzip.compress(b'x' * (8 * 1024 * 1024), compresslevel=9)
+        status, __ = await self.post('/add_logs', body, headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(status, 400)
+
+    async def test_unsupported_content_encoding(self):
+        status, __ = await self.post('/add_logs', b'x', headers={'Content-Encoding': 'br'})
+        self.assertEqual(status, 400)
+
+    async def test_long_line_inside_a_chunk(self):
+        long = json.dumps(record('x' * (2 * MAX_RECORD_BYTES))).encode('utf-8')
+        status, __ = await self.post('/add_logs', ndjson([record('a')]) + long + b'\n' + ndjson([record('b')]))
+        self.assertEqual(status, 400)
+
+    async def test_long_last_line(self):
+        status, __ = await self.post('/add_logs', json.dumps(record('x' * (2 * MAX_RECORD_BYTES))).encode('utf-8'))
+        self.assertEqual(status, 400)
+
+    async def test_add_log(self):
+        body = 'ts_ns=1&service=mnp&name=mnp&levelname=INFO&msg=hello'
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        self.assertEqual(await self.post('/add_log', body, headers), (200, {'code': 0}))
+        status, __ = await self.post('/add_log', gzip.compress(body.encode('utf-8')),
+                                     dict(headers, **{'Content-Encoding': 'gzip'}))
+        self.assertEqual(status, 200)
+
+
+
+class IngestTest(LogAnalyzerTestCase):
+    async def stats(self) -> Mapping[str, Any]:
+        async with self.session.get(self.url + '/stats') as resp:
+            return (await resp.json())['data']['ingest']
+
+    async def test_failed_record_does_not_stop_the_ingest(self):
+        # storage headers hold 64-bit timestamps, so the first record cannot be stored.
+        body = ndjson([record('a', ts_ns=2 ** 64), record('b')])
+        self.assertEqual(await self.post('/add_logs', body), (200, {'code': 0, 'accepted': 2, 'rejected': 0}))
+        for __ in range(200):
+            stats = await self.stats()
+            if stats['processed'] == 2:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual((stats['processed'], stats['failed'], stats['stored']), (2, 1, 1))
+        self.assertEqual(stats['queued'], 0)
+
+
+class QueryTest(LogAnalyzerTestCase):
+    async def query(self, **params) -> (int, List[Mapping[str, Any]]):
+        async with self.session.get(self.url + '/query', params=params) as resp:
+            if resp.status != 200:
+                return resp.status, [await resp.json()]
+            return resp.status, [json.loads(line) for line in (await resp.read()).splitlines()]
+
+    async def stored(self, service: str, count: int) -> None:
+        # records are stored by the ingest task, after the answer.
+        for __ in range(200):
+            __, lines = await self.query(service=service)
+            if lines[-1]['count'] >= count:
+                return
+            await asyncio.sleep(0.01)
+        self.fail('records were not stored')
+
+    async def test_filters_and_pages(self):
+        records = [record('took {} ms'.format(i), service='query', ts_ns=i + 1, session_key=i % 2)
+                   for i in range(10)]
+        await self.post('/add_logs', ndjson(records))
+        await self.stored('query', 10)
+
+        status, lines = await self.query(service='query', session_key=1, limit=3)
+        self.assertEqual(status, 200)
+        self.assertEqual([line['ts_ns'] for line in lines[:-1]], [2, 4, 6])
+        self.assertEqual(lines[-1]['count'], 3)
+        __, lines = await self.query(service='query', session_key=1, limit=3, cursor=lines[-1]['next_cursor'])
+        self.assertEqual([line['ts_ns'] for line in lines[:-1]], [8, 10])
+        self.assertIsNone(lines[-1]['next_cursor'])
+
+        __, lines = await self.query(service='query', start_ns=4, end_ns=5)
+        self.assertEqual([line['ts_ns'] for line in lines[:-1]], [4, 5])
+
+    async def test_invalid_queries(self):
+        for params in ({'limit': 0}, {'limit': 'many'}, {'session_key': 'x'}, {'cursor': '1-2'}):
+            with self.subTest(**params):
+                status, lines = await self.query(**params)
+                self.assertEqual((status, lines[0]['code']), (400, -1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+import os
+import shutil
+import tempfile
+import unittest
+from typing import Any, List, Mapping
+
+from log_analyzer.log_index import LogIndex
+from log_analyzer.log_query import LogQuery
+from log_analyzer.log_storage import LogStorage
+
+
+def record(ts_ns: int, session_key: int = None, template_id: int = None, **fields) -> Mapping[str, Any]:
+    res = {'ts_ns': ts_ns, 'service': 'mnp', 'levelname': 'INFO', 'session_key': session_key,
+           'template_id': template_id, 'msg': 'hello'}
+    res.update(fields)
+    return res
+
+
+class LogIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        # cleanups run last in, first out: stores and indexes are closed before this.
+        self.addCleanup(shutil.rmtree, self.path, ignore_errors=True)
+
+    def storage(self, **kwargs) -> LogStorage:
+        kwargs.setdefault('segment_max_bytes', 300)
+        kwargs.setdefault('index_interval_bytes', 64)
+        storage = LogStorage(self.path, **kwargs)
+        self.addCleanup(storage.close)
+        return storage
+
+    def index(self, storage: LogStorage, **kwargs) -> LogIndex:
+        index = LogIndex(storage, **kwargs)
+        self.addCleanup(index.close)
+        return index
+
+    def append(self, storage: LogStorage, index: LogIndex, records: List[Mapping[str, Any]]) -> None:
+        for r in records:
+            seq, offset = storage.append(r)
+            index.add(seq, offset, r)
+
+    def fill(self, storage: LogStorage, index: LogIndex, n: int = 30) -> None:
+        # session keys 0..2 and templates 0..4 spread over several segments.
+        self.append(storage, index, [record(ts, session_key=ts % 3, template_id=ts % 5) for ts in range(n)])
+
+    def looked_up(self, storage: LogStorage, index: LogIndex, field: str, value: Any, **kwargs) -> List[int]:
+        res = []
+        for seq, offsets in index.lookup(field, value, **kwargs):
+            res.extend(r['ts_ns'] for __, r in storage.read_many(seq, offsets))
+        return res
+
+
+class LogIndexTest(LogIndexTestCase):
+    def test_lookup_over_all_segments(self):
+        storage = self.storage()
+        index = self.index(storage)
+        self.fill(storage, index)
+        self.assertGreater(len(storage.segments()), 3)
+        self.assertEqual(self.looked_up(storage, index, 'session_key', 1), list(range(1, 30, 3)))
+        self.assertEqual(self.looked_up(storage, index, 'template_id', 4), list(range(4, 30, 5)))
+        self.assertEqual(index.lookup('session_key', 42), [])
+        self.assertEqual(index.unindexed(), [])
+
+    def test_sealed_postings_are_saved_next_to_their_segment(self):
+        storage = self.storage()
+        index = self.index(storage)
+        self.fill(storage, index)
+        saved = sorted(f for f in os.listdir(self.path) if f.endswith(LogIndex.SUFFIX))
+        self.assertEqual(saved, ['{:010d}{}'.format(seq, LogIndex.SUFFIX) for seq, __, __ in storage.segments()[:-1]])
+
+    def test_lookups_over_more_segments_than_the_cache(self):
+        storage = self.storage()
+        index = self.index(storage, cache_segments=1)
+        self.fill(storage, index)
+        for __ in range(2):
+            self.assertEqual(self.looked_up(storage, index, 'session_key', 2), list(range(2, 30, 3)))
+
+    def test_lookup_is_limited_to_the_time_range(self):
+        storage = self.storage()
+        index = self.index(storage)
+        self.fill(storage, index)
+        found = self.looked_up(storage, index, 'session_key', 0, start_ns=10, end_ns=20)
+        # whole segments overlapping the range come back, the caller filters by time.
+        self.assertTrue({12, 15, 18}.issubset(found))
+        self.assertNotIn(0, found)
+        self.assertNotIn(27, found)
+
+    def test_reopened_index_uses_the_saved_postings(self):
+        storage = self.storage()
+        index = self.index(storage)
+        self.fill(storage, index)
+        storage.close()
+        index.close()
+        storage = self.storage()
+        index = self.index(storage)
+        self.assertEqual(self.looked_up(storage, index, 'template_id', 0), list(range(0, 30, 5)))
+        self.append(storage, index, [record(30, template_id=0)])
+        self.assertEqual(self.looked_up(storage, index, 'template_id', 0), list(range(0, 31, 5)))
+
+    def test_segment_sealed_by_a_crash_is_reindexed(self):
+        storage = self.storage()
+        index = self.index(storage)
+        self.fill(storage, index)
+        storage.close()
+        first_seq = storage.segments()[0][0]
+        # the postings file of a sealed segment was never written.
+        os.remove(os.path.join(self.path, '{:010d}{}'.format(first_seq, LogIndex.SUFFIX)))
+        storage = self.storage()
+        index = self.index(storage)
+        self.assertEqual(self.looked_up(storage, index, 'session_key', 0), list(range(0, 30, 3)))
+        self.assertTrue(os.path.exists(os.path.join(self.path, '{:010d}{}'.format(first_seq, LogIndex.SUFFIX))))
+
+    def test_drop_removes_the_postings(self):
+        storage = self.storage()
+        index = self.index(storage)
+        self.fill(storage, index)
+        first_seq = storage.segments()[0][0]
+        index.drop([first_seq])
+        self.assertFalse(os.path.exists(os.path.join(self.path, '{:010d}{}'.format(first_seq, LogIndex.SUFFIX))))
+        self.assertNotIn(first_seq, [seq for seq, __ in index.lookup('session_key', 0)])
+
+
+class LogQueryTest(LogIndexTestCase):
+    def execute(self, partitions, **kwargs) -> List[int]:
+        return [r['ts_ns'] for __, __, __, r in LogQuery(**kwargs).execute(partitions)]
+
+    def test_filters(self):
+        storage = self.storage()
+        index = self.index(storage)
+        self.fill(storage, index)
+        self.append(storage, index, [record(30, session_key=0, template_id=0, levelname='ERROR')])
+        partitions = [(storage, index, None)]
+        self.assertEqual(self.execute(partitions, session_key=0, template_id=0), [0, 15, 30])
+        self.assertEqual(self.execute(partitions, session_key=0, start_ns=10, end_ns=20), [12, 15, 18])
+        self.assertEqual(self.execute(partitions, levelname='ERROR'), [30])
+        self.assertEqual(self.execute(partitions, start_ns=28), [28, 29, 30])
+        self.assertEqual(self.execute(partitions, service='balancer'), [])
+
+    def test_cursor_continues_after_the_last_record(self):
+        storage = self.storage()
+        index = self.index(storage)
+        self.fill(storage, index)
+        partitions = [(storage, index, None)]
+        for kwargs in ({}, {'session_key': 1}):
+            with self.subTest(**kwargs):
+                expected = self.execute(partitions, **kwargs)
+                pages, cursor = [], None
+                while True:
+                    page = list(LogQuery(cursor=cursor, **kwargs).execute(partitions))[:4]
+                    if len(page) == 0:
+                        break
+                    pages.extend(r['ts_ns'] for __, __, __, r in page)
+                    cursor = page[-1][:3]
+                self.assertEqual(pages, expected)
+
+    def test_template_ids_of_worker_partitions_are_mapped(self):
+        storage = self.storage()
+        index = self.index(storage)
+        self.fill(storage, index)
+        # global template 7 is local template 2 on this worker.
+        self.assertEqual(self.execute([(storage, index, {7: [2]})], template_id=7), list(range(2, 30, 5)))
+        self.assertEqual(self.execute([(storage, index, {7: [2]})], template_id=2), [])
+
+    def test_cursor_format(self):
+        self.assertEqual(LogQuery.from_params({'cursor': LogQuery.format_cursor(1, 2, 3)}).cursor, (1, 2, 3))
+        with self.assertRaises(ValueError):
+            LogQuery.from_params({'cursor': '1-2'})
+
+
+class ReadOnlyLogIndexTest(LogIndexTestCase):
+    def reader(self) -> (LogStorage, LogIndex):
+        storage = LogStorage(self.path, index_interval_bytes=64, read_only=True)
+        self.addCleanup(storage.close)
+        return storage, self.index(storage)
+
+    def test_refresh_follows_the_owner(self):
+        storage = self.storage()
+        index = self.index(storage)
+        self.fill(storage, index, n=15)
+        storage.flush()
+        reader_storage, reader_index = self.reader()
+        # the owner's active segment has no postings on disk yet.
+        self.assertEqual(reader_index.unindexed(), [storage.segments()[-1][0]])
+        sealed = len(reader_storage.segments()) - 1
+
+        self.append(storage, index, [record(ts, session_key=ts % 3, template_id=ts % 5) for ts in range(15, 30)])
+        storage.flush()
+        reader_storage.refresh()
+        reader_index.refresh()
+        self.assertGreater(len(reader_storage.segments()) - 1, sealed)
+        self.assertEqual(reader_index.unindexed(), [storage.segments()[-1][0]])
+        # sealed segments come from the postings, the active one is scanned.
+        self.assertEqual([r['ts_ns'] for __, __, __, r in LogQuery(session_key=1).execute(
+            [(reader_storage, reader_index, None)])], list(range(1, 30, 3)))
+
+    def test_refresh_forgets_removed_segments(self):
+        storage = self.storage(retention_bytes=600)
+        index = self.index(storage)
+        self.fill(storage, index)
+        storage.flush()
+        reader_storage, reader_index = self.reader()
+        removed = storage.enforce_retention()
+        index.drop(removed)
+        self.assertNotEqual(removed, [])
+        reader_storage.refresh()
+        reader_index.refresh()
+        self.assertNotIn(removed[0], [seq for seq, __ in reader_index.lookup('session_key', 0)])
+        self.assertNotIn(removed[0], reader_index.unindexed())
+
+    def test_read_only_index_writes_nothing(self):
+        storage = self.storage()
+        index = self.index(storage)
+        self.append(storage, index, [record(1, session_key=1)])
+        storage.flush()
+        reader_storage, reader_index = self.reader()
+        reader_index.close()
+        self.assertEqual([f for f in os.listdir(self.path) if f.endswith(LogIndex.SUFFIX)], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
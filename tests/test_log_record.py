@@ -0,0 +1,67 @@
+import logging
+import unittest
+
+from utils.lazy_logger import BraceMessage
+from utils.log_record import RECORD_SCHEMA, StructuredFieldsFilter, normalize_record, record_from_log_record
+
+
+def log_record(msg, args=(), **extra) -> logging.LogRecord:
+    record = logging.LogRecord('mnp', logging.INFO, __file__, 1, msg, args, None)
+    record.created = 1.5
+    for k, v in extra.items():
+        setattr(record, k, v)
+    return record
+
+
+class RecordFromLogRecordTest(unittest.TestCase):
+    def test_fields_are_typed(self):
+        record = log_record(BraceMessage('took {} ms', (12,)), session_key=42, route='/api/v1/x',
+                            upstream_port='10000', duration_ms=3)
+        StructuredFieldsFilter('mnp').filter(record)
+        res = record_from_log_record(record)
+        self.assertEqual(res['ts_ns'], 1500000000)
+        self.assertEqual(res['msg'], 'took 12 ms')
+        self.assertEqual(res['service'], 'mnp')
+        self.assertEqual(res['session_key'], 42)
+        self.assertEqual(res['upstream_port'], 10000)
+        self.assertEqual(res['duration_ms'], 3.0)
+        self.assertIsNone(res['upstream_host'])
+        self.assertEqual(set(res), set(RECORD_SCHEMA))
+
+    def test_unknown_session_key_is_none(self):
+        record = log_record('hello')
+        StructuredFieldsFilter('mnp').filter(record)
+        self.assertEqual(record.session_key, '???')
+        self.assertIsNone(record_from_log_record(record)['session_key'])
+
+    def test_field_of_the_wrong_type_is_dropped(self):
+        record = log_record('hello', session_key='not a number')
+        self.assertIsNone(record_from_log_record(record)['session_key'])
+
+
+class NormalizeRecordTest(unittest.TestCase):
+    def record(self, **fields) -> dict:
+        res = {'ts_ns': 1, 'service': 'mnp', 'name': 'mnp', 'levelname': 'INFO', 'msg': 'hello'}
+        res.update(fields)
+        return res
+
+    def test_accepts_a_valid_record(self):
+        res = normalize_record(self.record(session_key='7', repeat=2.0))
+        self.assertEqual(res['session_key'], 7)
+        self.assertEqual(res['repeat'], 2)
+        self.assertIsNone(res['route'])
+
+    def test_rejects_missing_or_invalid_fields(self):
+        for fields in ({'msg': None}, {'levelname': 'LOUD'}, {'ts_ns': -1}, {'ts_ns': 'soon'},
+                       {'upstream_port': 'http'}):
+            with self.subTest(fields=fields):
+                self.assertIsNone(normalize_record(self.record(**fields)))
+
+    def test_log_record_layout(self):
+        res = normalize_record({'created': '2.5', 'name': 'mnp', 'levelname': 'INFO', 'msg': 'hello'})
+        self.assertEqual(res['ts_ns'], 2500000000)
+        self.assertEqual(res['service'], 'mnp')
+
+
+if __name__ == '__main__':
+    unittest.main()
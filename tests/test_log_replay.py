@@ -0,0 +1,96 @@
+import datetime
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from typing import List
+
+from log_analyzer import log_replay
+from log_analyzer.log_replay import LogReplay
+
+START = datetime.datetime(2026, 3, 1, 12, 0, 0)
+
+
+def line(second: float, msg: str, service: str = 'mnp', session_key: str = '???', levelname: str = 'INFO') -> str:
+    asctime = (START + datetime.timedelta(seconds=second)).strftime('%Y-%m-%d %H:%M:%S,%f')[:-3]
+    return ' - '.join((asctime, service, session_key, levelname, msg)) + '\n'
+
+
+class LogReplayTest(unittest.TestCase):
+    CFG = {'detector': {'bucket_s': 1, 'min_count': 5, 'warmup_buckets': 3}}
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path, ignore_errors=True)
+        self.logger = logging.getLogger('test.log_replay')
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.propagate = False
+
+    def write(self, name: str, lines: List[str]) -> str:
+        path = os.path.join(self.path, name)
+        with open(path, 'w') as f:
+            f.write(''.join(lines))
+        return path
+
+    def test_rotated_files_come_first(self):
+        paths = ['mnp.log', 'balancer.log.1', 'mnp.log.2', 'mnp.log.1', 'balancer.log']
+        self.assertEqual(LogReplay.find_files(paths),
+                         ['balancer.log.1', 'balancer.log', 'mnp.log.2', 'mnp.log.1', 'mnp.log'])
+
+    def test_chunks_are_line_aligned(self):
+        path = self.write('mnp.log', [line(i, 'got request {}'.format(i)) for i in range(50)])
+        chunks = LogReplay({}, self.logger, chunk_bytes=200).split(path)
+        self.assertGreater(len(chunks), 1)
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.assertEqual((chunks[0][1], chunks[-1][2]), (0, len(data)))
+        for (__, __, end, __), (__, start, __, __) in zip(chunks, chunks[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[end - 1:end], b'\n')
+        self.assertEqual([ts for __, __, __, ts in chunks], sorted(ts for __, __, __, ts in chunks))
+
+    def test_chunk_of_continuation_lines_joins_the_previous_one(self):
+        traceback = ['Traceback (most recent call last):\n'] + ['  File "x.py", line {}\n'.format(i) for i in range(20)]
+        path = self.write('mnp.log', [line(0, 'boom')] + traceback)
+        self.assertEqual(len(LogReplay({}, self.logger, chunk_bytes=64).split(path)), 1)
+
+    def test_parse_chunk(self):
+        path = self.write('mnp.log', [
+            line(0, 'took 12 ms for 79000000000', session_key='42'),
+            line(1, 'boom'),
+            'Traceback (most recent call last):\n',
+            line(2, 'took 7 ms for 79000000001 (repeated 3 times)'),
+        ])
+        log_replay._init_worker({})
+        res = log_replay._parse_chunk((path, 0, os.path.getsize(path), 0))
+        self.assertEqual(res['session_key'].tolist(), [42, -1, -1])
+        self.assertEqual(res['repeat'].tolist(), [1, 1, 3])
+        template_ids = res['template_id'].tolist()
+        self.assertEqual(template_ids[0], template_ids[2])
+        self.assertEqual(res['templates'][template_ids[1]], 'boom Traceback (most recent call last):')
+        self.assertEqual(res['phones'], [(0, '79000000000'), (2, '79000000001')])
+        self.assertEqual((res['ts_ns'][1] - res['ts_ns'][0]).item(), 10 ** 9)
+
+    def test_run_finds_the_burst_whatever_the_chunking(self):
+        lines = []
+        for second in range(10):
+            for i in range(10 if second < 9 else 100):
+                lines.append(line(second + i / 1000, 'got request from {}'.format(i)))
+        # the first seconds are in the rotated file, the rest and the burst in the live one.
+        self.write('mnp.log.1', lines[:40])
+        self.write('mnp.log', lines[40:])
+        results = []
+        for jobs, chunk_bytes in ((1, 1024 * 1024), (3, 512)):
+            out = os.path.join(self.path, 'out-{}'.format(jobs))
+            LogReplay(self.CFG, self.logger, jobs=jobs, chunk_bytes=chunk_bytes).run([self.path], out)
+            with open(os.path.join(out, 'alerts.json')) as f:
+                results.append([json.loads(alert) for alert in f])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual([(a['kind'], a['observed'], a['template']) for a in results[0]],
+                         [('rate_spike', 100, 'got request from <*>')])
+
+
+if __name__ == '__main__':
+    unittest.main()
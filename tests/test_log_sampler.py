@@ -0,0 +1,74 @@
+import unittest
+from typing import Any, Mapping
+from unittest import mock
+
+from log_analyzer.log_sampler import LogSampler
+
+
+def record(levelname: str = 'INFO', template_id: int = 1, **fields) -> Mapping[str, Any]:
+    res = {'service': 'mnp', 'levelname': levelname, 'template_id': template_id}
+    res.update(fields)
+    return res
+
+
+class LogSamplerTest(unittest.TestCase):
+    def setUp(self):
+        # records over the budget are always sampled away.
+        patcher = mock.patch('log_analyzer.log_sampler.random.random', return_value=0.999)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_everything_is_kept_below_the_watermark(self):
+        sampler = LogSampler(watermark=0.5, per_template=1)
+        self.assertEqual([sampler.sample(record(), 0.4, 0) for __ in range(3)], [1, 1, 1])
+
+    def test_warnings_are_always_kept(self):
+        sampler = LogSampler(watermark=0.5, per_template=1)
+        self.assertEqual([sampler.sample(record('WARNING'), 0.99, 0) for __ in range(3)], [1, 1, 1])
+
+    def test_frequent_keys_are_thinned_and_weighted(self):
+        sampler = LogSampler(watermark=0.5, per_template=2)
+        weights = [sampler.sample(record(), 0.5, 0) for __ in range(5)]
+        self.assertEqual(weights, [1, 1, 0, 0, 0])
+        self.assertEqual(sampler.stats(), {'sampled_away': {'INFO': 3}, 'pending': 3})
+        # the next kept record stands for the ones sampled away before it.
+        self.assertEqual(sampler.sample(record(), 0.0, 0), 4)
+        self.assertEqual(sampler.stats()['pending'], 0)
+
+    def test_keys_have_budgets_of_their_own(self):
+        sampler = LogSampler(watermark=0.5, per_template=1)
+        self.assertEqual(sampler.sample(record(template_id=1), 0.5, 0), 1)
+        self.assertEqual(sampler.sample(record(template_id=2), 0.5, 0), 1)
+        self.assertEqual(sampler.sample(record(template_id=1), 0.5, 0), 0)
+
+    def test_budget_shrinks_as_the_queue_fills(self):
+        for load, kept in ((0.5, 10), (0.75, 5), (0.99, 1)):
+            with self.subTest(load=load):
+                sampler = LogSampler(watermark=0.5, per_template=10)
+                self.assertEqual(sum(1 for __ in range(20) if sampler.sample(record(), load, 0) != 0), kept)
+
+    def test_budget_is_per_window(self):
+        sampler = LogSampler(watermark=0.5, per_template=1, window_ms=1000)
+        self.assertEqual(sampler.sample(record(), 0.5, 0), 1)
+        self.assertEqual(sampler.sample(record(), 0.5, 10 ** 8), 0)
+        self.assertEqual(sampler.sample(record(), 0.5, 10 ** 9), 2)
+
+    def test_weights_count_repeats(self):
+        sampler = LogSampler(watermark=0.5, per_template=1)
+        self.assertEqual(sampler.sample(record(repeat=5), 0.0, 0), 5)
+        self.assertEqual(sampler.sample(record(), 0.5, 0), 1)
+        self.assertEqual(sampler.sample(record(repeat=3), 0.5, 0), 0)
+        self.assertEqual(sampler.sample(record(), 0.5, 0), 0)
+        self.assertEqual(sampler.stats(), {'sampled_away': {'INFO': 4}, 'pending': 4})
+        self.assertEqual(sampler.sample(record(repeat=2), 0.0, 0), 6)
+
+    def test_watermark_must_be_below_one(self):
+        self.assertIsInstance(LogSampler.from_config({'sample_watermark': 0.9}), LogSampler)
+        for watermark in (1.0, 1.5, -0.1):
+            with self.subTest(watermark=watermark):
+                with self.assertRaises(ValueError):
+                    LogSampler.from_config({'sample_watermark': watermark})
+
+
+if __name__ == '__main__':
+    unittest.main()
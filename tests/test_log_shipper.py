@@ -0,0 +1,140 @@
+import gzip
+import http.server
+import json
+import logging
+import threading
+import time
+import unittest
+from typing import List
+from unittest import mock
+
+from utils.log_shipper import BatchHTTPHandler
+
+
+class AnalyzerStub(http.server.ThreadingHTTPServer):
+    """Answers add_logs with the given statuses in turn (the last one for good) and keeps the bodies."""
+
+    def __init__(self, statuses: List[int]):
+        super().__init__(('127.0.0.1', 0), AnalyzerStubHandler)
+        self.statuses = list(statuses)
+        self.bodies: List[bytes] = []
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.01,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class AnalyzerStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.server.bodies.append(body)
+        status = self.server.statuses.pop(0) if len(self.server.statuses) > 1 else self.server.statuses[0]
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def record(msg: str) -> logging.LogRecord:
+    return logging.LogRecord('test', logging.INFO, __file__, 1, msg, (), None)
+
+
+class BatchHTTPHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.stubs: List[AnalyzerStub] = []
+        self.handlers: List[BatchHTTPHandler] = []
+
+    def tearDown(self):
+        for handler in self.handlers:
+            handler.close()
+        for stub in self.stubs:
+            stub.stop()
+
+    def ship(self, statuses: List[int], records: int = 3, **kwargs) -> (AnalyzerStub, BatchHTTPHandler):
+        stub = AnalyzerStub(statuses)
+        self.stubs.append(stub)
+        kwargs.setdefault('flush_interval_ms', 10)
+        kwargs.setdefault('backoff_ms', 1)
+        handler = BatchHTTPHandler('127.0.0.1', stub.server_address[1], '/api/v1/add_logs', **kwargs)
+        self.handlers.append(handler)
+        for i in range(records):
+            handler.emit(record('line {}'.format(i)))
+        return stub, handler
+
+    def wait_batches(self, handler: BatchHTTPHandler, batches: int = 1):
+        deadline = time.monotonic() + 5.0
+        while handler.stats()['batches'] < batches and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def test_ships_a_batch_as_ndjson(self):
+        stub, handler = self.ship([200], compress=True)
+        self.wait_batches(handler)
+        self.assertEqual(handler.stats()['shipped'], 3)
+        lines = [json.loads(line) for line in stub.bodies[0].splitlines()]
+        self.assertEqual([line['msg'] for line in lines], ['line 0', 'line 1', 'line 2'])
+
+    def test_refused_batch_is_failed_and_not_resent(self):
+        stub, handler = self.ship([400])
+        self.wait_batches(handler)
+        self.assertEqual(handler.stats()['shipped'], 0)
+        self.assertEqual(handler.stats()['failed'], 3)
+        self.assertEqual(len(stub.bodies), 1)
+
+    def test_server_errors_are_retried(self):
+        stub, handler = self.ship([500, 503, 200], max_retries=3)
+        self.wait_batches(handler)
+        self.assertEqual(handler.stats()['shipped'], 3)
+        self.assertEqual(len(stub.bodies), 3)
+
+    def test_retries_back_off_exponentially_with_jitter(self):
+        waits = []
+
+        def uniform(low: float, high: float) -> float:
+            waits.append((low, high))
+            return high
+
+        with mock.patch('utils.log_shipper.random.uniform', side_effect=uniform):
+            stub, handler = self.ship([500], max_retries=3, backoff_ms=10, max_backoff_ms=25)
+            start = time.monotonic()
+            self.wait_batches(handler)
+            elapsed_s = time.monotonic() - start
+        self.assertEqual(handler.stats()['failed'], 3)
+        self.assertEqual(len(stub.bodies), 4)
+        # no wait after the last attempt.
+        self.assertEqual(waits, [(0.0, 0.01), (0.0, 0.02), (0.0, 0.025)])
+        self.assertGreaterEqual(elapsed_s, 0.055)
+
+    def test_throttled_batch_is_resent_after_retry_after(self):
+        stub, handler = self.ship([429, 200])
+        self.wait_batches(handler)
+        self.assertEqual(handler.stats()['shipped'], 3)
+        self.assertEqual(handler.stats()['throttled'], 1)
+
+    def test_overflow_policies(self):
+        for policy, kept in ((BatchHTTPHandler.OVERFLOW_DROP_NEWEST, ['line 0', 'line 1']),
+                             (BatchHTTPHandler.OVERFLOW_DROP_OLDEST, ['line 1', 'line 2'])):
+            with self.subTest(policy=policy):
+                # the worker waits for a full batch, which never comes, so the queue overflows first.
+                stub, handler = self.ship([200], queue_size=2, batch_size=10, flush_interval_ms=200,
+                                          overflow_policy=policy)
+                self.wait_batches(handler)
+                self.assertEqual(handler.stats()['dropped'], 1)
+                self.assertEqual([json.loads(line)['msg'] for line in stub.bodies[0].splitlines()], kept)
+
+    def test_unknown_overflow_policy(self):
+        with self.assertRaises(ValueError):
+            BatchHTTPHandler('127.0.0.1', 1, '/', overflow_policy='nope')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from log_analyzer.log_storage import LogStorage, Segment
+
+
+def record(ts_ns: int, msg: str = 'hello') -> dict:
+    return {'ts_ns': ts_ns, 'msg': msg}
+
+
+class LogStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def storage(self, **kwargs) -> LogStorage:
+        kwargs.setdefault('index_interval_bytes', 64)
+        storage = LogStorage(self.path, **kwargs)
+        self.addCleanup(storage.close)
+        return storage
+
+    def test_scan_returns_the_time_range(self):
+        storage = self.storage()
+        # slightly out of order, as records of several services arrive.
+        for ts in (10, 30, 20, 40, 50, 45):
+            storage.append(record(ts))
+        self.assertEqual(sorted(r['ts_ns'] for r in storage.scan(20, 45)), [20, 30, 40, 45])
+        self.assertEqual(list(storage.scan(60, 70)), [])
+
+    def test_read_at_and_read_many(self):
+        storage = self.storage()
+        positions = [storage.append(record(ts, str(ts))) for ts in range(5)]
+        seq, offset = positions[3]
+        self.assertEqual(storage.read_at(seq, offset)['msg'], '3')
+        offsets = [offset for __, offset in positions[1:3]]
+        self.assertEqual([r['msg'] for __, r in storage.read_many(seq, offsets)], ['1', '2'])
+        self.assertIsNone(storage.read_at(seq + 1, 0))
+
+    def test_rolls_over_by_size(self):
+        storage = self.storage(segment_max_bytes=100)
+        for ts in range(10):
+            storage.append(record(ts))
+        self.assertGreater(len(storage.segments()), 1)
+        self.assertEqual([r['ts_ns'] for r in storage.scan(0, 9)], list(range(10)))
+
+    def test_reopened_store_has_every_record(self):
+        storage = self.storage(segment_max_bytes=100)
+        for ts in range(10):
+            storage.append(record(ts))
+        storage.close()
+        reopened = self.storage(segment_max_bytes=100)
+        self.assertEqual(reopened.segments(), storage.segments())
+        self.assertEqual([r['ts_ns'] for r in reopened.scan(3, 6)], [3, 4, 5, 6])
+
+    def test_partial_record_left_by_a_crash_is_dropped(self):
+        storage = self.storage()
+        storage.append(record(1))
+        storage.append(record(2))
+        storage.close()
+        data_path = os.path.join(self.path, '{:010d}{}'.format(0, Segment.DATA_SUFFIX))
+        size = os.path.getsize(data_path)
+        with open(data_path, 'ab') as f:
+            f.write(Segment.RECORD_HEADER.pack(100, 3) + b'{"ts')
+        reopened = self.storage()
+        self.assertEqual(os.path.getsize(data_path), size)
+        self.assertEqual([r['ts_ns'] for r in reopened.scan(0, 10)], [1, 2])
+        reopened.append(record(4))
+        self.assertEqual([r['ts_ns'] for r in reopened.scan(0, 10)], [1, 2, 4])
+
+    def test_retention_by_bytes_keeps_the_active_segment(self):
+        storage = self.storage(segment_max_bytes=100, retention_bytes=150)
+        now = time.time_ns()
+        for i in range(10):
+            storage.append(record(now + i))
+        before = storage.segments()
+        removed = storage.enforce_retention()
+        self.assertEqual(removed, [seq for seq, __, __ in before[:len(removed)]])
+        self.assertLessEqual(storage.stats()['bytes'], 150)
+        self.assertEqual(storage.segments()[-1], before[-1])
+
+    def test_retention_by_age(self):
+        storage = self.storage(segment_max_bytes=100, retention_age_s=60)
+        old = time.time_ns() - 3600 * 10 ** 9
+        for i in range(5):
+            storage.append(record(old + i))
+        storage.append(record(time.time_ns()))
+        storage.enforce_retention()
+        self.assertEqual(len(storage.segments()), 1)
+
+
+class ReadOnlyLogStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path, ignore_errors=True)
+
+    def owner(self, **kwargs) -> LogStorage:
+        owner = LogStorage(self.path, segment_max_bytes=100, index_interval_bytes=64, **kwargs)
+        self.addCleanup(owner.close)
+        return owner
+
+    def reader(self, path: str = None) -> LogStorage:
+        reader = LogStorage(path or self.path, index_interval_bytes=64, read_only=True)
+        self.addCleanup(reader.close)
+        return reader
+
+    def test_refresh_follows_the_owner(self):
+        owner = self.owner()
+        owner.append(record(1))
+        owner.flush()
+        reader = self.reader()
+        self.assertEqual([r['ts_ns'] for r in reader.scan(0, 100)], [1])
+
+        for ts in range(2, 10):
+            owner.append(record(ts))
+        owner.flush()
+        reader.refresh()
+        self.assertEqual(reader.segments(), owner.segments())
+        self.assertEqual([r['ts_ns'] for r in reader.scan(0, 100)], list(range(1, 10)))
+
+    def test_refresh_drops_segments_removed_by_the_owner(self):
+        owner = self.owner(retention_bytes=150)
+        now = time.time_ns()
+        for i in range(10):
+            owner.append(record(now + i))
+        owner.flush()
+        reader = self.reader()
+        removed = owner.enforce_retention()
+        self.assertNotEqual(removed, [])
+        reader.refresh()
+        self.assertEqual(reader.segments(), owner.segments())
+        self.assertFalse(reader.has_segment(removed[0]))
+
+    def test_read_only_store_writes_nothing(self):
+        missing = os.path.join(self.path, 'missing')
+        reader = self.reader(missing)
+        reader.refresh()
+        self.assertEqual(reader.segments(), [])
+        self.assertFalse(os.path.exists(missing))
+
+
+if __name__ == '__main__':
+    unittest.main()
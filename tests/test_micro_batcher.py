@@ -0,0 +1,80 @@
+import asyncio
+import unittest
+from typing import Any, Hashable, List, Mapping
+
+from utils.micro_batcher import MicroBatcher
+
+
+class MicroBatcherTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dispatched = []
+
+    async def dispatch(self, group: Hashable, keys: List[Hashable], tags: List[Any]) -> Mapping[Hashable, Any]:
+        self.dispatched.append((group, keys, tags))
+        # the key 'missing' gets no result.
+        return {key: '{}:{}'.format(group, key) for key in keys if key != 'missing'}
+
+    async def test_concurrent_calls_fan_out_from_one_dispatch(self):
+        batcher = MicroBatcher(self.dispatch, max_delay_ms=5.0)
+        results = await asyncio.gather(batcher.load('g', 'a', 1), batcher.load('g', 'b', 2),
+                                       batcher.load('g', 'a', 3), batcher.load('g', 'missing', 4))
+        self.assertEqual(results, ['g:a', 'g:b', 'g:a', None])
+        # a key asked for twice takes one slot, the tags of both calls go along.
+        self.assertEqual(self.dispatched, [('g', ['a', 'b', 'missing'], [1, 2, 3, 4])])
+        self.assertEqual(batcher.stats()['calls'], 4)
+        self.assertEqual(batcher.stats()['keys'], 3)
+
+    async def test_groups_are_dispatched_apart(self):
+        batcher = MicroBatcher(self.dispatch, max_delay_ms=5.0)
+        results = await asyncio.gather(batcher.load('g', 'a'), batcher.load('h', 'a'))
+        self.assertEqual(results, ['g:a', 'h:a'])
+        self.assertEqual(len(self.dispatched), 2)
+
+    async def test_max_items_flushes_at_once(self):
+        batcher = MicroBatcher(self.dispatch, max_delay_ms=10000.0, max_items=2)
+        results = await asyncio.wait_for(asyncio.gather(batcher.load('g', 'a'), batcher.load('g', 'b')), 1.0)
+        self.assertEqual(results, ['g:a', 'g:b'])
+
+    async def test_failed_dispatch_fails_every_call(self):
+        async def dispatch(group, keys, tags):
+            raise ValueError('broken')
+
+        batcher = MicroBatcher(dispatch, max_delay_ms=1.0)
+        results = await asyncio.gather(batcher.load('g', 'a'), batcher.load('g', 'b'), return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    async def test_cancelled_dispatch_leaves_no_call_waiting(self):
+        async def dispatch(group, keys, tags):
+            # e.g. the loop shutting down while callers still wait.
+            asyncio.current_task().cancel()
+            await asyncio.sleep(10.0)
+
+        batcher = MicroBatcher(dispatch, max_delay_ms=1.0)
+        calls = [asyncio.ensure_future(batcher.load('g', key)) for key in ('a', 'b')]
+        results = await asyncio.wait_for(asyncio.gather(*calls, return_exceptions=True), 1.0)
+        self.assertTrue(all(isinstance(result, asyncio.CancelledError) for result in results))
+
+    async def test_batch_is_cancelled_once_every_caller_went_away(self):
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def dispatch(group, keys, tags):
+            started.set()
+            try:
+                await asyncio.sleep(10.0)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        batcher = MicroBatcher(dispatch, max_delay_ms=1.0)
+        calls = [asyncio.ensure_future(batcher.load('g', key)) for key in ('a', 'b')]
+        await started.wait()
+        calls[0].cancel()
+        await asyncio.sleep(0.01)
+        self.assertFalse(cancelled.is_set())
+        calls[1].cancel()
+        await asyncio.wait_for(cancelled.wait(), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
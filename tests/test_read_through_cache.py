@@ -0,0 +1,86 @@
+import asyncio
+import unittest
+
+from utils.read_through_cache import ReadThroughCache
+
+
+class ReadThroughCacheTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cache = ReadThroughCache(len, max_bytes=1024 * 1024, ttl_s=60.0)
+        self.fetches = 0
+
+    def fetcher(self, value: str, gate: asyncio.Event = None):
+        async def fetch():
+            self.fetches += 1
+            if gate is not None:
+                await gate.wait()
+            return value
+        return fetch
+
+    async def test_concurrent_misses_share_one_fetch(self):
+        gate = asyncio.Event()
+        calls = [asyncio.ensure_future(self.cache.get('7', 'q', self.fetcher('old', gate))) for __ in range(3)]
+        await asyncio.sleep(0)
+        gate.set()
+        self.assertEqual(await asyncio.gather(*calls), ['old'] * 3)
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(await self.cache.get('7', 'q', self.fetcher('new')), 'old')
+        self.assertEqual(self.cache.stats()['coalesced'], 2)
+
+    async def test_fetch_in_flight_at_invalidation_is_not_cached(self):
+        gate = asyncio.Event()
+        before = asyncio.ensure_future(self.cache.get('7', 'q', self.fetcher('old', gate)))
+        await asyncio.sleep(0)
+        self.cache.invalidate('7')
+        # a read that starts after the invalidation does not join the fetch that started before it.
+        after = asyncio.ensure_future(self.cache.get('7', 'q', self.fetcher('new')))
+        gate.set()
+        self.assertEqual(await before, 'old')
+        self.assertEqual(await after, 'new')
+        self.assertEqual(self.fetches, 2)
+        self.assertEqual(await self.cache.get('7', 'q', self.fetcher('newer')), 'new')
+
+    async def test_stale_fetch_does_not_overwrite_a_newer_result(self):
+        gate = asyncio.Event()
+        before = asyncio.ensure_future(self.cache.get('7', 'q', self.fetcher('old', gate)))
+        await asyncio.sleep(0)
+        self.cache.invalidate('7')
+        self.assertEqual(await self.cache.get('7', 'q', self.fetcher('new')), 'new')
+        gate.set()
+        await before
+        self.assertEqual(await self.cache.get('7', 'q', self.fetcher('newer')), 'new')
+
+    async def test_result_of_a_lower_version_is_refetched(self):
+        self.assertEqual(await self.cache.get('7', 'q', self.fetcher('old'), 1), 'old')
+        self.assertEqual(await self.cache.get('7', 'q', self.fetcher('other'), 1), 'old')
+        self.assertEqual(await self.cache.get('7', 'q', self.fetcher('new'), 2), 'new')
+        # a lower version is served the newer result.
+        self.assertEqual(await self.cache.get('7', 'q', self.fetcher('other'), 0), 'new')
+        self.assertEqual(self.fetches, 2)
+
+    async def test_fetch_of_a_lower_version_is_not_joined(self):
+        gate = asyncio.Event()
+        low = asyncio.ensure_future(self.cache.get('7', 'q', self.fetcher('old', gate), 1))
+        await asyncio.sleep(0)
+        high = asyncio.ensure_future(self.cache.get('7', 'q', self.fetcher('new'), 2))
+        self.assertEqual(await high, 'new')
+        gate.set()
+        self.assertEqual(await low, 'old')
+        self.assertEqual(await self.cache.get('7', 'q', self.fetcher('other'), 2), 'new')
+
+    async def test_fetch_is_cancelled_once_every_caller_went_away(self):
+        gate = asyncio.Event()
+        calls = [asyncio.ensure_future(self.cache.get('7', 'q', self.fetcher('old', gate))) for __ in range(2)]
+        await asyncio.sleep(0)
+        calls[0].cancel()
+        await asyncio.sleep(0)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+        calls[1].cancel()
+        await asyncio.gather(*calls, return_exceptions=True)
+        # a later miss starts a fetch of its own.
+        self.assertEqual(await self.cache.get('7', 'q', self.fetcher('new')), 'new')
+        self.assertEqual(self.fetches, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+from typing import Any, Mapping, Optional
+from unittest import mock
+
+from utils.backend_pool import Backend
+from utils.replica_router import ReplicaRouter
+
+
+class _Response:
+    def __init__(self, data: Optional[Mapping[str, Any]]):
+        self.status = 200 if data is not None else 503
+        self.__data = data
+
+    async def json(self) -> Mapping[str, Any]:
+        return {'code': 0, 'data': self.__data}
+
+    async def __aenter__(self) -> '_Response':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+
+class _Client:
+    """Answers status polls with whatever the test set last."""
+
+    def __init__(self):
+        self.status: Optional[Mapping[str, Any]] = None
+
+    def get(self, path: str, timeout: Any = None) -> _Response:
+        return _Response(self.status)
+
+
+class ReplicaRouterRefreshTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.clients = [_Client() for __ in range(3)]
+        self.primary, *replicas = (Backend('db', port, client) for port, client in enumerate(self.clients))
+        self.router = ReplicaRouter(self.primary, replicas, primary_reads=False, max_lag_ms=1000.0)
+        self.now = 100.0
+
+    def set_positions(self, *positions_ts):
+        for client, (position, position_ts) in zip(self.clients, positions_ts):
+            client.status = {'position': position, 'position_ts': position_ts}
+
+    async def refresh_at(self, now: float) -> Mapping[str, Any]:
+        # the clock of the router only, the event loop keeps its own.
+        with mock.patch('utils.replica_router.time') as clock:
+            clock.monotonic.return_value = now
+            await self.router.refresh('/api/v1/status', 100)
+        return {db['port']: db for db in self.router.stats()['databases']}
+
+    async def test_caught_up_replicas_have_no_lag(self):
+        self.set_positions((5, 50.0), (5, 50.0), (5, 50.0))
+        dbs = await self.refresh_at(100.0)
+        self.assertEqual([dbs[port]['lag_ms'] for port in (1, 2)], [0.0, 0.0])
+
+    async def test_lag_grows_while_a_replica_is_stuck(self):
+        self.set_positions((5, 50.0), (5, 50.0), (5, 50.0))
+        await self.refresh_at(100.0)
+        # the primary takes a write, replica 2 applies it, replica 1 does not.
+        self.set_positions((6, 50.5), (5, 50.0), (6, 50.5))
+        dbs = await self.refresh_at(101.0)
+        self.assertAlmostEqual(dbs[1]['lag_ms'], 500.0)
+        self.assertEqual(dbs[2]['lag_ms'], 0.0)
+        # no more writes: replica 1 is behind since the primary was first seen at 6, at 101.0.
+        dbs = await self.refresh_at(103.0)
+        self.assertAlmostEqual(dbs[1]['lag_ms'], 2000.0)
+
+    async def test_lag_counts_from_the_first_write_a_replica_misses(self):
+        self.set_positions((5, 50.0), (5, 50.0), (5, 50.0))
+        await self.refresh_at(100.0)
+        self.set_positions((6, 50.0), (5, 50.0), (6, 50.0))
+        await self.refresh_at(101.0)
+        self.set_positions((7, 50.0), (6, 50.0), (7, 50.0))
+        dbs = await self.refresh_at(102.0)
+        # replica 1 has 6, the primary was first seen past it (at 7) at 102.0.
+        self.assertEqual(dbs[1]['lag_ms'], 0.0)
+        dbs = await self.refresh_at(102.25)
+        self.assertAlmostEqual(dbs[1]['lag_ms'], 250.0)
+
+    async def test_lagging_replica_takes_no_reads(self):
+        self.set_positions((5, 50.0), (5, 50.0), (5, 50.0))
+        await self.refresh_at(100.0)
+        self.set_positions((6, 50.0), (5, 50.0), (6, 50.0))
+        await self.refresh_at(101.0)
+        await self.refresh_at(103.0)
+        self.assertTrue(all(self.router.pick_read().port == 2 for __ in range(20)))
+
+    async def test_unreachable_database_keeps_its_last_position(self):
+        self.set_positions((5, 50.0), (5, 50.0), (5, 50.0))
+        await self.refresh_at(100.0)
+        self.clients[1].status = None
+        dbs = await self.refresh_at(101.0)
+        self.assertFalse(dbs[1]['reachable'])
+        self.assertEqual(dbs[1]['position'], 5)
+
+    async def test_writes_are_forgotten_once_every_replica_has_them(self):
+        self.set_positions((5, 50.0), (4, 50.0), (5, 50.0))
+        await self.refresh_at(100.0)
+        self.router.written(5, ('session', 1))
+        self.assertEqual(self.router.required_position(('session', 1)), 5)
+        self.assertEqual(self.router.pick_read(5).port, 2)
+        self.set_positions((5, 50.0), (5, 50.0), (5, 50.0))
+        await self.refresh_at(101.0)
+        self.assertEqual(self.router.required_position(('session', 1)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
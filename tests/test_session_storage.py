@@ -0,0 +1,98 @@
+import time
+import unittest
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from aiohttp_session import Session
+
+from utils.session_storage import SignedCookieStorage
+
+COOKIE_NAME = 'AIOHTTP_SESSION'
+
+
+def request(cookie: str = None) -> web.Request:
+    headers = {'Cookie': '{}={}'.format(COOKIE_NAME, cookie)} if cookie is not None else {}
+    return make_mocked_request('GET', '/', headers=headers)
+
+
+class SessionStorageTestCase(unittest.IsolatedAsyncioTestCase):
+    async def save(self, storage: SignedCookieStorage, session: Session) -> str:
+        resp = web.Response()
+        await storage.save_session(request(), resp, session)
+        return resp.cookies[COOKIE_NAME].value
+
+    async def login(self, storage: SignedCookieStorage, session_key: int = 42) -> str:
+        session = await storage.load_session(request())
+        session['login'] = 'user'
+        session['session_key'] = session_key
+        return await self.save(storage, session)
+
+
+class SignedCookieStorageTest(SessionStorageTestCase):
+    async def test_another_balancer_with_the_secret_accepts_the_cookie(self):
+        cookie = await self.login(SignedCookieStorage(b'secret'))
+        session = await SignedCookieStorage(b'secret').load_session(request(cookie))
+        self.assertFalse(session.new)
+        self.assertEqual((session['login'], session['session_key']), ('user', 42))
+
+    async def test_forged_cookies_are_rejected(self):
+        cookie = await self.login(SignedCookieStorage(b'secret'))
+        payload, __, signature = cookie.partition('.')
+        forged = await self.login(SignedCookieStorage(b'other'), session_key=43)
+        for bad in (forged, forged.partition('.')[0] + '.' + signature, payload + '.' + signature[::-1],
+                    payload, 'not base64!.' + signature, ''):
+            with self.subTest(cookie=bad):
+                session = await SignedCookieStorage(b'secret').load_session(request(bad))
+                self.assertTrue(session.new)
+                self.assertNotIn('session_key', session)
+
+    async def test_verified_cookies_are_cached(self):
+        storage = SignedCookieStorage(b'secret', cache_size=1)
+        cookie = await self.login(storage)
+        # the cookie the storage signed itself is known already.
+        for __ in range(3):
+            await storage.load_session(request(cookie))
+        self.assertEqual((storage.hits, storage.misses), (3, 0))
+        other = await self.login(SignedCookieStorage(b'secret'), session_key=43)
+        await storage.load_session(request(other))
+        await storage.load_session(request(cookie))
+        self.assertEqual((storage.hits, storage.misses), (3, 2))
+
+    async def test_expired_session_is_empty(self):
+        storage = SignedCookieStorage(b'secret', max_age=60)
+        cookie = await self.login(storage)
+        with mock.patch('aiohttp_session.time.time', return_value=time.time() + 61):
+            session = await storage.load_session(request(cookie))
+        self.assertTrue(session.empty)
+
+    async def test_logout_clears_the_cookie(self):
+        storage = SignedCookieStorage(b'secret')
+        session = await storage.load_session(request(await self.login(storage)))
+        session.clear()
+        resp = web.Response()
+        await storage.save_session(request(), resp, session)
+        self.assertEqual(resp.cookies[COOKIE_NAME].value, '')
+
+
+class ServerSideSessionTest(SessionStorageTestCase):
+    async def test_logout_revokes_the_session(self):
+        storage = SignedCookieStorage(b'secret', server_side=True)
+        cookie = await self.login(storage)
+        session = await storage.load_session(request(cookie))
+        self.assertEqual(session['session_key'], 42)
+        session.clear()
+        await self.save(storage, session)
+        # a copy of the cookie kept by the client is no good any more.
+        self.assertTrue((await storage.load_session(request(cookie))).new)
+
+    async def test_oldest_sessions_are_dropped(self):
+        storage = SignedCookieStorage(b'secret', server_side=True, max_sessions=1)
+        first = await self.login(storage)
+        second = await self.login(storage, session_key=43)
+        self.assertTrue((await storage.load_session(request(first))).new)
+        self.assertFalse((await storage.load_session(request(second))).new)
+
+
+if __name__ == '__main__':
+    unittest.main()
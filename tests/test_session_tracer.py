@@ -0,0 +1,84 @@
+import unittest
+from typing import Any, List, Mapping
+
+from log_analyzer.session_tracer import SessionTracer
+
+S = 10 ** 9
+
+
+def record(session_key: int, ts_ns: int, service: str = 'mnp', **fields) -> Mapping[str, Any]:
+    res = {'session_key': session_key, 'ts_ns': ts_ns, 'service': service, 'levelname': 'INFO', 'route': None,
+           'template_id': 1, 'upstream_host': None, 'upstream_port': None, 'duration_ms': None}
+    res.update(fields)
+    return res
+
+
+class SessionTracerTest(unittest.TestCase):
+    def setUp(self):
+        self.flushed: List[Mapping[str, Any]] = []
+
+    def tracer(self, **kwargs) -> SessionTracer:
+        return SessionTracer(self.flushed.append, **kwargs)
+
+    def test_records_without_a_session_are_ignored(self):
+        tracer = self.tracer()
+        tracer.add(record(None, 1), 0)
+        self.assertEqual(tracer.stats()['active'], 0)
+
+    def test_idle_sessions_expire_after_the_ttl(self):
+        tracer = self.tracer(ttl_s=10)
+        tracer.add(record(1, 100), 0)
+        tracer.add(record(2, 200), 5 * S)
+        tracer.expire(9 * S)
+        self.assertEqual(self.flushed, [])
+        tracer.expire(10 * S)
+        self.assertEqual([s['session_key'] for s in self.flushed], [1])
+        self.assertIsNone(tracer.get(1))
+        self.assertIsNotNone(tracer.get(2))
+
+    def test_activity_keeps_a_session_alive(self):
+        tracer = self.tracer(ttl_s=10)
+        tracer.add(record(1, 100), 0)
+        tracer.add(record(2, 200), 1 * S)
+        tracer.add(record(1, 300), 8 * S)
+        tracer.expire(12 * S)
+        self.assertEqual([s['session_key'] for s in self.flushed], [2])
+
+    def test_oldest_session_is_evicted_over_the_limit(self):
+        tracer = self.tracer(max_sessions=2)
+        for session_key in (1, 2, 1, 3):
+            tracer.add(record(session_key, session_key), 0)
+        self.assertEqual([s['session_key'] for s in self.flushed], [2])
+        self.assertEqual(tracer.stats(), {'active': 2, 'flushed': 1, 'evicted': 1})
+
+    def test_events_are_capped(self):
+        tracer = self.tracer(max_events=2)
+        for ts in range(3):
+            tracer.add(record(1, ts), 0)
+        tracer.flush_all()
+        self.assertEqual((self.flushed[0]['events'], self.flushed[0]['truncated']), (2, True))
+
+    def test_summary_sorts_events_with_none_fields(self):
+        tracer = self.tracer()
+        # same timestamps, so sorting whole events would compare the None routes and hosts.
+        tracer.add(record(1, 50 * 10 ** 6, 'balancer', route='/api/v1/x', upstream_host='mnp',
+                          upstream_port=10000, duration_ms=40.0), 0)
+        tracer.add(record(1, 50 * 10 ** 6), 0)
+        tracer.add(record(1, 30 * 10 ** 6, upstream_host='db', upstream_port=5432, duration_ms=15.0), 0)
+        tracer.flush_all()
+        summary = self.flushed[0]
+        self.assertEqual((summary['ts_ns'], summary['end_ts_ns']), (30 * 10 ** 6, 50 * 10 ** 6))
+        self.assertEqual(summary['services'], ['balancer', 'mnp'])
+        self.assertEqual(summary['requests'], [{
+            'ts_ns': 10 * 10 ** 6,
+            'route': '/api/v1/x',
+            'mnp': 'mnp:10000',
+            'database': 'db:5432',
+            'total_ms': 40.0,
+            'balancer_to_mnp_ms': 25.0,
+            'mnp_to_db_ms': 15.0,
+        }])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from log_analyzer.template_miner import WILDCARD, TemplateMiner
+
+
+class TemplateMinerTest(unittest.TestCase):
+    def test_similar_messages_share_a_template(self):
+        miner = TemplateMiner()
+        first, __ = miner.add('user logged in alice')
+        second, params = miner.add('user logged in bob')
+        self.assertEqual(first, second)
+        self.assertEqual(params, ['bob'])
+        self.assertEqual(miner.template(first).tokens, ['user', 'logged', 'in', WILDCARD])
+        self.assertEqual(miner.template(first).count, 2)
+
+    def test_tokens_with_digits_are_parameters(self):
+        miner = TemplateMiner()
+        template_id, params = miner.add('took 12 ms for 79000000000')
+        self.assertEqual(params, ['12', '79000000000'])
+        self.assertEqual(miner.add('took 7 ms for 79000000001')[0], template_id)
+        self.assertEqual(str(miner.template(template_id)), 'took <*> ms for <*>')
+
+    def test_different_messages_get_different_templates(self):
+        miner = TemplateMiner(sim_th=0.5)
+        self.assertNotEqual(miner.add('connection refused by peer')[0], miner.add('request served from cache')[0])
+        # the token count comes first in the tree, so lengths never mix.
+        self.assertNotEqual(miner.add('a b c')[0], miner.add('a b c d')[0])
+
+    def test_repeated_shapes_skip_the_tree(self):
+        miner = TemplateMiner()
+        for port in range(5):
+            miner.add('listening on {}'.format(port))
+        stats = miner.stats()
+        self.assertEqual(stats['tree_matches'], 1)
+        self.assertEqual(stats['lru_hits'], 4)
+
+    def test_lru_is_bounded(self):
+        miner = TemplateMiner(lru_size=2)
+        for word in ('a', 'b', 'c'):
+            miner.add('got ' + word)
+        self.assertEqual(miner.stats()['lru_size'], 2)
+
+    def test_full_node_routes_to_the_wildcard_child(self):
+        miner = TemplateMiner(max_children=1)
+        first, __ = miner.add('alpha one two')
+        second, __ = miner.add('beta one two')
+        self.assertNotEqual(first, second)
+        self.assertEqual(miner.add('gamma one two')[0], second)
+
+
+class TemplateMinerRestartTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.templates_path = os.path.join(self.path, 'templates.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def restarted(self, miner: TemplateMiner, **kwargs) -> TemplateMiner:
+        miner.save(self.templates_path)
+        res = TemplateMiner(**kwargs)
+        res.load(self.templates_path)
+        return res
+
+    def test_missing_file_is_an_empty_miner(self):
+        miner = TemplateMiner()
+        miner.load(self.templates_path)
+        self.assertEqual(miner.templates(), [])
+
+    def test_templates_keep_their_ids_and_counts(self):
+        miner = TemplateMiner()
+        for msg in ('user logged in alice', 'user logged in bob', 'disk full'):
+            miner.add(msg)
+        miner.set_global_id(1, 7)
+        restarted = self.restarted(miner)
+        self.assertEqual([(t.id, t.tokens, t.count, t.global_id) for t in restarted.templates()],
+                         [(t.id, t.tokens, t.count, t.global_id) for t in miner.templates()])
+
+    def test_template_mined_under_the_wildcard_child_is_found_again(self):
+        kwargs = {'max_children': 1, 'sim_th': 0.5}
+        miner = TemplateMiner(**kwargs)
+        msgs = ['alpha one two', 'beta one two', 'gamma one two']
+        ids = [miner.add(msg)[0] for msg in msgs]
+        # 'beta' is not a child of the full node, so its template lives under the wildcard child.
+        restarted = self.restarted(miner, **kwargs)
+        self.assertEqual([restarted.add(msg)[0] for msg in msgs], ids)
+        self.assertEqual(len(restarted.templates()), len(miner.templates()))
+
+    def test_cached_shapes_keep_matching_after_a_restart(self):
+        kwargs = {'depth': 3, 'sim_th': 0.7}
+        miner = TemplateMiner(**kwargs)
+        # wildcards do not count as similar, so in the tree 'a d <*>' misses even the template it made; only the
+        # cache sends it there.
+        msgs = ['a d 1', 'a d 2']
+        ids = [miner.add(msg)[0] for msg in msgs]
+        restarted = self.restarted(miner, **kwargs)
+        self.assertEqual([restarted.add(msg)[0] for msg in msgs], ids)
+        self.assertEqual(len(restarted.templates()), len(miner.templates()))
+
+    def test_local_ids_by_global_id(self):
+        miner = TemplateMiner()
+        miner.add('disk full')
+        miner.add('user logged in alice')
+        miner.set_global_id(0, 3)
+        miner.set_global_id(1, 3)
+        miner.save(self.templates_path)
+        self.assertEqual(TemplateMiner.load_local_ids(self.templates_path), {3: [0, 1]})
+        self.assertEqual(miner.local_ids(), {3: [0, 1]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,368 @@
+import asyncio
+import collections
+import math
+import random
+import time
+from typing import Any, Deque, List, Mapping, Optional
+
+import aiohttp
+
+from utils.concurrency_limiter import ConcurrencyLimiter
+
+
+class CircuitBreaker:
+    """Per-backend circuit breaker.
+
+    closed: requests flow, outcomes of the last `window` requests are watched;
+    open: the backend is ejected for an ejection time that doubles with every consecutive ejection;
+    half_open: after that time up to `half_open_requests` trial requests are let through, the backend is
+    re-admitted when they all succeed and ejected again on the first failure.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window: int = 20, min_requests: int = 10, max_error_rate: float = 0.5,
+                 max_consecutive_failures: int = 5, base_ejection_s: float = 5.0, max_ejection_s: float = 60.0,
+                 half_open_requests: int = 1):
+        self.__outcomes: Deque[bool] = collections.deque(maxlen=window)
+        self.__errors = 0
+        self.__min_requests = min_requests
+        self.__max_error_rate = max_error_rate
+        self.__max_consecutive_failures = max_consecutive_failures
+        self.__base_ejection_s = base_ejection_s
+        self.__max_ejection_s = max_ejection_s
+        self.__half_open_requests = half_open_requests
+
+        self.state = self.CLOSED
+        self.__consecutive_failures = 0
+        self.__open_until = 0.0
+        self.__ejections = 0
+        self.__trials = 0
+        self.__trial_successes = 0
+
+        self.ejected = 0
+
+    def available(self) -> bool:
+        if self.state == self.OPEN and time.monotonic() >= self.__open_until:
+            self.state = self.HALF_OPEN
+            self.__trials = 0
+            self.__trial_successes = 0
+        if self.state == self.HALF_OPEN:
+            return self.__trials < self.__half_open_requests
+        return self.state == self.CLOSED
+
+    def acquire(self) -> None:
+        if self.state == self.HALF_OPEN:
+            self.__trials += 1
+
+    def record(self, ok: bool) -> bool:
+        """Accounts a request outcome; returns True if the backend should be ejected."""
+        if self.state == self.HALF_OPEN:
+            if not ok:
+                return True
+            self.__trial_successes += 1
+            if self.__trial_successes >= self.__half_open_requests:
+                self.close()
+            return False
+        if self.state == self.OPEN:
+            # answers of requests sent before the ejection.
+            return False
+
+        if len(self.__outcomes) == self.__outcomes.maxlen and not self.__outcomes[0]:
+            self.__errors -= 1
+        self.__outcomes.append(ok)
+        if not ok:
+            self.__errors += 1
+            self.__consecutive_failures += 1
+        else:
+            self.__consecutive_failures = 0
+        return (self.__consecutive_failures >= self.__max_consecutive_failures or
+                (len(self.__outcomes) >= self.__min_requests and
+                 self.__errors > self.__max_error_rate * len(self.__outcomes)))
+
+    def release(self) -> None:
+        """Gives back the trial of a request abandoned without an outcome."""
+        if self.state == self.HALF_OPEN and self.__trials > 0:
+            self.__trials -= 1
+
+    def trip(self) -> None:
+        # a failed probe of an ejected backend keeps it out, the ejection time only grows on re-admission trials.
+        if self.state != self.OPEN:
+            self.__ejections += 1
+            self.ejected += 1
+        self.state = self.OPEN
+        ejection_s = min(self.__base_ejection_s * 2 ** (self.__ejections - 1), self.__max_ejection_s)
+        self.__open_until = time.monotonic() + ejection_s
+
+    def close(self) -> None:
+        self.state = self.CLOSED
+        self.__ejections = 0
+        self.__outcomes.clear()
+        self.__errors = 0
+        self.__consecutive_failures = 0
+
+
+class Backend:
+    """An upstream server: its client session plus the load it is carrying and how fast it answers."""
+
+    def __init__(self, host: str, port: int, client: aiohttp.ClientSession, weight: int = 1,
+                 ewma_alpha: float = 0.3, decay_s: float = 10.0, breaker: Optional[CircuitBreaker] = None,
+                 limiter: Optional[ConcurrencyLimiter] = None):
+        self.host = host
+        self.port = port
+        self.client = client
+        self.weight = weight
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.limiter = limiter
+
+        self.__alpha = ewma_alpha
+        self.__decay_s = decay_s
+        self.in_flight = 0
+        # None until the first response, unknown backends are tried first.
+        self.latency_ms: Optional[float] = None
+        self.__updated = 0.0
+
+        self.requests = 0
+        self.errors = 0
+
+    def __str__(self) -> str:
+        return '{}:{}'.format(self.host, self.port)
+
+    def start(self) -> float:
+        self.in_flight += 1
+        self.requests += 1
+        if self.limiter is not None:
+            self.limiter.take()
+        return time.monotonic()
+
+    def finish(self, start: float, ok: bool = True) -> float:
+        """Accounts a finished request started at `start`; returns its duration in ms."""
+        self.in_flight -= 1
+        self.__updated = time.monotonic()
+        duration_ms = (self.__updated - start) * 1000.0
+        if not ok:
+            self.errors += 1
+        if self.latency_ms is None:
+            self.latency_ms = duration_ms
+        else:
+            self.latency_ms += self.__alpha * (duration_ms - self.latency_ms)
+        if self.limiter is not None:
+            self.limiter.release(duration_ms, ok)
+        return duration_ms
+
+    def cancel(self, start: float) -> None:
+        """Accounts a request started at `start` and abandoned: its latency is at least the time it took so far."""
+        self.in_flight -= 1
+        elapsed_ms = (time.monotonic() - start) * 1000.0
+        if self.latency_ms is not None and elapsed_ms > self.latency_ms:
+            self.__updated = time.monotonic()
+            self.latency_ms += self.__alpha * (elapsed_ms - self.latency_ms)
+        if self.limiter is not None:
+            self.limiter.release()
+
+    def score(self, baseline_ms: float = 0.0) -> float:
+        # expected wait of one more request: the latency of this backend times the queue it would join.
+        # Latency not refreshed for a while decays toward `baseline_ms` (the median of its peers), so a backend
+        # that was slow once gets tried again, but one left idle does not come to look faster than the others.
+        if self.latency_ms is None:
+            return 0.0
+        latency_ms = baseline_ms + (self.latency_ms - baseline_ms) * \
+            math.exp(-(time.monotonic() - self.__updated) / self.__decay_s)
+        return latency_ms * (self.in_flight + 1)
+
+    @staticmethod
+    def median_latency_ms(backends: List['Backend']) -> float:
+        """The baseline of score(): the median latency of the backends that have answered, 0 if none has."""
+        latencies = sorted(backend.latency_ms for backend in backends if backend.latency_ms is not None)
+        return latencies[len(latencies) // 2] if len(latencies) != 0 else 0.0
+
+    def stats(self) -> Mapping[str, Any]:
+        return {
+            'host': self.host,
+            'port': self.port,
+            'weight': self.weight,
+            'in_flight': self.in_flight,
+            'latency_ms': self.latency_ms,
+            'requests': self.requests,
+            'errors': self.errors,
+            'state': self.breaker.state,
+            'ejected': self.breaker.ejected,
+            'limit': int(self.limiter.limit) if self.limiter is not None else None,
+        }
+
+
+class BackendPool:
+    """Picks the backend for the next request among the ones their circuit breakers let through.
+
+    Besides request outcomes, a backend is ejected when it answers slower than `outlier_factor` times the
+    median latency of the pool, or fails `unhealthy_threshold` active health checks in a row. No more than
+    `max_ejection_percent` of the backends are ever ejected at once, a pool never ejects its last backends.
+    Backends with an adaptive concurrency limiter are skipped while they are at their limit.
+
+    Strategies:
+    - round_robin: the next backend in order;
+    - least_outstanding: the backend with the fewest requests in flight;
+    - p2c_ewma: the better of two random backends by EWMA latency times in-flight requests;
+    - weighted_round_robin: smooth weighted round robin over the configured weights.
+    """
+
+    STRATEGY_ROUND_ROBIN = 'round_robin'
+    STRATEGY_LEAST_OUTSTANDING = 'least_outstanding'
+    STRATEGY_P2C_EWMA = 'p2c_ewma'
+    STRATEGY_WEIGHTED_ROUND_ROBIN = 'weighted_round_robin'
+
+    STRATEGIES = (STRATEGY_ROUND_ROBIN, STRATEGY_LEAST_OUTSTANDING, STRATEGY_P2C_EWMA,
+                  STRATEGY_WEIGHTED_ROUND_ROBIN)
+
+    def __init__(self, backends: List[Backend], strategy: str = STRATEGY_ROUND_ROBIN, outlier_factor: float = 5.0,
+                 min_outlier_latency_ms: float = 100.0, max_ejection_percent: int = 50, unhealthy_threshold: int = 3):
+        if strategy not in self.STRATEGIES:
+            raise ValueError("unknown balancing strategy '{}'".format(strategy))
+        if len(backends) == 0:
+            raise ValueError('no backends to balance')
+        self.backends = backends
+        self.__strategy = strategy
+        self.__outlier_factor = outlier_factor
+        self.__min_outlier_latency_ms = min_outlier_latency_ms
+        self.__max_ejected = len(backends) * max_ejection_percent // 100
+        self.__unhealthy_threshold = unhealthy_threshold
+        self.__failed_checks = [0] * len(backends)
+
+        self.__cur_ind = 0
+        self.__current_weights = [0] * len(backends)
+
+    @classmethod
+    def from_config(cls, balancing_cfg: dict, servers: List[Mapping[str, Any]],
+                    loop: asyncio.AbstractEventLoop) -> 'BackendPool':
+        breaker_cfg = balancing_cfg.get('circuit_breaker', {})
+        limiter_cfg = balancing_cfg.get('concurrency_limit', {}).get('per_backend')
+        # requests to a hanging backend must not hold capacity for the default 5 minutes of aiohttp.
+        timeout = aiohttp.ClientTimeout(total=balancing_cfg.get('request_timeout_ms', 10000) / 1000.0)
+        # bodies are proxied as is, compressed ones included.
+        backends = [Backend(server['host'], server['port'],
+                            aiohttp.ClientSession('http://{}:{}'.format(server['host'], server['port']), loop=loop,
+                                                  timeout=timeout, auto_decompress=False),
+                            weight=server.get('weight', 1),
+                            ewma_alpha=balancing_cfg.get('ewma_alpha', 0.3),
+                            decay_s=balancing_cfg.get('decay_s', 10.0),
+                            breaker=CircuitBreaker(window=breaker_cfg.get('window', 20),
+                                                   min_requests=breaker_cfg.get('min_requests', 10),
+                                                   max_error_rate=breaker_cfg.get('max_error_rate', 0.5),
+                                                   max_consecutive_failures=breaker_cfg.get(
+                                                       'max_consecutive_failures', 5),
+                                                   base_ejection_s=breaker_cfg.get('base_ejection_s', 5.0),
+                                                   max_ejection_s=breaker_cfg.get('max_ejection_s', 60.0),
+                                                   half_open_requests=breaker_cfg.get('half_open_requests', 1)),
+                            limiter=ConcurrencyLimiter.from_config(limiter_cfg) if limiter_cfg is not None else None)
+                    for server in servers]
+        return cls(backends, strategy=balancing_cfg.get('strategy', cls.STRATEGY_ROUND_ROBIN),
+                   outlier_factor=breaker_cfg.get('outlier_factor', 5.0),
+                   min_outlier_latency_ms=breaker_cfg.get('min_outlier_latency_ms', 100.0),
+                   max_ejection_percent=breaker_cfg.get('max_ejection_percent', 50),
+                   unhealthy_threshold=balancing_cfg.get('health_check', {}).get('unhealthy_threshold', 3))
+
+    def stats(self) -> Mapping[str, Any]:
+        return {
+            'strategy': self.__strategy,
+            'backends': [backend.stats() for backend in self.backends],
+        }
+
+    def pick(self, exclude: Optional[Backend] = None) -> Optional[Backend]:
+        """Returns None when every backend (but `exclude`) is ejected or at its concurrency limit."""
+        available = [i for i, backend in enumerate(self.backends)
+                     if backend is not exclude and backend.breaker.available() and
+                     (backend.limiter is None or backend.limiter.available())]
+        if len(available) == 0:
+            return None
+        if self.__strategy == self.STRATEGY_LEAST_OUTSTANDING:
+            backend = self.__least_outstanding(available)
+        elif self.__strategy == self.STRATEGY_P2C_EWMA:
+            backend = self.__p2c_ewma(available)
+        elif self.__strategy == self.STRATEGY_WEIGHTED_ROUND_ROBIN:
+            backend = self.__weighted_round_robin(available)
+        else:
+            backend = self.__round_robin(available)
+        backend.breaker.acquire()
+        return backend
+
+    def finish(self, backend: Backend, start: float, ok: bool = True) -> float:
+        """Accounts a finished request (see Backend.finish) and ejects the backend if it went bad."""
+        duration_ms = backend.finish(start, ok)
+        eject = backend.breaker.record(ok)
+        if not eject and backend.breaker.state == CircuitBreaker.CLOSED:
+            eject = self.__is_outlier(backend)
+        if eject:
+            self.__eject(backend)
+        return duration_ms
+
+    def cancel(self, backend: Backend, start: float) -> None:
+        """Accounts an abandoned request (see Backend.cancel), it is neither a success nor a failure."""
+        backend.cancel(start)
+        backend.breaker.release()
+
+    async def check_health(self, path: str, timeout_ms: int) -> None:
+        """Probes every backend once; `unhealthy_threshold` failed probes in a row eject a backend."""
+        async def probe(backend: Backend) -> bool:
+            try:
+                async with backend.client.get(path, timeout=aiohttp.ClientTimeout(total=timeout_ms / 1000.0)) as resp:
+                    return resp.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return False
+
+        results = await asyncio.gather(*(probe(backend) for backend in self.backends))
+        for i, (backend, ok) in enumerate(zip(self.backends, results)):
+            self.__failed_checks[i] = 0 if ok else self.__failed_checks[i] + 1
+            if self.__failed_checks[i] >= self.__unhealthy_threshold and \
+                    backend.breaker.state != CircuitBreaker.HALF_OPEN:
+                self.__eject(backend)
+
+    def __eject(self, backend: Backend) -> None:
+        if backend.breaker.state == CircuitBreaker.CLOSED:
+            ejected = sum(1 for other in self.backends if other.breaker.state != CircuitBreaker.CLOSED)
+            if ejected >= self.__max_ejected:
+                return
+        backend.breaker.trip()
+
+    def __is_outlier(self, backend: Backend) -> bool:
+        if backend.latency_ms is None or backend.latency_ms < self.__min_outlier_latency_ms or len(self.backends) < 3:
+            return False
+        latencies = sorted(other.latency_ms for other in self.backends
+                           if other is not backend and other.latency_ms is not None)
+        if len(latencies) == 0:
+            return False
+        return backend.latency_ms > self.__outlier_factor * latencies[len(latencies) // 2]
+
+    def __round_robin(self, available: List[int]) -> Backend:
+        n = len(self.backends)
+        ind = min(available, key=lambda i: (i - self.__cur_ind) % n)
+        self.__cur_ind = (ind + 1) % n
+        return self.backends[ind]
+
+    def __least_outstanding(self, available: List[int]) -> Backend:
+        # scanning from a rotating start spreads ties instead of always loading the first backend.
+        n = len(self.backends)
+        start = self.__cur_ind
+        self.__cur_ind = (self.__cur_ind + 1) % n
+        ind = min(available, key=lambda i: (self.backends[i].in_flight, (i - start) % n))
+        return self.backends[ind]
+
+    def __p2c_ewma(self, available: List[int]) -> Backend:
+        if len(available) == 1:
+            return self.backends[available[0]]
+        a, b = (self.backends[i] for i in random.sample(available, 2))
+        baseline_ms = Backend.median_latency_ms(self.backends)
+        return a if a.score(baseline_ms) <= b.score(baseline_ms) else b
+
+    def __weighted_round_robin(self, available: List[int]) -> Backend:
+        total = 0
+        best = None
+        for i in available:
+            self.__current_weights[i] += self.backends[i].weight
+            total += self.backends[i].weight
+            if best is None or self.__current_weights[i] > self.__current_weights[best]:
+                best = i
+        self.__current_weights[best] -= total
+        return self.backends[best]
+
@@ -0,0 +1,146 @@
+import asyncio
+import collections
+import math
+from typing import Any, Deque, Mapping, Optional
+
+
+class ConcurrencyLimiter:
+    """Adaptive limit on the requests in flight, driven by their latency.
+
+    Algorithms:
+    - gradient: the limit follows the ratio of the long-term latency to the latest one: it shrinks as soon as
+      requests queue up downstream and grows by about sqrt(limit) while latency stays at its usual level;
+    - aimd: the limit grows by one per request while more than half of it is used, and is multiplied by
+      `backoff` on every error or request slower than `latency_threshold_ms`.
+
+    Failed requests shrink the limit with both. The limit only grows while it is actually used, so an idle
+    period does not inflate it. A request over the limit waits in a FIFO queue of up to `max_queue` for at
+    most `max_wait_ms`, and is rejected when either runs out.
+    """
+
+    GRADIENT = 'gradient'
+    AIMD = 'aimd'
+
+    ALGORITHMS = (GRADIENT, AIMD)
+
+    def __init__(self, algorithm: str = GRADIENT, initial_limit: int = 20, min_limit: int = 1, max_limit: int = 1000,
+                 max_queue: int = 100, max_wait_ms: float = 100.0, smoothing: float = 0.2, tolerance: float = 1.5,
+                 long_window: int = 600, backoff: float = 0.9, latency_threshold_ms: float = 1000.0):
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError("unknown concurrency limit algorithm '{}'".format(algorithm))
+        self.__algorithm = algorithm
+        self.__min_limit = min_limit
+        self.__max_limit = max_limit
+        self.__max_queue = max_queue
+        self.__max_wait_s = max_wait_ms / 1000.0
+        self.__smoothing = smoothing
+        self.__tolerance = tolerance
+        self.__long_alpha = 2.0 / (long_window + 1)
+        self.__backoff = backoff
+        self.__latency_threshold_ms = latency_threshold_ms
+
+        self.limit = float(initial_limit)
+        self.in_flight = 0
+        self.__long_latency_ms: Optional[float] = None
+        self.__waiters: Deque[asyncio.Future] = collections.deque()
+
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, limiter_cfg: dict) -> 'ConcurrencyLimiter':
+        return cls(algorithm=limiter_cfg.get('algorithm', cls.GRADIENT),
+                   initial_limit=limiter_cfg.get('initial_limit', 20),
+                   min_limit=limiter_cfg.get('min_limit', 1),
+                   max_limit=limiter_cfg.get('max_limit', 1000),
+                   max_queue=limiter_cfg.get('max_queue', 100),
+                   max_wait_ms=limiter_cfg.get('max_wait_ms', 100.0),
+                   smoothing=limiter_cfg.get('smoothing', 0.2),
+                   tolerance=limiter_cfg.get('tolerance', 1.5),
+                   long_window=limiter_cfg.get('long_window', 600),
+                   backoff=limiter_cfg.get('backoff', 0.9),
+                   latency_threshold_ms=limiter_cfg.get('latency_threshold_ms', 1000.0))
+
+    def stats(self) -> Mapping[str, Any]:
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'queued': len(self.__waiters),
+            'rejected': self.rejected,
+        }
+
+    def available(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def take(self) -> None:
+        """Takes a slot regardless of the limit, for callers that checked available() themselves."""
+        self.in_flight += 1
+
+    def try_acquire(self) -> bool:
+        if not self.available() or len(self.__waiters) != 0:
+            return False
+        self.take()
+        return True
+
+    async def acquire(self) -> bool:
+        """Takes a slot, waiting for one if allowed; returns False if the request is rejected."""
+        if self.try_acquire():
+            return True
+        if len(self.__waiters) >= self.__max_queue or self.__max_wait_s <= 0:
+            self.rejected += 1
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self.__waiters.append(waiter)
+        granted = False
+        try:
+            await asyncio.wait((waiter,), timeout=self.__max_wait_s)
+            granted = waiter.done()
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+                self.__waiters.remove(waiter)
+            elif not granted:
+                # the slot was handed over just as the caller got cancelled.
+                self.release()
+        if not granted:
+            self.rejected += 1
+        return granted
+
+    def release(self, duration_ms: Optional[float] = None, ok: bool = True) -> None:
+        """Gives back a slot; a request abandoned before its outcome (None duration) does not move the limit."""
+        self.in_flight -= 1
+        if duration_ms is not None:
+            self.__update(duration_ms, ok)
+        while len(self.__waiters) != 0 and self.available():
+            self.in_flight += 1
+            self.__waiters.popleft().set_result(True)
+
+    def __update(self, duration_ms: float, ok: bool) -> None:
+        if not ok:
+            limit = self.limit * self.__backoff
+        elif self.__algorithm == self.AIMD:
+            if duration_ms > self.__latency_threshold_ms:
+                limit = self.limit * self.__backoff
+            elif (self.in_flight + 1) * 2 >= self.limit:
+                limit = self.limit + 1.0
+            else:
+                return
+        else:
+            limit = self.__gradient(duration_ms)
+            if limit is None:
+                return
+        self.limit = max(float(self.__min_limit), min(float(self.__max_limit), limit))
+
+    def __gradient(self, duration_ms: float) -> Optional[float]:
+        if self.__long_latency_ms is None:
+            self.__long_latency_ms = duration_ms
+        else:
+            self.__long_latency_ms += self.__long_alpha * (duration_ms - self.__long_latency_ms)
+            if self.__long_latency_ms > 2.0 * duration_ms:
+                # the latency dropped for good (e.g. a slow backend recovered), the baseline catches up faster.
+                self.__long_latency_ms *= 0.95
+        # the request that just finished was in flight too.
+        if (self.in_flight + 1) * 2 < self.limit:
+            return None
+        gradient = max(0.5, min(1.0, self.__tolerance * self.__long_latency_ms / max(duration_ms, 1e-3)))
+        limit = self.limit * gradient + math.sqrt(self.limit)
+        return self.limit * (1.0 - self.__smoothing) + limit * self.__smoothing
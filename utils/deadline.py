@@ -0,0 +1,79 @@
+import asyncio
+import math
+import time
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+from utils.utils import DEADLINE_HEADER
+
+
+class Deadline:
+    """When the caller of a request stops waiting for its answer; None is no deadline.
+
+    Services pass it on in DEADLINE_HEADER as the milliseconds left, not as a point in time, so the clocks of
+    the hosts need not agree (the time on the wire is not accounted). Work that cannot finish before the
+    deadline is not worth doing: its answer would go nowhere.
+    """
+
+    SLACK_S = 0.001
+
+    def __init__(self, timeout_ms: Optional[float] = None):
+        self.__expires_at = time.monotonic() + timeout_ms / 1000.0 if timeout_ms is not None else None
+
+    @classmethod
+    def from_request(cls, req: web.Request, default_ms: Optional[float] = None) -> 'Deadline':
+        """The deadline the caller sent, but no later than `default_ms` from now."""
+        timeout_ms = default_ms
+        try:
+            header = req.headers.get(DEADLINE_HEADER)
+            given_ms = float(header) if header is not None else None
+        except ValueError:
+            given_ms = None
+        # 'inf' would never expire and cannot be passed on, 'nan' compares with nothing.
+        if given_ms is not None and math.isfinite(given_ms):
+            timeout_ms = given_ms if timeout_ms is None else min(given_ms, timeout_ms)
+        return cls(timeout_ms)
+
+    @classmethod
+    def latest(cls, *deadlines: 'Deadline') -> 'Deadline':
+        """The deadline of work done for all of `deadlines` at once: it is useful until the last one."""
+        deadline = cls()
+        if len(deadlines) != 0 and all(d.__expires_at is not None for d in deadlines):
+            deadline.__expires_at = max(d.__expires_at for d in deadlines)
+        return deadline
+
+    def remaining_s(self) -> Optional[float]:
+        if self.__expires_at is None:
+            return None
+        return max(0.0, self.__expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.__expires_at is not None and time.monotonic() >= self.__expires_at
+
+    def caused(self, error: BaseException) -> bool:
+        """Whether `error` is an upstream call cut by this deadline rather than a failure of the upstream."""
+        # the timer of the call may fire a clock tick before the deadline.
+        return isinstance(error, asyncio.TimeoutError) and self.__expires_at is not None and \
+            time.monotonic() >= self.__expires_at - self.SLACK_S
+
+    def header(self) -> Optional[str]:
+        remaining_s = self.remaining_s()
+        return str(int(remaining_s * 1000.0)) if remaining_s is not None else None
+
+    def client_timeout(self, total_s: Optional[float] = None) -> aiohttp.ClientTimeout:
+        """Timeout of an upstream call: until the deadline, or after `total_s` if that comes first."""
+        remaining_s = self.remaining_s()
+        if remaining_s is None or (total_s is not None and total_s < remaining_s):
+            return aiohttp.ClientTimeout(total=total_s)
+        return aiohttp.ClientTimeout(total=remaining_s)
+
+    async def sleep(self, delay_s: float) -> bool:
+        """Sleeps for `delay_s`, or until the deadline if it comes first; returns False in that case."""
+        remaining_s = self.remaining_s()
+        if remaining_s is not None and remaining_s < delay_s:
+            await asyncio.sleep(remaining_s)
+            return False
+        await asyncio.sleep(delay_s)
+        return True
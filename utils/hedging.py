@@ -0,0 +1,76 @@
+import collections
+from typing import Any, Deque, Mapping
+
+
+class HedgingPolicy:
+    """When to duplicate a slow idempotent request, and how many duplicates to afford.
+
+    The hedge delay is the `percentile` of the latencies of the last `window` requests (`initial_delay_ms`
+    until `min_samples` are seen, never less than `min_delay_ms`), so only the slowest requests are hedged.
+    Every request earns `budget` of a hedge and a hedge spends a whole one, so duplicates stay within
+    `budget` of the traffic even when everything gets slow under overload. At most `max_tokens` hedges are
+    saved up, a quiet period does not buy a burst of them.
+    """
+
+    def __init__(self, percentile: float = 95.0, budget: float = 0.05, min_delay_ms: float = 5.0,
+                 initial_delay_ms: float = 500.0, window: int = 1000, min_samples: int = 100,
+                 max_tokens: float = 10.0):
+        self.__percentile = percentile
+        self.__budget = budget
+        self.__min_delay_ms = min_delay_ms
+        self.__min_samples = min_samples
+        self.__max_tokens = max_tokens
+
+        self.__latencies: Deque[float] = collections.deque(maxlen=window)
+        # the percentile is recomputed every tenth of a window, not on every request.
+        self.__recompute_every = max(1, window // 10)
+        self.__since_recompute = 0
+        self.__delay_ms = max(min_delay_ms, initial_delay_ms)
+
+        self.__tokens = 0.0
+
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @classmethod
+    def from_config(cls, hedging_cfg: dict) -> 'HedgingPolicy':
+        return cls(percentile=hedging_cfg.get('percentile', 95.0),
+                   budget=hedging_cfg.get('budget', 0.05),
+                   min_delay_ms=hedging_cfg.get('min_delay_ms', 5.0),
+                   initial_delay_ms=hedging_cfg.get('initial_delay_ms', 500.0),
+                   window=hedging_cfg.get('window', 1000),
+                   min_samples=hedging_cfg.get('min_samples', 100),
+                   max_tokens=hedging_cfg.get('max_tokens', 10.0))
+
+    def stats(self) -> Mapping[str, Any]:
+        return {
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'delay_ms': self.__delay_ms,
+        }
+
+    def delay_s(self) -> float:
+        return self.__delay_ms / 1000.0
+
+    def record(self, duration_ms: float) -> None:
+        self.__latencies.append(duration_ms)
+        self.__since_recompute += 1
+        if self.__since_recompute >= self.__recompute_every and len(self.__latencies) >= self.__min_samples:
+            self.__since_recompute = 0
+            latencies = sorted(self.__latencies)
+            ind = min(len(latencies) - 1, int(len(latencies) * self.__percentile / 100.0))
+            self.__delay_ms = max(self.__min_delay_ms, latencies[ind])
+
+    def admit(self) -> None:
+        """Accounts a hedgeable request, it earns its share of the budget."""
+        self.requests += 1
+        self.__tokens = min(self.__max_tokens, self.__tokens + self.__budget)
+
+    def can_hedge(self) -> bool:
+        return self.__tokens >= 1.0
+
+    def hedged(self) -> None:
+        self.__tokens -= 1.0
+        self.hedges += 1
@@ -0,0 +1,45 @@
+import time
+
+
+class SnowflakeGenerator:
+    """Snowflake-style 64-bit ids: 41 bits of ms since `epoch_ms`, 5 bits of node id, 5 bits of worker id and
+    a 12-bit sequence within the ms.
+
+    Ids of different (node, worker) pairs never collide, ids of one generator grow monotonically. When the
+    sequence of a ms runs out, or the clock steps back, the generator keeps counting on its own clock
+    instead of waiting, so a burst of more than 4096 ids per ms only borrows ms from the future.
+    """
+
+    NODE_BITS = 5
+    WORKER_BITS = 5
+    SEQUENCE_BITS = 12
+
+    MAX_NODE_ID = (1 << NODE_BITS) - 1
+    MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+
+    # 2024-01-01T00:00:00Z, 41 bits of ms last till 2093.
+    DEFAULT_EPOCH_MS = 1704067200000
+
+    def __init__(self, node_id: int = 0, worker_id: int = 0, epoch_ms: int = DEFAULT_EPOCH_MS):
+        if not 0 <= node_id <= self.MAX_NODE_ID:
+            raise ValueError('node id must be in [0, {}]'.format(self.MAX_NODE_ID))
+        if not 0 <= worker_id <= self.MAX_WORKER_ID:
+            raise ValueError('worker id must be in [0, {}]'.format(self.MAX_WORKER_ID))
+        self.__prefix = ((node_id << self.WORKER_BITS) | worker_id) << self.SEQUENCE_BITS
+        self.__epoch_ms = epoch_ms
+
+        self.__last_ms = -1
+        self.__sequence = 0
+
+    def next_id(self) -> int:
+        now_ms = time.time_ns() // 10 ** 6 - self.__epoch_ms
+        if now_ms > self.__last_ms:
+            self.__last_ms = now_ms
+            self.__sequence = 0
+        else:
+            self.__sequence += 1
+            if self.__sequence >> self.SEQUENCE_BITS != 0:
+                self.__last_ms += 1
+                self.__sequence = 0
+        return (self.__last_ms << (self.NODE_BITS + self.WORKER_BITS + self.SEQUENCE_BITS)) | self.__prefix | \
+            self.__sequence
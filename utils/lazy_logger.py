@@ -0,0 +1,66 @@
+import logging
+from typing import Any, Callable, MutableMapping, Tuple
+
+
+class Deferred:
+    """Argument of a log call that is only computed when the record is formatted."""
+
+    __slots__ = ('__fn', '__value', '__done')
+
+    def __init__(self, fn: Callable[[], Any]):
+        self.__fn = fn
+        self.__value = None
+        self.__done = False
+
+    def value(self) -> Any:
+        if not self.__done:
+            self.__value = self.__fn()
+            self.__done = True
+        return self.__value
+
+    def __format__(self, format_spec: str) -> str:
+        return format(self.value(), format_spec)
+
+    def __str__(self) -> str:
+        return str(self.value())
+
+
+class BraceMessage:
+    """str.format() message, formatted on first use by a handler (LogRecord.getMessage calls str())."""
+
+    __slots__ = ('__fmt', '__args', '__msg')
+
+    def __init__(self, fmt: str, args: Tuple[Any, ...]):
+        self.__fmt = fmt
+        self.__args = args
+        self.__msg = None
+
+    @property
+    def fmt(self) -> str:
+        return self.__fmt
+
+    def __str__(self) -> str:
+        if self.__msg is None:
+            self.__msg = self.__fmt.format(*self.__args)
+        return self.__msg
+
+
+class LazyLogger(logging.LoggerAdapter):
+    """Level-gated facade over a service logger.
+
+    Messages are str.format() templates with positional arguments: `logger.debug("got {} from {}:{}", x,
+    host, port, extra={...})`. Nothing is formatted, and no Deferred argument is evaluated, unless the
+    level is enabled and a handler actually emits the record. `extra` is passed through as is.
+    """
+
+    def __init__(self, logger: logging.Logger):
+        super().__init__(logger, {})
+
+    def process(self, msg: Any, kwargs: MutableMapping[str, Any]) -> Tuple[Any, MutableMapping[str, Any]]:
+        return msg, kwargs
+
+    def log(self, level: int, msg: Any, *args: Any, **kwargs: Any) -> None:
+        if self.isEnabledFor(level):
+            if len(args) != 0:
+                msg = BraceMessage(msg, args)
+            self.logger.log(level, msg, **kwargs)
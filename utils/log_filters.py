@@ -0,0 +1,164 @@
+import collections
+import logging
+import re
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+from utils.lazy_logger import BraceMessage
+
+# numbers and quoted values are what differs between records of one call site formatted before logging.
+SHAPE_RE = re.compile(r"'[^']*'|\"[^\"]*\"|\d+")
+
+REPEAT_SUFFIX = ' (repeated {} times)'
+REPEAT_SUFFIX_RE = re.compile(r' \(repeated (\d+) times\)$')
+
+
+class DuplicateFilter(logging.Filter):
+    """Collapses records of the same shape and level within a window.
+
+    Records are of the same kind if their level, shape and route agree. The shape is the template of the
+    message when it has arguments, which are never formatted here; otherwise the message with its numbers and
+    quoted values masked. The per-request lines every service logs differ only by session, so by default they
+    are one kind and the summary carries the session of the last of them. With `per_session` the session is
+    part of the kind too, for when each session's own records are what tracing needs. The first record of a
+    kind passes at once, the ones that follow within `window_ms` are held back and counted. When the window is
+    over, the last of them is let through once with `repeat` set to the number of records it stands for, so
+    how often it happened is not lost, only the arguments of the copies.
+    Held back summaries are released by the next record the logger sees, by a timer once a window if the logger
+    goes quiet, and by close().
+    """
+
+    def __init__(self, logger: logging.Logger, window_ms: int = 1000, max_keys: int = 10000,
+                 per_session: bool = False):
+        super().__init__()
+        self.__logger = logger
+        self.__window = window_ms / 1000.0
+        self.__max_keys = max_keys
+        self.__per_session = per_session
+
+        # (levelno, shape, route, session_key or None) -> [window start, held back records, last held back record]
+        self.__windows: 'collections.OrderedDict[Tuple[int, str, Any, Any], list]' = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+        self.__collapsed = 0
+
+        self.__closed = threading.Event()
+        self.__flusher = threading.Thread(target=self.__run, name='log-dedup', daemon=True)
+        self.__flusher.start()
+
+    @property
+    def collapsed(self) -> int:
+        return self.__collapsed
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, 'repeat', None) is not None:
+            return True
+        key = (record.levelno, self.__shape(record), getattr(record, 'route', None),
+               getattr(record, 'session_key', None) if self.__per_session else None)
+        with self.__lock:
+            summaries = self.__expire(record.created)
+            window = self.__windows.get(key)
+            if window is None:
+                self.__windows[key] = [record.created, 0, None]
+                res = True
+            else:
+                window[1] += 1
+                window[2] = record
+                self.__collapsed += 1
+                res = False
+        for summary in summaries:
+            self.__logger.handle(summary)
+        return res
+
+    @staticmethod
+    def __shape(record: logging.LogRecord) -> str:
+        if isinstance(record.msg, BraceMessage):
+            return record.msg.fmt
+        if len(record.args) != 0:
+            return str(record.msg)
+        return SHAPE_RE.sub('#', str(record.msg))
+
+    def close(self) -> None:
+        """Stops the timer and releases every held back summary, windows over or not."""
+        self.__closed.set()
+        self.__flusher.join()
+        self.__release(float('inf'))
+
+    def __run(self) -> None:
+        while not self.__closed.wait(self.__window):
+            # windows start at record.created, which is time.time().
+            self.__release(time.time())
+
+    def __release(self, now: float) -> None:
+        with self.__lock:
+            summaries = self.__expire(now)
+        for summary in summaries:
+            self.__logger.handle(summary)
+
+    def __expire(self, now: float) -> List[logging.LogRecord]:
+        summaries = []
+        while len(self.__windows) != 0:
+            start, count, last = next(iter(self.__windows.values()))
+            if now - start < self.__window and len(self.__windows) < self.__max_keys:
+                break
+            self.__windows.popitem(last=False)
+            if count != 0:
+                last.repeat = count
+                summaries.append(last)
+        return summaries
+
+
+class RateLimitFilter(logging.Filter):
+    """Per-logger token bucket for records up to `max_level` (DEBUG and INFO by default).
+
+    Records over the limit are dropped; how many is reported by a WARNING once the bucket refills.
+    """
+
+    def __init__(self, logger: logging.Logger, rate: float = 1000.0, burst: int = 2000,
+                 max_level: int = logging.INFO):
+        super().__init__()
+        self.__logger = logger
+        self.__rate = rate
+        self.__burst = burst
+        self.__max_level = max_level
+
+        self.__tokens = float(burst)
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+
+        self.__dropped = 0
+        self.__unreported = 0
+
+    @property
+    def dropped(self) -> int:
+        return self.__dropped
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.__max_level or getattr(record, 'repeat', None) is not None:
+            return True
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.__burst, self.__tokens + (now - self.__last) * self.__rate)
+            self.__last = now
+            if self.__tokens < 1.0:
+                self.__dropped += 1
+                self.__unreported += 1
+                return False
+            self.__tokens -= 1.0
+            unreported, self.__unreported = self.__unreported, 0
+        if unreported != 0:
+            self.__logger.warning('rate limit dropped {} log records'.format(unreported),
+                                  extra={'repeat': 1})
+        return True
+
+
+class RepeatFormatter(logging.Formatter):
+    """Appends the repeat count of collapsed records to the text of the line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        res = super().format(record)
+        repeat: Optional[int] = getattr(record, 'repeat', None)
+        if repeat is not None and repeat > 1:
+            res += REPEAT_SUFFIX.format(repeat)
+        return res
@@ -0,0 +1,96 @@
+import logging
+from typing import Any, Mapping, Optional
+
+# Structured log record schema shared by the services (producers) and LogAnalyzer (consumer).
+# Every field is typed, so the analyzer never has to recover them from the message text.
+RECORD_SCHEMA = {
+    'ts_ns': int,
+    'service': str,
+    'name': str,
+    'levelname': str,
+    'msg': str,
+    'session_key': int,
+    'route': str,
+    'upstream_host': str,
+    'upstream_port': int,
+    'duration_ms': float,
+    # number of identical records a collapsed record stands for, see log_filters.DuplicateFilter.
+    'repeat': int,
+}
+
+REQUIRED_FIELDS = ('ts_ns', 'service', 'name', 'levelname', 'msg')
+
+# fields services may pass through `extra`.
+EXTRA_FIELDS = ('session_key', 'route', 'upstream_host', 'upstream_port', 'duration_ms', 'repeat')
+
+UNKNOWN_SESSION_KEY = '???'
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+
+class StructuredFieldsFilter(logging.Filter):
+    """Fills absent structured fields, so `extra` only needs the ones a call site knows."""
+
+    def __init__(self, service: str):
+        super().__init__()
+        self.__service = service
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, 'service'):
+            record.service = self.__service
+        if not hasattr(record, 'session_key'):
+            record.session_key = UNKNOWN_SESSION_KEY
+        for field in EXTRA_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, None)
+        return True
+
+
+def _coerce(field: str, value: Any) -> Any:
+    if value is None:
+        return None
+    t = RECORD_SCHEMA[field]
+    if field == 'session_key' and value == UNKNOWN_SESSION_KEY:
+        return None
+    if t is str:
+        return str(value)
+    if t is int and isinstance(value, float):
+        return int(value)
+    return t(value)
+
+
+def record_from_log_record(record: logging.LogRecord) -> Mapping[str, Any]:
+    res = {
+        'ts_ns': int(record.created * 1e9),
+        'service': getattr(record, 'service', record.name),
+        'name': record.name,
+        'levelname': record.levelname,
+        'msg': record.getMessage(),
+    }
+    for field in EXTRA_FIELDS:
+        try:
+            res[field] = _coerce(field, getattr(record, field, None))
+        except (TypeError, ValueError):
+            res[field] = None
+    return res
+
+
+def normalize_record(params: Mapping[str, Any]) -> Optional[Mapping[str, Any]]:
+    """Validates a received record against RECORD_SCHEMA; returns None if it can not be accepted."""
+    res = {}
+    try:
+        if 'ts_ns' not in params and 'created' in params:
+            # records from senders that only know the LogRecord layout.
+            params = dict(params)
+            params['ts_ns'] = int(float(params['created']) * 1e9)
+            params.setdefault('service', params.get('name'))
+        for field in RECORD_SCHEMA:
+            res[field] = _coerce(field, params.get(field))
+    except (TypeError, ValueError):
+        return None
+    for field in REQUIRED_FIELDS:
+        if res[field] is None:
+            return None
+    if res['levelname'] not in LEVELS or res['ts_ns'] < 0:
+        return None
+    return res
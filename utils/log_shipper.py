@@ -0,0 +1,211 @@
+import collections
+import gzip
+import http.client
+import json
+import logging
+import random
+import threading
+import time
+from typing import Any, Deque, List, Mapping, Optional
+
+from utils.log_record import record_from_log_record
+
+
+class BatchHTTPHandler(logging.Handler):
+    """Ships log records to LogAnalyzer in batches without blocking the caller.
+
+    emit() only serializes the record and puts it into a bounded in-memory queue;
+    a background worker flushes the queue as NDJSON over one keep-alive connection
+    whenever `batch_size` records are pending or `flush_interval_ms` has passed.
+    An overloaded analyzer answers 429; the worker then waits for Retry-After
+    (at most `max_retry_after_ms`) and the queue absorbs the backlog meanwhile.
+    5xx answers and connection errors are retried after a jittered exponential
+    backoff (`backoff_ms`, doubling up to `max_backoff_ms`); a batch the analyzer
+    refuses with another 4xx is not sent again and counts as failed.
+    """
+
+    OVERFLOW_DROP_NEWEST = 'drop_newest'
+    OVERFLOW_DROP_OLDEST = 'drop_oldest'
+    OVERFLOW_BLOCK = 'block'
+
+    OVERFLOW_POLICIES = (OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, OVERFLOW_BLOCK)
+
+    def __init__(self, host: str, port: int, url: str,
+                 queue_size: int = 10000, batch_size: int = 500, flush_interval_ms: int = 200,
+                 overflow_policy: str = OVERFLOW_DROP_NEWEST, block_timeout_ms: int = 50,
+                 max_retries: int = 3, timeout_ms: int = 5000, compress: bool = False,
+                 max_retry_after_ms: int = 10000, backoff_ms: int = 100, max_backoff_ms: int = 5000):
+        super().__init__()
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy '{}'".format(overflow_policy))
+
+        self.__host = host
+        self.__port = port
+        self.__url = url
+
+        self.__queue_size = queue_size
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval_ms / 1000.0
+        self.__overflow_policy = overflow_policy
+        self.__block_timeout = block_timeout_ms / 1000.0
+        self.__max_retries = max_retries
+        self.__timeout = timeout_ms / 1000.0
+        self.__compress = compress
+        self.__max_retry_after = max_retry_after_ms / 1000.0
+        self.__backoff = backoff_ms / 1000.0
+        self.__max_backoff = max_backoff_ms / 1000.0
+
+        self.__queue: Deque[bytes] = collections.deque()
+        self.__cond = threading.Condition(threading.Lock())
+        self.__closed = False
+
+        self.__conn: Optional[http.client.HTTPConnection] = None
+
+        self.__shipped = 0
+        self.__dropped = 0
+        self.__failed = 0
+        self.__batches = 0
+        self.__throttled = 0
+
+        self.__worker = threading.Thread(target=self.__run, name='log-shipper', daemon=True)
+        self.__worker.start()
+
+    def stats(self) -> Mapping[str, int]:
+        with self.__cond:
+            return {
+                'queued': len(self.__queue),
+                'shipped': self.__shipped,
+                'dropped': self.__dropped,
+                'failed': self.__failed,
+                'batches': self.__batches,
+                'throttled': self.__throttled,
+            }
+
+    def map_record(self, record: logging.LogRecord) -> Mapping[str, Any]:
+        return record_from_log_record(record)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            line = json.dumps(self.map_record(record), ensure_ascii=False, default=str).encode('utf-8')
+        except Exception:
+            self.handleError(record)
+            return
+
+        with self.__cond:
+            if self.__closed:
+                self.__dropped += 1
+                return
+            if len(self.__queue) >= self.__queue_size:
+                if self.__overflow_policy == self.OVERFLOW_DROP_NEWEST:
+                    self.__dropped += 1
+                    return
+                elif self.__overflow_policy == self.OVERFLOW_DROP_OLDEST:
+                    self.__queue.popleft()
+                    self.__dropped += 1
+                else:
+                    self.__cond.notify()
+                    deadline = time.monotonic() + self.__block_timeout
+                    while len(self.__queue) >= self.__queue_size:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0.0:
+                            self.__dropped += 1
+                            return
+                        self.__cond.wait(remaining)
+            self.__queue.append(line)
+            if len(self.__queue) >= self.__batch_size:
+                self.__cond.notify()
+
+    def flush(self) -> None:
+        with self.__cond:
+            self.__cond.notify()
+
+    def close(self) -> None:
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify()
+        self.__worker.join(self.__timeout * (self.__max_retries + 1))
+        super().close()
+
+    def __take_batch(self) -> List[bytes]:
+        with self.__cond:
+            deadline = time.monotonic() + self.__flush_interval
+            while not self.__closed and len(self.__queue) < self.__batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0.0:
+                    break
+                self.__cond.wait(remaining)
+            n = min(len(self.__queue), self.__batch_size)
+            batch = [self.__queue.popleft() for __ in range(n)]
+            # wake up producers waiting under the 'block' overflow policy.
+            self.__cond.notify_all()
+            return batch
+
+    def __connect(self) -> http.client.HTTPConnection:
+        if self.__conn is None:
+            self.__conn = http.client.HTTPConnection(self.__host, self.__port, timeout=self.__timeout)
+        return self.__conn
+
+    def __post(self, body: bytes) -> bool:
+        headers = {'Content-Type': 'application/x-ndjson', 'Connection': 'keep-alive'}
+        if self.__compress:
+            body = gzip.compress(body, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        for attempt in range(self.__max_retries + 1):
+            try:
+                conn = self.__connect()
+                conn.request('POST', self.__url, body=body, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status < 300:
+                    return True
+                if resp.status == 429:
+                    self.__wait_retry_after(resp.getheader('Retry-After'))
+                    continue
+                if resp.status < 500:
+                    # the analyzer refused the batch (e.g. 400 or 413), it would refuse it again.
+                    return False
+            except (OSError, http.client.HTTPException):
+                if self.__conn is not None:
+                    self.__conn.close()
+                self.__conn = None
+            if attempt != self.__max_retries:
+                # full jitter: shippers of every service that lost the analyzer at once do not come back at once.
+                self.__wait(random.uniform(0.0, min(self.__backoff * 2 ** attempt, self.__max_backoff)))
+        return False
+
+    def __wait_retry_after(self, retry_after: Optional[str]) -> None:
+        with self.__cond:
+            self.__throttled += 1
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = self.__flush_interval
+        self.__wait(min(max(delay, 0.0), self.__max_retry_after))
+
+    def __wait(self, delay: float) -> None:
+        deadline = time.monotonic() + delay
+        with self.__cond:
+            # close() cuts the wait short, the remaining retries still run.
+            while not self.__closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0.0:
+                    break
+                self.__cond.wait(remaining)
+
+    def __run(self) -> None:
+        while True:
+            batch = self.__take_batch()
+            if len(batch) != 0:
+                ok = self.__post(b'\n'.join(batch) + b'\n')
+                with self.__cond:
+                    self.__batches += 1
+                    if ok:
+                        self.__shipped += len(batch)
+                    else:
+                        self.__failed += len(batch)
+            else:
+                with self.__cond:
+                    if self.__closed:
+                        break
+        if self.__conn is not None:
+            self.__conn.close()
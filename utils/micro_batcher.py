@@ -0,0 +1,114 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Mapping, Optional, Set
+
+# (group, keys, tags of every call) -> result by key; a key missing from the result gets None.
+Dispatch = Callable[[Hashable, List[Hashable], List[Any]], Awaitable[Mapping[Hashable, Any]]]
+
+
+class _Batch:
+    __slots__ = ('waiters', 'tags', 'timer', 'task')
+
+    def __init__(self):
+        self.waiters: Dict[Hashable, List[asyncio.Future]] = {}
+        self.tags: List[Any] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def abandoned(self) -> bool:
+        return all(waiter.done() for waiters in self.waiters.values() for waiter in waiters)
+
+
+class MicroBatcher:
+    """Dataloader-style coalescing of concurrent single-key calls into batch calls.
+
+    Calls of one group (e.g. one statement) are held for up to `max_delay_ms` after the first of them, or
+    until `max_items` distinct keys are collected, then `dispatch` gets all their keys at once and every
+    caller gets the result for its key. Callers asking for the same key share one slot of the batch.
+    A failed dispatch fails every call of its batch, and a batch every caller of which went away is not
+    dispatched, or is cancelled.
+    """
+
+    def __init__(self, dispatch: Dispatch, max_delay_ms: float = 2.0, max_items: int = 100):
+        self.__dispatch = dispatch
+        self.__max_delay_s = max_delay_ms / 1000.0
+        self.__max_items = max_items
+
+        self.__pending: Dict[Hashable, _Batch] = {}
+        # asyncio keeps only weak references to tasks.
+        self.__running: Set[asyncio.Task] = set()
+
+        self.__batches = 0
+        self.__calls = 0
+        self.__keys = 0
+
+    @classmethod
+    def from_config(cls, batching_cfg: dict, dispatch: Dispatch) -> 'MicroBatcher':
+        return cls(dispatch, max_delay_ms=batching_cfg.get('max_delay_ms', 2.0),
+                   max_items=batching_cfg.get('max_items', 100))
+
+    def stats(self) -> Mapping[str, Any]:
+        return {
+            'batches': self.__batches,
+            'calls': self.__calls,
+            'keys': self.__keys,
+            'calls_per_batch': self.__calls / self.__batches if self.__batches != 0 else None,
+        }
+
+    async def load(self, group: Hashable, key: Hashable, tag: Any = None) -> Any:
+        """Returns the result for `key`; `tag` (e.g. a session key) is passed to dispatch along with it."""
+        loop = asyncio.get_running_loop()
+        batch = self.__pending.get(group)
+        if batch is None:
+            batch = _Batch()
+            batch.timer = loop.call_later(self.__max_delay_s, self.__flush, group)
+            self.__pending[group] = batch
+        waiter = loop.create_future()
+        waiters = batch.waiters.get(key)
+        if waiters is None:
+            batch.waiters[key] = [waiter]
+        else:
+            waiters.append(waiter)
+        # a caller sharing the slot of another one may have a tag of its own (e.g. a later deadline).
+        batch.tags.append(tag)
+        self.__calls += 1
+        if len(batch.waiters) >= self.__max_items:
+            self.__flush(group)
+        try:
+            return await waiter
+        finally:
+            if waiter.cancelled() and batch.task is not None and not batch.task.done() and batch.abandoned():
+                batch.task.cancel()
+
+    def __flush(self, group: Hashable) -> None:
+        batch = self.__pending.pop(group, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        self.__batches += 1
+        self.__keys += len(batch.waiters)
+        if batch.abandoned():
+            return
+        batch.task = asyncio.ensure_future(self.__run(group, batch))
+        self.__running.add(batch.task)
+        batch.task.add_done_callback(self.__running.discard)
+
+    async def __run(self, group: Hashable, batch: _Batch) -> None:
+        results: Optional[Mapping[Hashable, Any]] = None
+        error: Optional[Exception] = None
+        try:
+            results = await self.__dispatch(group, list(batch.waiters), batch.tags)
+        except Exception as e:
+            error = e
+        finally:
+            # no caller is left waiting, whatever ended the dispatch: a cancelled one cancels their calls.
+            for key, waiters in batch.waiters.items():
+                for waiter in waiters:
+                    # callers that went away leave cancelled futures behind.
+                    if waiter.done():
+                        continue
+                    if results is not None:
+                        waiter.set_result(results.get(key))
+                    elif error is not None:
+                        waiter.set_exception(error)
+                    else:
+                        waiter.cancel()
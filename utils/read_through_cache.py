@@ -0,0 +1,148 @@
+import asyncio
+import collections
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Mapping, Optional, Tuple
+
+
+class _Flight:
+    __slots__ = ('task', 'version', 'stale', 'waiters')
+
+    def __init__(self, task: asyncio.Future, version: int):
+        self.task = task
+        self.version = version
+        # set by an invalidation while the fetch was running, its result must not be cached.
+        self.stale = False
+        self.waiters = 0
+
+
+class ReadThroughCache:
+    """In-process cache of query results by key, e.g. the answers of every query about one phone number.
+
+    Keys are evicted least recently used first once their results take more than `max_bytes`, and a result
+    is served for `ttl_s` at most. Concurrent misses of one (key, query) share a single fetch (single flight);
+    the fetch runs as a task of its own, so a caller that goes away does not fail the others waiting on it.
+    Once every caller went away the fetch is cancelled, nobody would get its result.
+
+    invalidate(key) drops every result of the key, and fetches that started before it neither fill the cache
+    nor take in new callers. It only reaches this cache: writes made elsewhere are seen through versions. A
+    caller passes the version its read must reflect (e.g. the position of a write it knows of), a result is
+    cached under the version its fetch was made for, and neither a result nor a fetch of a lower version serves
+    it. A write the caller does not know of is seen once the result expires, after `ttl_s` at most.
+    """
+
+    # dict entries, tuples and the key itself, roughly.
+    ENTRY_OVERHEAD_BYTES = 200
+
+    def __init__(self, sizeof: Callable[[Any], Optional[int]], max_bytes: int = 64 * 1024 * 1024,
+                 ttl_s: float = 60.0):
+        self.__sizeof = sizeof
+        self.__max_bytes = max_bytes
+        self.__ttl_s = ttl_s
+
+        # key -> query -> (expires at, value, size, version)
+        self.__entries: 'collections.OrderedDict[Hashable, Dict[Hashable, Tuple[float, Any, int, int]]]' = \
+            collections.OrderedDict()
+        self.__bytes = 0
+        self.__flights: Dict[Hashable, Dict[Hashable, _Flight]] = {}
+
+        self.__hits = 0
+        self.__misses = 0
+        self.__coalesced = 0
+        self.__evictions = 0
+        self.__invalidations = 0
+
+    @classmethod
+    def from_config(cls, cache_cfg: dict, sizeof: Callable[[Any], Optional[int]]) -> 'ReadThroughCache':
+        return cls(sizeof, max_bytes=cache_cfg.get('max_bytes', 64 * 1024 * 1024),
+                   ttl_s=cache_cfg.get('ttl_s', 60.0))
+
+    def stats(self) -> Mapping[str, Any]:
+        lookups = self.__hits + self.__misses + self.__coalesced
+        return {
+            'entries': len(self.__entries),
+            'bytes': self.__bytes,
+            'hits': self.__hits,
+            'misses': self.__misses,
+            'coalesced': self.__coalesced,
+            'hit_ratio': self.__hits / lookups if lookups != 0 else None,
+            'coalesce_ratio': self.__coalesced / lookups if lookups != 0 else None,
+            'evictions': self.__evictions,
+            'invalidations': self.__invalidations,
+        }
+
+    async def get(self, key: Hashable, query: Hashable, fetch: Callable[[], Awaitable[Any]],
+                  version: int = 0) -> Any:
+        """Returns the cached result of `query` about `key` of at least `version`, or awaits `fetch()` for it.
+
+        `fetch()` must return a result of at least `version`. A result is cached when `sizeof` gives its size,
+        None keeps it (e.g. an error answer) out.
+        """
+        queries = self.__entries.get(key)
+        if queries is not None:
+            entry = queries.get(query)
+            if entry is not None and entry[0] > time.monotonic() and entry[3] >= version:
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+                return entry[1]
+
+        flights = self.__flights.setdefault(key, {})
+        flight = flights.get(query)
+        if flight is not None and flight.version >= version:
+            self.__coalesced += 1
+        else:
+            # a fetch of a lower version keeps running for its callers, but takes in no new ones.
+            self.__misses += 1
+            flight = _Flight(asyncio.ensure_future(fetch()), version)
+            flights[query] = flight
+            flight.task.add_done_callback(lambda task: self.__land(key, query, flight))
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # later misses start a fetch of their own rather than join a cancelled one.
+                self.__drop_flight(key, query, flight)
+                flight.task.cancel()
+
+    def invalidate(self, key: Hashable) -> None:
+        self.__invalidations += 1
+        queries = self.__entries.pop(key, None)
+        if queries is not None:
+            self.__bytes -= sum(entry[2] for entry in queries.values())
+        for flight in self.__flights.pop(key, {}).values():
+            flight.stale = True
+
+    def __drop_flight(self, key: Hashable, query: Hashable, flight: _Flight) -> None:
+        flights = self.__flights.get(key)
+        if flights is not None and flights.get(query) is flight:
+            del flights[query]
+            if len(flights) == 0:
+                del self.__flights[key]
+
+    def __land(self, key: Hashable, query: Hashable, flight: _Flight) -> None:
+        self.__drop_flight(key, query, flight)
+        # the exception is retrieved even if every caller is gone.
+        if flight.task.cancelled() or flight.task.exception() is not None or flight.stale:
+            return
+        value = flight.task.result()
+        size = self.__sizeof(value)
+        if size is None:
+            return
+        size += self.ENTRY_OVERHEAD_BYTES
+        if size > self.__max_bytes:
+            return
+
+        queries = self.__entries.setdefault(key, {})
+        old = queries.get(query)
+        if old is not None:
+            if old[3] > flight.version:
+                return
+            self.__bytes -= old[2]
+        queries[query] = (time.monotonic() + self.__ttl_s, value, size, flight.version)
+        self.__bytes += size
+        self.__entries.move_to_end(key)
+        while self.__bytes > self.__max_bytes:
+            __, evicted = self.__entries.popitem(last=False)
+            self.__bytes -= sum(entry[2] for entry in evicted.values())
+            self.__evictions += 1
@@ -0,0 +1,132 @@
+import asyncio
+import collections
+import random
+import time
+from typing import Any, Deque, Hashable, List, Mapping, Optional, Tuple
+
+import aiohttp
+
+from utils.backend_pool import Backend
+
+
+class ReplicaRouter:
+    """Picks the database for a read among a primary and its read-only replicas.
+
+    Every database reports the position of the last write it applied and the primary's time of that write;
+    refresh() polls them. The lag of a replica is how long ago the primary was first seen past the replica's
+    position (or how much older its last write is than the primary's, if more), so it keeps growing while a
+    replica is stuck, even if the primary takes no more writes. A replica lagging more than `max_lag_ms` takes
+    no reads. Of the databases that may serve a read, the better of two random ones by expected wait (EWMA
+    latency times requests in flight) gets it, as with the p2c_ewma strategy of BackendPool. The primary only
+    serves reads with `primary_reads`, or when no replica may.
+
+    Read-your-writes: written() remembers the position of a write under keys (a session, a phone number),
+    a read about those keys only goes to a database known to have reached it. The primary always has. Up to
+    `max_tracked_writes` keys are remembered, a key is forgotten once every replica has caught up with it.
+    What is remembered is local to the process: a position the caller brings along (see WRITE_POSITION_HEADER)
+    is what makes a session read its writes on any MNP server, writes to a number made through another one are
+    only seen once the replica lag allows.
+    """
+
+    def __init__(self, primary: Backend, replicas: List[Backend], primary_reads: bool = True,
+                 max_lag_ms: float = 1000.0, max_tracked_writes: int = 100000):
+        self.primary = primary
+        self.__dbs = [primary] + replicas
+        self.__primary_reads = primary_reads
+        self.__max_lag_ms = max_lag_ms
+        self.__max_tracked_writes = max_tracked_writes
+
+        self.__reachable = [True] * len(self.__dbs)
+        self.__positions = [0] * len(self.__dbs)
+        self.__position_ts = [0.0] * len(self.__dbs)
+        self.__lags_ms = [0.0] * len(self.__dbs)
+        # (position, when first seen) of the primary, as long as some replica is behind it.
+        self.__primary_history: Deque[Tuple[int, float]] = collections.deque()
+        # key -> position of its last write.
+        self.__writes: 'collections.OrderedDict[Hashable, int]' = collections.OrderedDict()
+
+        self.pinned_reads = 0
+
+    @classmethod
+    def from_config(cls, routing_cfg: dict, rw_database: Mapping[str, Any], ro_databases: List[Mapping[str, Any]],
+                    loop: asyncio.AbstractEventLoop) -> 'ReplicaRouter':
+        def backend(db: Mapping[str, Any]) -> Backend:
+            return Backend(db['host'], db['port'],
+                           aiohttp.ClientSession('http://{}:{}'.format(db['host'], db['port']), loop=loop),
+                           ewma_alpha=routing_cfg.get('ewma_alpha', 0.3), decay_s=routing_cfg.get('decay_s', 10.0))
+
+        return cls(backend(rw_database), [backend(db) for db in ro_databases],
+                   primary_reads=routing_cfg.get('primary_reads', True),
+                   max_lag_ms=routing_cfg.get('max_lag_ms', 1000.0),
+                   max_tracked_writes=routing_cfg.get('max_tracked_writes', 100000))
+
+    def stats(self) -> Mapping[str, Any]:
+        dbs = []
+        for i, db in enumerate(self.__dbs):
+            stats = dict(db.stats())
+            stats.update({
+                'primary': i == 0,
+                'reachable': self.__reachable[i],
+                'position': self.__positions[i],
+                'lag_ms': self.__lags_ms[i],
+            })
+            dbs.append(stats)
+        return {'databases': dbs, 'tracked_writes': len(self.__writes), 'pinned_reads': self.pinned_reads}
+
+    def written(self, position: int, *keys: Hashable) -> None:
+        for key in keys:
+            self.__writes[key] = max(position, self.__writes.pop(key, 0))
+        while len(self.__writes) > self.__max_tracked_writes:
+            self.__writes.popitem(last=False)
+
+    def required_position(self, *keys: Hashable) -> int:
+        """The position a database needs to answer a read about `keys` without going back in time."""
+        return max((self.__writes.get(key, 0) for key in keys), default=0)
+
+    def pick_read(self, min_position: int = 0) -> Backend:
+        candidates = [i for i in range(1, len(self.__dbs))
+                      if self.__reachable[i] and self.__lags_ms[i] <= self.__max_lag_ms and
+                      self.__positions[i] >= min_position]
+        if min_position != 0 and len(candidates) != len(self.__dbs) - 1:
+            self.pinned_reads += 1
+        if self.__primary_reads or len(candidates) == 0:
+            candidates.append(0)
+        if len(candidates) == 1:
+            return self.__dbs[candidates[0]]
+        a, b = (self.__dbs[i] for i in random.sample(candidates, 2))
+        baseline_ms = Backend.median_latency_ms(self.__dbs)
+        return a if a.score(baseline_ms) <= b.score(baseline_ms) else b
+
+    async def refresh(self, path: str, timeout_ms: int) -> None:
+        async def status(db: Backend) -> Optional[Mapping[str, Any]]:
+            try:
+                async with db.client.get(path, timeout=aiohttp.ClientTimeout(total=timeout_ms / 1000.0)) as resp:
+                    if resp.status != 200:
+                        return None
+                    return (await resp.json())['data']
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError):
+                return None
+
+        results = await asyncio.gather(*(status(db) for db in self.__dbs))
+        now = time.monotonic()
+        for i, result in enumerate(results):
+            self.__reachable[i] = result is not None
+            if result is not None:
+                self.__positions[i] = result['position']
+                self.__position_ts[i] = result['position_ts']
+        if len(self.__primary_history) == 0 or self.__primary_history[-1][0] < self.__positions[0]:
+            self.__primary_history.append((self.__positions[0], now))
+
+        caught_up = min(self.__positions[1:], default=self.__positions[0])
+        while len(self.__primary_history) > 1 and self.__primary_history[1][0] <= caught_up:
+            self.__primary_history.popleft()
+        for i in range(1, len(self.__dbs)):
+            if self.__positions[i] >= self.__positions[0]:
+                self.__lags_ms[i] = 0.0
+                continue
+            first_ahead = next(seen for position, seen in self.__primary_history if position > self.__positions[i])
+            self.__lags_ms[i] = max(now - first_ahead, self.__position_ts[0] - self.__position_ts[i]) * 1000.0
+
+        # writes every replica has applied need no pinning any more.
+        while len(self.__writes) != 0 and next(iter(self.__writes.values())) <= caught_up:
+            self.__writes.popitem(last=False)
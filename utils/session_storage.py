@@ -0,0 +1,135 @@
+import base64
+import collections
+import hashlib
+import hmac
+import json
+import secrets
+from typing import Any, Optional
+
+from aiohttp import web
+from aiohttp_session import AbstractStorage, Session
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class SignedCookieStorage(AbstractStorage):
+    """Session storage with HMAC-signed cookies.
+
+    A cookie is `<payload>.<signature>`, both base64url: the payload is the session as compact JSON, the
+    signature is a truncated HMAC-SHA256 of it under `secret`. Every balancer configured with the same
+    secret accepts the cookies of the others, so sessions survive restarts and several balancers can serve
+    one VIP. The data is readable by the client, it is only protected from forging: nothing secret may be
+    put into a session.
+
+    Verified cookies are kept in an LRU of `cache_size`, so a repeated cookie costs a dict lookup instead of
+    a HMAC and a JSON decode.
+
+    With `server_side` the cookie only carries a random signed session id and the data stays in a table of
+    up to `max_sessions` sessions. Logout then revokes the session at once (a signed cookie is valid until
+    it expires), but the table is local to the process, so the balancers must route a client back to the
+    one that logged it in.
+    """
+
+    SIGNATURE_BYTES = 16
+
+    def __init__(self, secret: bytes, *, cookie_name: str = 'AIOHTTP_SESSION', max_age: Optional[int] = None,
+                 cache_size: int = 10000, server_side: bool = False, max_sessions: int = 100000):
+        super().__init__(cookie_name=cookie_name, max_age=max_age,
+                         encoder=lambda data: json.dumps(data, separators=(',', ':')))
+        self.__secret = secret
+        self.__cache_size = cache_size
+        # cookie -> session data (or session id when server side).
+        self.__verified: 'collections.OrderedDict[str, Any]' = collections.OrderedDict()
+
+        self.__server_side = server_side
+        self.__max_sessions = max_sessions
+        self.__sessions: 'collections.OrderedDict[str, Any]' = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, session_cfg: dict) -> 'SignedCookieStorage':
+        """An empty `secret` means a random one: sessions are then bound to this process."""
+        secret = session_cfg.get('secret', '')
+        return cls(secret.encode('utf-8') if secret != '' else secrets.token_bytes(32),
+                   cookie_name=session_cfg.get('cookie_name', 'AIOHTTP_SESSION'),
+                   max_age=session_cfg.get('max_age_s'),
+                   cache_size=session_cfg.get('cache_size', 10000),
+                   server_side=session_cfg.get('server_side', False),
+                   max_sessions=session_cfg.get('max_sessions', 100000))
+
+    async def load_session(self, request: web.Request) -> Session:
+        cookie = self.load_cookie(request)
+        value = self.__verify(cookie) if cookie is not None else None
+        if value is None:
+            return Session(None, data=None, new=True, max_age=self.max_age)
+        if not self.__server_side:
+            return Session(None, data=value, new=False, max_age=self.max_age)
+        data = self.__sessions.get(value)
+        if data is None:
+            return Session(None, data=None, new=True, max_age=self.max_age)
+        return Session(value, data=data, new=False, max_age=self.max_age)
+
+    async def save_session(self, request: web.Request, response: web.StreamResponse, session: Session) -> None:
+        if not self.__server_side:
+            if session.empty:
+                return self.save_cookie(response, '', max_age=session.max_age)
+            data = self._get_session_data(session)
+            cookie = self.__sign(self._encoder(data))
+            self.__remember(cookie, data)
+            return self.save_cookie(response, cookie, max_age=session.max_age)
+
+        sid = session.identity
+        if session.empty:
+            if sid is not None:
+                self.__sessions.pop(sid, None)
+            return self.save_cookie(response, '', max_age=session.max_age)
+        if sid is None:
+            sid = secrets.token_urlsafe(16)
+            session.set_new_identity(sid)
+        self.__sessions[sid] = self._get_session_data(session)
+        self.__sessions.move_to_end(sid)
+        if len(self.__sessions) > self.__max_sessions:
+            self.__sessions.popitem(last=False)
+        cookie = self.__sign(sid)
+        self.__remember(cookie, sid)
+        self.save_cookie(response, cookie, max_age=session.max_age)
+
+    def __sign(self, payload: str) -> str:
+        if not self.__server_side:
+            payload = _b64encode(payload.encode('utf-8'))
+        signature = hmac.new(self.__secret, payload.encode('ascii'), hashlib.sha256).digest()
+        return payload + '.' + _b64encode(signature[:self.SIGNATURE_BYTES])
+
+    def __verify(self, cookie: str) -> Any:
+        value = self.__verified.get(cookie)
+        if value is not None:
+            self.__verified.move_to_end(cookie)
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        payload, __, signature = cookie.rpartition('.')
+        try:
+            expected = hmac.new(self.__secret, payload.encode('ascii'), hashlib.sha256).digest()
+            if not hmac.compare_digest(_b64decode(signature), expected[:self.SIGNATURE_BYTES]):
+                return None
+            value = payload if self.__server_side else self._decoder(_b64decode(payload).decode('utf-8'))
+        except ValueError:
+            # bad base64, non-ASCII or broken JSON (json and binascii errors are ValueErrors).
+            return None
+        self.__remember(cookie, value)
+        return value
+
+    def __remember(self, cookie: str, value: Any) -> None:
+        self.__verified[cookie] = value
+        self.__verified.move_to_end(cookie)
+        if len(self.__verified) > self.__cache_size:
+            self.__verified.popitem(last=False)
@@ -1,14 +1,55 @@
 import argparse
+import atexit
 import logging
-from logging import handlers
 from typing import Mapping, Any
 
+import aiohttp
+from aiohttp import web
+
+from utils.log_filters import DuplicateFilter, RateLimitFilter, RepeatFormatter
+from utils.log_record import StructuredFieldsFilter
+from utils.log_shipper import BatchHTTPHandler
+
+# session key of a request proxied by the balancer.
+SESSION_KEY_HEADER = 'X-Session-Key'
+# milliseconds the caller still waits for the answer, see deadline.Deadline.
+DEADLINE_HEADER = 'X-Deadline-Ms'
+# set on a 504 answered because the deadline ran out: the caller gave up, the server did not fail.
+DEADLINE_EXCEEDED_HEADER = 'X-Deadline-Exceeded'
+# position of the last write of a session in the primary database, see replica_router.ReplicaRouter.
+# MNP sets it on the answer to a write, the balancer keeps it in the session and sends it with every request.
+WRITE_POSITION_HEADER = 'X-Write-Position'
+
+
+def make_app_runner(app: web.Application) -> web.AppRunner:
+    # the handler of a request is cancelled when its client goes away, and so are the upstream calls it awaits.
+    # aiohttp 3.8 always does it, later versions only when asked to.
+    if tuple(int(part) for part in aiohttp.__version__.split('.')[:2]) >= (3, 9):
+        return web.AppRunner(app, handler_cancellation=True)
+    return web.AppRunner(app)
+
 
 def get_logger(cfg: dict, name: str) -> logging.Logger:
     logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(cfg['logs'].get('level', 'DEBUG'))
+    logger.addFilter(StructuredFieldsFilter(name))
+
+    # the rate limit drops records before the duplicate filter holds them back, so it never sees those.
+    rate_limit = cfg['logs'].get('rate_limit')
+    if rate_limit is not None:
+        logger.addFilter(RateLimitFilter(logger, rate=rate_limit.get('rate', 1000),
+                                         burst=rate_limit.get('burst', 2000),
+                                         max_level=logging.getLevelName(rate_limit.get('max_level', 'INFO'))))
+    dedup = cfg['logs'].get('dedup')
+    if dedup is not None:
+        dedup_filter = DuplicateFilter(logger, window_ms=dedup.get('window_ms', 1000),
+                                       max_keys=dedup.get('max_keys', 10000),
+                                       per_session=dedup.get('per_session', False))
+        logger.addFilter(dedup_filter)
+        # before logging.shutdown() closes the handlers, registered earlier.
+        atexit.register(dedup_filter.close)
 
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(session_key)s - %(levelname)s - %(message)s')
+    formatter = RepeatFormatter('%(asctime)s - %(name)s - %(session_key)s - %(levelname)s - %(message)s')
 
     if cfg['logs'].get('con', False):
         ch = logging.StreamHandler()
@@ -23,8 +64,19 @@ def get_logger(cfg: dict, name: str) -> logging.Logger:
 
     server = cfg['logs'].get('server')
     if server is not None:
-        hh = handlers.HTTPHandler(host='{}:{}'.format(server.get('host', '0.0.0.0'), server.get('port', 20000)),
-                                  url='/api/v1/add_log', method='POST')
+        hh = BatchHTTPHandler(host=server.get('host', '0.0.0.0'), port=server.get('port', 20000),
+                              url='/api/v1/add_logs',
+                              queue_size=server.get('queue_size', 10000),
+                              batch_size=server.get('batch_size', 500),
+                              flush_interval_ms=server.get('flush_interval_ms', 200),
+                              overflow_policy=server.get('overflow_policy', BatchHTTPHandler.OVERFLOW_DROP_NEWEST),
+                              block_timeout_ms=server.get('block_timeout_ms', 50),
+                              max_retries=server.get('max_retries', 3),
+                              compress=server.get('compress', False),
+                              max_retry_after_ms=server.get('max_retry_after_ms', 10000),
+                              backoff_ms=server.get('backoff_ms', 100),
+                              max_backoff_ms=server.get('max_backoff_ms', 5000))
+        hh.setLevel(server.get('level', 'DEBUG'))
         hh.setFormatter(formatter)
         logger.addHandler(hh)
 